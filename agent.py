@@ -0,0 +1,399 @@
+"""
+
+Process management over a leaf's link, instead of over ssh.
+
+A node checks up on its clients with kill, ps and the like, and over
+ssh every one of those pays for a new connection and handshake. A
+command_agent runs in the leaf and answers the same questions as
+requests over the link the leaf keeps to its node anyway, and an
+agent_client on the node asks them. ssh is only needed when the agent
+doesn't answer, which agent_client reports by raising agent_unavailable.
+    
+    Example leaf:
+        
+        agent = command_agent({'leaf0': ['python', 'leaf.py', 'leaf0']})
+        agent.register(self.dispatch)
+    
+    Example node:
+        
+        agent = agent_client( requester(downlink), dispatch=d )
+        d[REPLY] = agent.handle
+        
+        def checked(p):
+            try:
+                running = answer(p)['running']
+            except agent_unavailable:
+                running = str(pid) in ssh_ps(pid)
+        
+        agent.request('ps', callback=checked, pid=pid)
+
+request() doesn't wait; the reply comes in through the node's loop like
+anything else, and completes the pending request. call() waits for it,
+for the likes of scripts with nothing better to do.
+
+Requests are messages with obj-id 'agent-request', the operation in
+'op' and its arguments alongside:
+    
+    kill    pid, and signal (SIGTERM by default); only the agent's
+            own process, commands it started and its children
+    ps      pid; replies with running, and state and cmdline if known
+    stat    path, inside one of the agent's roots; replies with size,
+            mtime and mode
+    start   name; starts the agent's command called name, and replies
+            with its pid
+
+Replies have obj-id 'agent-reply' and 'ok' True, along with whatever
+the operation replies with, or 'ok' False and an 'error' and 'errno'.
+
+start only runs commands from the agent's own table, which is set up
+in the leaf. Nothing sent over the link is ever run as a command.
+
+"""
+
+import os
+import sys
+import errno
+import signal
+import threading
+import subprocess
+
+from rpc import request_timeout, request_failed
+
+REQUEST = 'agent-request'
+REPLY = 'agent-reply'
+
+if sys.version_info[0] >= 3:
+    _new_session = {'start_new_session': True}
+else:
+    _new_session = {'preexec_fn': os.setsid}
+
+
+class agent_unavailable(Exception):
+    """
+    The agent couldn't be asked, or didn't answer in time
+    """
+    pass
+
+
+class agent_error(EnvironmentError):
+    """
+    The agent tried, and the operation failed
+    """
+    pass
+
+
+def answer(p):
+    """
+    Return the reply to the finished agent request p, or raise
+    agent_unavailable if there wasn't one and agent_error if the
+    operation failed
+    """
+    
+    try:
+        reply = p.result(timeout=0)
+    except (request_timeout, request_failed) as e:
+        raise agent_unavailable(str(e))
+    
+    if not reply.get('ok'):
+        raise agent_error(reply.get('errno'), reply.get('error'))
+    
+    return reply
+
+
+class command_agent(object):
+    """
+    Answer agent requests in a leaf. See the module docstring.
+    """
+    
+    # seconds to put off signalling our own process, so the reply to
+    # the kill gets sent first
+    self_signal_delay = 0.1
+    
+    def __init__(self, commands=None, roots=None):
+        """
+        @commands:
+            dictionary of name -> command, as would be passed to the
+            subprocess module, of what start may run
+        
+        @roots:
+            list of directories whose contents stat may look at; the
+            current directory, by default
+        """
+        
+        self.commands = dict(commands or {})
+        
+        if roots == None:
+            roots = [os.getcwd()]
+        
+        self.roots = [os.path.realpath(r) for r in roots]
+        
+        # Popen objects of commands we started, to reap once they exit
+        self.started = []
+        
+        self.ops = {
+            'kill': self.kill,
+            'ps': self.ps,
+            'stat': self.stat,
+            'start': self.start,
+            }
+        
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            }
+    
+    def register(self, dispatch):
+        """
+        Have dispatcher dispatch hand us agent requests
+        """
+        
+        dispatch.register(REQUEST, self.handle)
+    
+    def handle(self, link, msg):
+        """
+        Carry out the request msg and return the reply, for a
+        dispatcher to push back to link
+        """
+        
+        self.stats['requests'] += 1
+        
+        self.reap()
+        
+        op = self.ops.get(msg.get('op'))
+        
+        try:
+            if op == None:
+                raise ValueError('unknown op %r' % msg.get('op'))
+            
+            out = op(msg)
+            out['ok'] = True
+        
+        except (EnvironmentError, ValueError, KeyError, TypeError) as e:
+            
+            self.stats['errors'] += 1
+            
+            out = {
+                'ok': False,
+                'error': str(e),
+                'errno': getattr(e, 'errno', None),
+                }
+        
+        out['obj-id'] = REPLY
+        out['reply-to'] = msg.get('msg-id')
+        
+        return out
+    
+    def kill(self, msg):
+        
+        pid = int(msg['pid'])
+        sig = int(msg.get('signal', signal.SIGTERM))
+        
+        if not self.owns(pid):
+            raise OSError(errno.EPERM, 'pid %i is not ours to signal' % pid)
+        
+        if pid == os.getpid():
+            timer = threading.Timer(self.self_signal_delay, os.kill,
+                (pid, sig))
+            timer.daemon = True
+            timer.start()
+        else:
+            os.kill(pid, sig)
+        
+        return {}
+    
+    def owns(self, pid):
+        """
+        True if pid is ours to kill: our own process, a command we
+        started that's still running, or a child of ours
+        """
+        
+        if pid <= 0:
+            # process groups, or everything we can see
+            return False
+        
+        if pid == os.getpid() or pid in [p.pid for p in self.started]:
+            return True
+        
+        try:
+            with open('/proc/%i/stat' % pid) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            return False
+        
+        return ppid == os.getpid()
+    
+    def ps(self, msg):
+        
+        pid = int(msg['pid'])
+        
+        try:
+            os.kill(pid, 0)
+            running = True
+        except OSError as e:
+            if e.errno == errno.EPERM:
+                # someone else's, but it's there
+                running = True
+            elif e.errno == errno.ESRCH:
+                running = False
+            else:
+                raise
+        
+        out = {'pid': pid, 'running': running}
+        
+        if not running:
+            return out
+        
+        try:
+            with open('/proc/%i/stat' % pid) as f:
+                # the state follows the parenthesised command name
+                out['state'] = f.read().rsplit(')', 1)[1].split()[0]
+            
+            with open('/proc/%i/cmdline' % pid) as f:
+                out['cmdline'] = f.read().strip('\0').split('\0')
+        
+        except (IOError, IndexError):
+            # exited meanwhile, or no /proc here
+            pass
+        
+        if out.get('state') == 'Z':
+            out['running'] = False
+        
+        return out
+    
+    def stat(self, msg):
+        
+        path = os.path.realpath(msg['path'])
+        
+        if not [r for r in self.roots if path == r or \
+            path.startswith(r.rstrip(os.sep) + os.sep)]:
+            raise OSError(errno.EACCES, 'not under any of our roots', path)
+        
+        st = os.stat(path)
+        
+        return {
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'mode': st.st_mode,
+            }
+    
+    def start(self, msg):
+        
+        cmd = self.commands[msg['name']]
+        
+        devnull = open(os.devnull, 'r+b')
+        
+        try:
+            # a session of its own, so it outlives us
+            proc = subprocess.Popen(cmd, stdin=devnull, stdout=devnull,
+                stderr=devnull, close_fds=True, **_new_session)
+        finally:
+            devnull.close()
+        
+        self.started.append(proc)
+        
+        return {'pid': proc.pid}
+    
+    def reap(self):
+        """
+        Collect the exit status of commands we started that have exited
+        """
+        
+        self.started = [p for p in self.started if p.poll() == None]
+
+
+class agent_client(object):
+    """
+    Ask the command_agent at the other end of a link to do things. See
+    the module docstring.
+    
+    request() returns straight away, and the reply is handed to handle()
+    by whoever pulls from the link. call() and the methods named after
+    operations block until the reply arrives or timeout seconds pass,
+    pulling from the link meanwhile; anything else that arrives then is
+    handed to dispatch.
+    """
+    
+    def __init__(self, requests, timeout=2.0, dispatch=None):
+        """
+        @requests:
+            rpc.requester for the link to the agent
+        
+        @timeout:
+            seconds to wait for each reply before giving up on the agent
+        
+        @dispatch:
+            dispatcher for messages call() pulls that aren't replies. If
+            None, they're left in requests.unsolicited.
+        """
+        
+        self.requests = requests
+        self.timeout = timeout
+        self.dispatch = dispatch
+    
+    def request(self, op, callback=None, **args):
+        """
+        Send a request for op with args, and return its rpc pending
+        object without waiting for the reply. answer() makes sense of
+        it once it's done, and callback, if given, is called with it
+        then. Raises agent_unavailable if the link's down.
+        """
+        
+        if self.requests.link.socket == None:
+            raise agent_unavailable('not connected')
+        
+        msg = dict(args)
+        msg['obj-id'] = REQUEST
+        msg['op'] = op
+        
+        return self.requests.request(msg, callback=callback,
+            timeout=self.timeout)
+    
+    def handle(self, link, msg):
+        """
+        Dispatcher handler for replies pulled from link
+        """
+        
+        self.requests.handle([msg])
+    
+    def call(self, op, **args):
+        """
+        Send a request for op with args, and return the reply. Raises
+        agent_unavailable if there's no answer and agent_error if the
+        operation failed.
+        """
+        
+        p = self.request(op, **args)
+        
+        try:
+            self.requests.wait(p)
+        finally:
+            self.drain()
+        
+        return answer(p)
+    
+    def drain(self):
+        """
+        Dispatch whatever call() pulled that wasn't a reply
+        """
+        
+        requests = self.requests
+        
+        if self.dispatch == None or not requests.unsolicited:
+            return
+        
+        msgs = requests.unsolicited
+        requests.unsolicited = []
+        
+        self.dispatch.dispatch([(requests.link, msg) for msg in msgs])
+    
+    def kill(self, pid, sig=signal.SIGTERM):
+        return self.call('kill', pid=pid, signal=int(sig))
+    
+    def ps(self, pid):
+        return self.call('ps', pid=pid)
+    
+    def stat(self, path):
+        return self.call('stat', path=path)
+    
+    def start(self, name):
+        return self.call('start', name=name)
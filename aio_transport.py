@@ -0,0 +1,366 @@
+"""
+
+asyncio counterparts of the uplink, downlink and listener classes in
+transport.py, for processes that would rather run a single event loop
+than a hand-rolled select() loop. Messages are JSON objects exactly as
+in transport.py, on the wire as well, so async and plain links can be
+freely connected to each other, including HELLO negotiated length
+prefixed framing.
+
+Requires python 3.5 or later.
+
+
+    Example server:
+    
+        async def serve(down):
+            
+            async for json_obj in down:
+                do_stuff(json_obj)
+                await down.push({'ok': True})
+    
+        _listener = async_listener( [('localhost',31415)], serve )
+        
+        await _listener.start()
+        
+    Example client:
+    
+        up = async_uplink('localhost', 31415)
+        
+        await up.push({ 'payload': 'Hello, World!' })
+        
+        async for json_obj in up:
+            do_stuff(json_obj)
+
+
+As with uplink, an async_uplink may push() before the server is ready.
+Messages pushed while disconnected are held until a connection is
+(re)established, and iterating over an async_uplink waits out dropped
+connections rather than ending.
+
+"""
+
+import asyncio
+from collections import deque
+
+from transport import link, uplink, HELLO, _bytes
+
+
+class async_link(link):
+    """
+    Common parts of async_uplink and async_downlink. Framing, decoding
+    and HELLO handling are inherited from transport.link; socket I/O
+    goes through asyncio streams instead.
+    """
+    
+    def __init__(self):
+        
+        link.__init__(self)
+        
+        self.reader = None
+        self.writer = None
+        
+        # objects pull()'ed but not yet returned by iteration
+        self.inbox = deque()
+        
+    def fileno(self):
+        return self.writer.get_extra_info('socket').fileno()
+        
+    def close(self):
+        
+        if self.writer != None:
+            self.writer.close()
+            
+        self.reader = None
+        self.writer = None
+        
+    def write(self, payload):
+        """
+        Frame a serialized JSON object and hand it to the transport
+        """
+        
+        self.writer.write(self.encode(payload))
+        
+    async def push(self, msg):
+        """
+        Send msg, waiting if the transport's write buffer is full
+        """
+        
+        self.write(_bytes(self.dumps(msg)))
+        await self.writer.drain()
+        
+    async def recv(self):
+        """
+        Wait for data and add it to the recieve buffer. Returns the
+        number of bytes recieved, 0 meaning the peer closed the
+        connection.
+        """
+        
+        data = await self.reader.read(self.recv_size)
+        self.rq += data
+        self.stats['bytes_in'] += len(data)
+        
+        return len(data)
+        
+    async def pull(self):
+        """
+        Wait for data and return a list of JSON objects subsequently
+        found in the recieve buffer, or None if the connection closed.
+        """
+        
+        if await self.recv() == 0:
+            self.close()
+            return None
+            
+        return self.unpack()
+        
+    def __aiter__(self):
+        return self
+        
+    async def __anext__(self):
+        
+        while not self.inbox:
+        
+            objs = await self.pull()
+            
+            if objs == None:
+                raise StopAsyncIteration
+                
+            self.inbox.extend(objs)
+            
+        return self.inbox.popleft()
+        
+        
+class async_uplink(async_link):
+    """
+    Connect to a listener (async or not) and reconnect whenever the
+    connection is lost.
+    """
+    
+    def __init__(self, addr, port, connect_msg='', framing='brace',
+                    compress=False, retry=1.0):
+        """
+        @connect_msg:
+            Message to automatically send on connect or reconnect
+            
+        @framing:
+            'brace' or 'length', as for transport.uplink
+            
+        @compress:
+            as for transport.uplink
+            
+        @retry:
+            seconds to wait between connection attempts
+        """
+        
+        async_link.__init__(self)
+        
+        self.addr = addr
+        self.port = port
+        self.retry = retry
+        
+        if isinstance(connect_msg, dict):
+            self.connect_msg = _bytes(self.dumps(connect_msg))
+        else:
+            self.connect_msg = _bytes(connect_msg)
+            
+        self.offer = {}
+        
+        if framing != 'brace' or compress:
+            self.offer['framing'] = ['length']
+            
+        if compress:
+            self.offer['compress'] = ['zlib']
+            
+        # serialized messages push()'ed while disconnected
+        self.pending = deque()
+        
+        # task running connect(), if a connection is in progress
+        self.connecting = None
+        
+    def reconnect(self):
+        """
+        Start connecting in the background unless already doing so.
+        Returns the connecting task.
+        """
+        
+        if self.connecting == None or self.connecting.done():
+            self.close()
+            self.connecting = asyncio.ensure_future(self.connect())
+            
+        return self.connecting
+        
+    async def connect(self):
+        """
+        Try to connect every self.retry seconds until it works, then
+        send our greeting and everything pushed in the meantime
+        """
+        
+        while True:
+        
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.addr, self.port)
+                break
+                
+            except OSError as e:
+                self.log(e.args)
+                await asyncio.sleep(self.retry)
+                
+        # whatever partial object we had belongs to the old connection
+        del self.rq[:]
+        self.framer.reset()
+        self.framing = 'brace'
+        self.compress = None
+        
+        if self.offer:
+            msg = dict(self.offer)
+            msg['obj-id'] = HELLO
+            self.write(_bytes(self.dumps(msg)))
+            
+        if self.connect_msg:
+            self.write(self.connect_msg)
+            
+        while self.pending:
+            self.write(self.pending.popleft())
+            
+    hello = uplink.hello
+            
+    async def push(self, msg):
+        
+        payload = _bytes(self.dumps(msg))
+        
+        if self.writer == None:
+            self.pending.append(payload)
+            self.reconnect()
+            return
+            
+        self.write(payload)
+        
+        try:
+            await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            self.log(e.args)
+            
+            # it may not have got out, so send it again once we've
+            # reconnected, ahead of anything pushed since
+            self.pending.appendleft(payload)
+            self.reconnect()
+            
+    async def pull(self):
+        """
+        As for async_link.pull(), except that a lost connection is
+        reestablished and an empty list returned instead of None
+        """
+        
+        if self.writer == None:
+            await self.reconnect()
+            
+        try:
+            nbytes = await self.recv()
+        except (ConnectionError, OSError) as e:
+            self.log(e.args)
+            nbytes = 0
+            
+        if nbytes == 0:
+            self.reconnect()
+            return []
+            
+        return self.unpack()
+        
+        
+class async_downlink(async_link):
+    """
+    Wrap the streams for a connection accepted by an async_listener
+    """
+    
+    def __init__(self, reader, writer):
+        
+        async_link.__init__(self)
+        
+        self.reader = reader
+        self.writer = writer
+        
+    def hello(self, msg):
+        """
+        Agree to whatever transport features offered we understand, as
+        transport.downlink does
+        """
+        
+        reply = self.answer_offer(msg)
+        
+        if reply != None:
+            self.write(_bytes(self.dumps(reply)))
+            self.use_features(reply)
+            
+    async def pull(self):
+        
+        try:
+            return await async_link.pull(self)
+        except (ConnectionError, OSError) as e:
+            self.log(e.args)
+            self.close()
+            return None
+            
+            
+class async_listener(object):
+    """
+    Accept connections on a list of (addr,port) pairs, producing an
+    async_downlink for each
+    """
+    
+    def __init__(self, locations, handler=None):
+        """
+        @locations:
+            a list of (addr,port) tuples to bind to
+            
+        @handler:
+            coroutine function to run as a new task with each new
+            async_downlink as its argument. If None, new downlinks are
+            instead returned by accept() or by iterating over the
+            listener.
+        """
+        
+        self.locations = locations
+        self.handler = handler
+        
+        self.servers = []
+        self.new_downlinks = asyncio.Queue()
+        
+    async def start(self):
+        """
+        bind() and listen() on every location
+        """
+        
+        for addr, port in self.locations:
+            server = await asyncio.start_server(self.connected, addr, port)
+            self.servers.append(server)
+            
+    def connected(self, reader, writer):
+        
+        down = async_downlink(reader, writer)
+        
+        if self.handler != None:
+            asyncio.ensure_future(self.handler(down))
+        else:
+            self.new_downlinks.put_nowait(down)
+            
+    async def accept(self):
+        """
+        Wait for and return the next new async_downlink
+        """
+        
+        return await self.new_downlinks.get()
+        
+    def __aiter__(self):
+        return self
+        
+    async def __anext__(self):
+        return await self.accept()
+        
+    async def close(self):
+        
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+            
+        self.servers = []
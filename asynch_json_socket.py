@@ -5,7 +5,16 @@ import sys
 import errno
 import datetime
 
-utcnow = datetime.datetime.utcnow()
+from spill import spill_queue
+
+utcnow = datetime.datetime.utcnow
+
+class recv_overflow(Exception):
+    """
+    Raised by _socket.recv() when high_water_mark bytes have arrived
+    without making up a complete object
+    """
+    pass
 
 class _socket(object):
     """
@@ -24,7 +33,8 @@ class _socket(object):
             
         Creates a new socket internally. This socket must be intended to
         connect() only. Note that addr and port must be keyword
-        arguments.
+        arguments. Any of spill_queue's keyword arguments may be given
+        too, along with spill_name, the name of the queue; see below.
         
         Responsibility for attempting to reconnect in case of
         communication failure to lies exclusively with _socket objects
@@ -36,20 +46,26 @@ class _socket(object):
             _s = _socket( ordinary_tcp_socket.accept() )
             
         Wraps the socket obtained from a call to socket.accept().
-
+        
+        Outbound messages that can't be sent yet wait in a spill_queue
+        (see spill.py), which keeps up to high_water_mark bytes in
+        memory and the rest on disk, and sends them in order once the
+        connection's back. Only sockets of the first kind have one,
+        since nobody can reconnect the second kind.
             
         """
         
         if len(args) == 0:
         
             # Use case 1
-            self.addr = kwargs[addr]
-            self.port = kwargs[port]
+            self.addr = kwargs.pop('addr')
+            self.port = kwargs.pop('port')
         
             self.socket = socket.socket(socket.AF_INET,
                 socket.SOCK_STREAM)
                 
             self.previously_connected = False
+            self.connected = False
             
             self.is_accept_socket = False
                 
@@ -76,6 +92,16 @@ class _socket(object):
         
         # maximum self.mem_usage to allow
         self.high_water_mark = int(1e5)
+        
+        # outbound messages past high_water_mark go to disk
+        self.spill = None
+        
+        if not self.is_accept_socket:
+            
+            name = kwargs.pop('spill_name', '%s-%s' % (self.addr, self.port))
+            kwargs.setdefault('mem_limit', self.high_water_mark)
+            
+            self.spill = spill_queue(name, **kwargs)
 
         # circular buffer of (utc datetime, error msg) pairs encountered
         self.errors = deque([],maxlen=512)
@@ -94,6 +120,13 @@ class _socket(object):
                 self.previously_connected = True
                 
             except socket.error as e:
+                
+                if e.errno == errno.EISCONN:
+                    # an earlier nonblocking connect() has finished
+                    self.connected = True
+                    self.previously_connected = True
+                    return
+                    
                 self.errors.append(\
                     (utcnow(), 'connect: errno=%i'%e.errno))            
         else:
@@ -108,25 +141,36 @@ class _socket(object):
         self.fileno = self.socket.fileno()
         self.connected = False
         self.previously_connected = False
+        
+        if self.spill != None:
+            # whatever message we were partway through sending, the new
+            # connection gets all of
+            self.spill.restart()
+        
         self.connect()
                     
     def recv(self):
+        """
+        Read what's waiting on the socket and return the complete JSON
+        objects found, with None at the end if the connection closed.
+        
+        No more than high_water_mark bytes are held waiting to be
+        parsed; past that, we stop reading and leave the rest in the
+        socket, which holds up the sender until we've caught up. If
+        that many bytes don't make up a single object, recv_overflow is
+        raised, since reading on can't help.
+        """
         
         if self.connected != True:
             self.connect()
         
-        if self.mem_usage > self.high_water_mark:
-            # in the future, we may not want to quite delete everything
-            # in the recieve queue
-            self.rq = ''
-            self.errors.append((utcnow(), 'recv: high_water'))
-        
         json_objects = []
         
-        while True:
+        while len(self.rq) < self.high_water_mark:
             try:
                 
-                ret = self.socket.recv(4096)
+                ret = self.socket.recv(min(4096,
+                    self.high_water_mark - len(self.rq)))
                                 
                 if ret == '':
                     # connection closed gracefully
@@ -137,8 +181,7 @@ class _socket(object):
                     break
                     
                 self.rq += ret
-                self.mem_usage = getsizeof(self.rq) + \
-                    self.getsizeof(self.sq)
+                self.mem_usage = self.queued_bytes()
                     
             except socket.error as e:
                 
@@ -166,20 +209,44 @@ class _socket(object):
         if last_idx != None:
             self.rq = self.rq[last_idx:]
             
+        self.mem_usage = self.queued_bytes()
+        
+        if len(self.rq) >= self.high_water_mark:
+            self.errors.append((utcnow(), 'recv: high_water'))
+            raise recv_overflow('%i bytes without a complete object' % \
+                len(self.rq))
+        
         return json_objects
         
         
-    def send(self,msg):
+    def queued_bytes(self):
+        """
+        Bytes in memory waiting to be sent or parsed
+        """
+        
+        if self.spill != None:
+            return len(self.rq) + self.spill.mem_usage()
+        
+        return len(self.rq) + len(self.sq)
+        
+    def send(self,msg=''):
+        """
+        Queue msg and send as much of the queue as the socket will take.
+        Call with no message to carry on draining the queue, after a
+        reconnect for instance. Returns the number of bytes sent.
+        """
         
         if self.connected == False:
             self.connect()
             
+        if self.spill != None:
+            return self._send_spill(msg)
             
         # using an immutable object like a string as a send queue is
         # memory inefficient, but it is convenient 
         self.sq += msg
         
-        self.mem_usage = getsizeof(self.rq) + self.getsizeof(self.sq)
+        self.mem_usage = self.queued_bytes()
         
         if self.mem_usage > self.high_water_mark:
             # haven't been able to send in a while...
@@ -202,6 +269,68 @@ class _socket(object):
                 
         
         self.sq = self.sq[nbytes_sent:]
+        
+        return nbytes_sent
+        
+    def _send_spill(self, msg):
+        """
+        send() for sockets with a spill_queue. Nothing is thrown away
+        while the connection's down; it's all kept for later, on disk
+        once memory's full.
+        """
+        
+        if msg:
+            self.spill.append(msg)
+            
+        self.mem_usage = self.queued_bytes()
+        
+        if self.connected == False:
+            return 0
+            
+        nbytes_sent = 0
+        
+        while self.spill:
+            
+            data = self.spill.peek()
+            
+            if not data:
+                # waiting on the replay rate
+                break
+                
+            try:
+                nbytes = self.socket.send(data)
+                
+            except socket.error as e:
+                
+                if e.errno != errno.EWOULDBLOCK:
+                    self.connected = False
+                    self.errors.append((utcnow(), 'send: errno=%i'%e.errno))
+                    
+                break
+                
+            self.spill.consume(nbytes)
+            nbytes_sent += nbytes
+            
+            if nbytes < len(data):
+                break
+                
+        self.mem_usage = self.queued_bytes()
+        
+        return nbytes_sent
+        
+    def close(self):
+        """
+        Close the socket, keeping whatever hasn't been sent on disk for
+        the next _socket to the same place
+        """
+        
+        if self.spill != None:
+            self.spill.flush_to_disk()
+            self.spill.close()
+            
+        if self.socket != None:
+            self.socket.close()
+            self.socket = None
                     
                 
 def split_on_object_candidate(string):
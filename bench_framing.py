@@ -0,0 +1,127 @@
+"""
+Compare the cost of finding JSON objects in a link's recieve buffer
+using the original whole-buffer brace scan against the incremental
+brace_framer now used by link.pull().
+
+A single large object is fed into the recieve buffer in recv() sized
+chunks, with a pull() style scan after every chunk, as happens when a
+big message arrives slowly. The time spent scanning is reported per
+received byte for successive slices of the backlog. The incremental
+framer should stay flat while the old scan grows with the backlog.
+
+    python bench_framing.py [object size in bytes] [chunk size]
+"""
+
+import sys
+import json
+import time
+
+from transport import brace_framer
+
+
+def legacy_scan(rq):
+    """
+    The brace matching loop link.pull() used before brace_framer
+    """
+    
+    objs = []
+    stack = [None]
+    
+    cursor = 0
+    end = None
+    
+    for i,c in enumerate(rq):
+        
+        if c == '{' or c == '}':
+            
+            stack.append(c)
+            
+            if stack[-2] == '{' and stack[-1] == '}':
+                
+                if len(stack) == 3:
+                    objs.append(rq[cursor:i+1])
+                    end = i+1
+                    cursor = i+1
+                    
+                stack.pop()
+                stack.pop()
+                
+    if end != None:
+        rq = rq[end:]
+        
+    return objs, rq
+    
+    
+def make_payload(size):
+    
+    # lots of small nested objects, so there is structure to scan
+    entry = {'host': 'leaf-0', 'status': {'ok': True, 'load': 0.5}}
+    n = size // len(json.dumps(entry)) + 1
+    
+    return json.dumps({'obj-id': 'bench', 'entries': [entry]*n})
+    
+    
+def run_legacy(payload, chunk):
+    
+    times = []
+    rq = ''
+    
+    for i in range(0, len(payload), chunk):
+        
+        t0 = time.time()
+        rq += payload[i:i+chunk]
+        objs, rq = legacy_scan(rq)
+        times.append(time.time() - t0)
+        
+    return times
+    
+    
+def run_framer(payload, chunk):
+    
+    times = []
+    rq = bytearray()
+    payload = payload.encode('utf-8')
+    framer = brace_framer()
+    
+    for i in range(0, len(payload), chunk):
+        
+        t0 = time.time()
+        rq += payload[i:i+chunk]
+        spans = framer.scan(rq)
+        consumed = framer.consumed()
+        if consumed:
+            del rq[:consumed]
+            framer.discard(consumed)
+        times.append(time.time() - t0)
+        
+    assert len(spans) == 1
+    
+    return times
+    
+    
+def report(name, times, chunk, nslices=8):
+    
+    per = max(len(times) // nslices, 1)
+    
+    cols = []
+    
+    for i in range(0, len(times), per):
+        
+        seg = times[i:i+per]
+        cols.append('%8.1f' % (1e9 * sum(seg) / (len(seg) * chunk)))
+        
+    print('%-8s%s' % (name, ''.join(cols)))
+    
+    
+if __name__ == '__main__':
+    
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    chunk = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    
+    payload = make_payload(size)
+    
+    print('%i byte object in %i byte chunks' % (len(payload), chunk))
+    print('ns per byte recieved, by backlog eighth:')
+    
+    report('framer', run_framer(payload, chunk), chunk)
+    report('legacy', run_legacy(payload, chunk), chunk)
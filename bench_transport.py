@@ -0,0 +1,292 @@
+"""
+Loopback throughput and latency benchmark for the transport module.
+
+A listener in this process accepts connections from a configurable
+number of uplinks spread across a number of client processes. Each
+uplink pushes timestamped messages of a given size at a given rate
+(or as fast as it can). The server measures, over a fixed window after
+a warmup period:
+
+    messages per second and MB per second recieved
+    p50/p99/p999/max latency from push() to pull()
+    CPU time used by the server and by the clients
+    peak RSS of the server and of the largest client
+
+Results are printed as JSON, one object per run, along with the git
+commit and parameters, so that runs on different commits can be
+compared directly. Comma separated lists of sizes, client counts or
+rates run every combination.
+
+    python bench_transport.py --clients 1,100,1000 --size 100,10000 \\
+        --duration 5 --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import multiprocessing
+
+from transport import listener, uplink
+
+
+def raise_fd_limit():
+    """
+    Large fan-in needs more file descriptors than the usual default
+    """
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    return hard
+
+
+def git_commit():
+
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT)
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(ordered, p):
+
+    if not ordered:
+        return None
+
+    i = min(int(p * len(ordered)), len(ordered) - 1)
+
+    return ordered[i]
+
+
+def run_clients(port, nclients, size, rate, until, framing,
+                compress, local, results):
+    """
+    Client process body. Push messages from nclients uplinks until
+    time until, then report resource usage through results.
+    """
+
+    raise_fd_limit()
+
+    ups = [uplink('127.0.0.1', port, framing=framing, compress=compress,
+            local=local) for i in range(nclients)]
+
+    pad = 'x' * size
+
+    start = time.time()
+    sent = 0
+    i = 0
+
+    # don't let queues grow without bound when pushing flat out
+    max_queued = 65536
+
+    while True:
+
+        t = time.time()
+
+        if t >= until:
+            break
+
+        if rate > 0:
+            due = int((t - start) * rate * nclients) - sent
+        else:
+            due = nclients
+
+        for k in range(due):
+
+            up = ups[i]
+            i = (i + 1) % nclients
+
+            if rate <= 0 and up.queued_bytes() > max_queued:
+                continue
+
+            up.push({'obj-id': 'bench', 't': time.time(), 'pad': pad})
+            sent += 1
+
+        for up in ups:
+            if up.queued_bytes():
+                up.send()
+
+        if rate > 0 and due == 0:
+            time.sleep(0.001)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    results.put({
+        'sent': sent,
+        'cpu_s': usage.ru_utime + usage.ru_stime,
+        'peak_rss_kb': usage.ru_maxrss,
+        })
+
+
+def run(nclients, size, rate, args):
+    """
+    Run one benchmark and return a dictionary of results
+    """
+
+    _listener = listener([('127.0.0.1', 0)], local=not args.tcp)
+    port = _listener.bound_sockets[0].getsockname()[1]
+
+    nprocs = max(1, min(args.procs, nclients))
+
+    start = time.time()
+    begin = start + args.warmup
+    end = begin + args.duration
+
+    results = multiprocessing.Queue()
+    procs = []
+
+    for k in range(nprocs):
+
+        first = k * nclients // nprocs
+        n = (k+1) * nclients // nprocs - first
+
+        proc = multiprocessing.Process(target=run_clients,
+            args=(port, n, size, rate, end, args.framing,
+                args.compress, not args.tcp, results))
+        proc.start()
+        procs.append(proc)
+
+    usage0 = resource.getrusage(resource.RUSAGE_SELF)
+
+    links = []
+    latencies = []
+    nbytes = 0
+
+    while True:
+
+        t = time.time()
+
+        if t >= end:
+            break
+
+        readable, new_downlinks = _listener.select(None, timeout=0.1)
+        links += new_downlinks
+
+        for link in readable:
+
+            before = link.stats['bytes_in']
+            objs = link.pull()
+
+            t = time.time()
+
+            if t < begin:
+                continue
+
+            nbytes += link.stats['bytes_in'] - before
+
+            for obj in objs:
+                latencies.append(t - obj['t'])
+
+    usage1 = resource.getrusage(resource.RUSAGE_SELF)
+
+    clients = [results.get() for proc in procs]
+
+    for proc in procs:
+        proc.join()
+
+    for link in links:
+        if link.socket != None:
+            link.close()
+
+    _listener.close()
+
+    latencies.sort()
+
+    def ms(x):
+        if x == None:
+            return None
+        return round(1000 * x, 4)
+
+    return {
+        'commit': args.commit,
+        'python': sys.version.split()[0],
+        'params': {
+            'clients': nclients,
+            'procs': nprocs,
+            'size': size,
+            'rate': rate,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'framing': args.framing,
+            'compress': args.compress,
+            'tcp': args.tcp,
+            },
+        'msgs': len(latencies),
+        'msgs_per_s': len(latencies) / args.duration,
+        'mb_per_s': nbytes / args.duration / 1e6,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 0.5)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'p999': ms(percentile(latencies, 0.999)),
+            'max': ms(latencies[-1] if latencies else None),
+            },
+        'server_cpu_s': (usage1.ru_utime + usage1.ru_stime) - \
+            (usage0.ru_utime + usage0.ru_stime),
+        'server_peak_rss_kb': usage1.ru_maxrss,
+        'client_cpu_s': sum(c['cpu_s'] for c in clients),
+        'client_peak_rss_kb': max(c['peak_rss_kb'] for c in clients),
+        'sent': sum(c['sent'] for c in clients),
+        }
+
+
+def int_list(s):
+    return [int(x) for x in s.split(',')]
+
+def float_list(s):
+    return [float(x) for x in s.split(',')]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+
+    parser.add_argument('--clients', type=int_list, default=[1],
+        help='number of uplinks, comma separated for several runs')
+    parser.add_argument('--size', type=int_list, default=[100],
+        help='message padding in bytes, comma separated')
+    parser.add_argument('--rate', type=float_list, default=[0],
+        help='messages/s per client, 0 for flat out, comma separated')
+    parser.add_argument('--procs', type=int, default=4,
+        help='client processes to spread uplinks over')
+    parser.add_argument('--duration', type=float, default=5.0,
+        help='seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=1.0,
+        help='seconds to run before measuring')
+    parser.add_argument('--framing', default='brace',
+        choices=['brace', 'length'])
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--tcp', action='store_true',
+        help='use loopback TCP rather than a Unix domain socket')
+    parser.add_argument('--output', default=None,
+        help='also write results to this file as a JSON list')
+
+    args = parser.parse_args()
+
+    raise_fd_limit()
+
+    args.commit = git_commit()
+
+    out = []
+
+    for nclients in args.clients:
+        for size in args.size:
+            for rate in args.rate:
+
+                result = run(nclients, size, rate, args)
+                out.append(result)
+
+                print(json.dumps(result, sort_keys=True))
+                sys.stdout.flush()
+
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=1, sort_keys=True)
@@ -29,19 +29,13 @@ class host_interface(object):
         
     def ping_status(self):
         """
-        Call out to the ping utility to test the route to the host interface.
-        Return True if route is ok. For the moment, sends small number of test
-        packets and only returns True if none of them are lost.
+        Test the route to the host interface. Return True if route is ok,
+        that is if the host accepts or refuses a TCP connection to its ssh
+        port. Results are cached by the shared host_prober (see prober()),
+        so this is usually just a lookup.
         """
         
-        # Four test packets, 100 millisecond timeout
-        cmd = ['ping','-c','4','-w','.1',self.addr] 
-        
-        out,err = external_call([cmd])
-        
-        if '0% packet loss' in out[0]:
-            return True
-        return False
+        return prober().status(self.addr, self.sshport)
 
 class client(object):
     """
@@ -0,0 +1,388 @@
+"""
+
+Logical channels multiplexed over a single link.
+
+A channel_mux wraps one end of a link (uplink or downlink) and carries
+any number of named channels over it, each with its own priority and,
+optionally, its own flow control window. Messages pushed to a channel
+wait in that channel's queue, and are only handed to the link when its
+send queue has room, highest priority channel first, so a pulse on a
+control channel never waits behind more than low_water bytes of bulk
+data. Messages bigger than frag_size are split into fragments, so that
+one large message can't hold up a smaller, more urgent one for longer
+than it takes to send a fragment.
+    
+    Example leaf:
+        
+        mux = channel_mux( uplink(addr='localhost',port=31415) )
+        
+        control = mux.channel('control', priority=0)
+        bulk = mux.channel('bulk', priority=10, window=1<<20)
+        
+        bulk.push(big_blob_msg)
+        control.push(pulse)
+    
+    Example node:
+        
+        mux = channel_mux(downlink)
+        
+        for name, msg in mux.pull():
+            ...
+
+On the wire, a message on a channel is the message itself with the
+channel's name in a 'transport-chan' entry, which pull() takes out
+again. Fragments and flow control credit are messages of their own. A
+message without a channel name arrives on the default channel, '', so
+plain links can talk to a channel_mux; flow control needs a
+channel_mux at both ends, though.
+
+Flow control is by credit. A channel with a window sends no more than
+window bytes the other end's application hasn't pull()ed yet, and the
+other end hands credit back as it does. Control channels are best left
+without a window, so that nothing but the link itself can hold them up.
+
+"""
+
+from transport import _bytes
+
+CHAN = 'transport-chan'
+FRAG = 'transport-frag'
+CREDIT = 'transport-credit'
+SIZE = 'transport-size'
+
+
+def split_utf8(data, size):
+    """
+    Split UTF-8 encoded bytes data into pieces of at most size bytes,
+    without cutting any character in two
+    """
+    
+    pieces = []
+    i = 0
+    
+    while i < len(data):
+        
+        j = min(i + size, len(data))
+        
+        # back up to the first byte of a character
+        while j < len(data) and j > i + 1 and \
+            ord(data[j:j+1]) & 0xc0 == 0x80:
+            j -= 1
+        
+        pieces.append(data[i:j])
+        i = j
+    
+    return pieces
+
+
+class channel(object):
+    """
+    One logical channel in a channel_mux. Use channel_mux.channel() to
+    make these.
+    """
+    
+    def __init__(self, mux, name, priority=0, window=None):
+        """
+        @priority:
+            channels with lower numbers are sent first
+        
+        @window:
+            number of bytes that may be sent without credit from the
+            other end, or None for no flow control
+        """
+        
+        self.mux = mux
+        self.name = name
+        self.priority = priority
+        self.window = window
+        
+        # messages waiting to be sent, as a list of (nbytes, message)
+        # units each, nbytes being what the unit takes up encoded;
+        # fragments of one message are sent consecutively
+        self.queue = []
+        
+        # bytes sent that the other end hasn't given us credit for yet
+        self.in_flight = 0
+        
+        # recieving: fragments of a message so far
+        self.fragments = []
+        
+        self.stats = {
+            'msgs_out': 0,
+            'bytes_out': 0,
+            'msgs_in': 0,
+            'fragments_out': 0,
+            'fragments_in': 0,
+            'stalls': 0,
+            }
+    
+    def push(self, msg):
+        """
+        Queue msg on this channel and send() whatever the link has room
+        for. Returns the same as link.push().
+        """
+        
+        self.queue.append(self.mux.units(self, msg))
+        self.stats['msgs_out'] += 1
+        
+        return self.mux.send()
+    
+    def queued(self):
+        """
+        Number of messages waiting to be handed to the link
+        """
+        
+        return len(self.queue)
+    
+    def sendable(self, nbytes):
+        """
+        True if flow control lets us send nbytes more now
+        """
+        
+        if self.window == None or self.in_flight == 0:
+            # always let one unit through, however big
+            return True
+        
+        return self.in_flight + nbytes <= self.window
+    
+    def next_unit(self):
+        """
+        Take the next (nbytes, message) unit to send off the queue, or
+        return None if there isn't one or flow control says wait
+        """
+        
+        if not self.queue:
+            return None
+        
+        units = self.queue[0]
+        nbytes, unit = units[0]
+        
+        if not self.sendable(nbytes):
+            self.stats['stalls'] += 1
+            return None
+        
+        units.pop(0)
+        
+        if not units:
+            self.queue.pop(0)
+        
+        if unit.get('obj-id') == FRAG:
+            self.stats['fragments_out'] += 1
+        
+        if self.window != None:
+            self.in_flight += nbytes
+        
+        self.stats['bytes_out'] += nbytes
+        
+        return nbytes, unit
+    
+    def credit(self, nbytes):
+        """
+        The other end has consumed nbytes of ours
+        """
+        
+        self.in_flight = max(0, self.in_flight - nbytes)
+
+
+class channel_mux(object):
+    """
+    Carry logical channels over link. See the module docstring.
+    """
+    
+    # messages whose encoded JSON is longer than this many bytes are
+    # sent in fragments of about this size
+    frag_size = 16384
+    
+    # only hand the link more messages while it has fewer bytes than
+    # this queued, so that higher priority messages don't have to wait
+    # behind much of anything
+    low_water = 65536
+    
+    def __init__(self, link):
+        
+        self.link = link
+        
+        # channels by name, and in the order to send from them
+        self.channels = {}
+        self.order = []
+        
+        self.channel('')
+    
+    def channel(self, name, priority=None, window=None):
+        """
+        Return the channel called name, creating it if it doesn't exist
+        yet. priority and window are applied to it if given.
+        """
+        
+        ch = self.channels.get(name)
+        
+        if ch == None:
+            ch = channel(self, name, priority or 0, window)
+            self.channels[name] = ch
+            self.order.append(ch)
+        
+        else:
+            if priority != None:
+                ch.priority = priority
+            if window != None:
+                ch.window = window
+        
+        # sort is stable, so equal priorities go in order of creation
+        self.order.sort(key=lambda ch: ch.priority)
+        
+        return ch
+    
+    def units(self, ch, msg):
+        """
+        Return msg as a list of (nbytes, message) units ready to hand to
+        the link: the message itself tagged with the name of channel
+        ch, or fragments of it. nbytes is the size of the unit as the
+        link encodes it. On channels with a window, units also say how
+        many bytes of it they count for, so the other end knows how
+        much credit to give back.
+        """
+        
+        data = _bytes(self.link.dumps(msg))
+        
+        if len(data) <= self.frag_size:
+            units = [(len(data), dict(msg))]
+        
+        else:
+            units = []
+            parts = split_utf8(data, self.frag_size)
+            
+            for i, part in enumerate(parts):
+                
+                part = part.decode('utf-8')
+                
+                # escaping the fragment's text costs a little more
+                nbytes = len(_bytes(self.link.dumps(part)))
+                
+                units.append((nbytes, {
+                    'obj-id': FRAG,
+                    'data': part,
+                    'more': i + 1 < len(parts),
+                    }))
+        
+        for nbytes, unit in units:
+            
+            if ch.name:
+                unit[CHAN] = ch.name
+            
+            if ch.window != None:
+                unit[SIZE] = nbytes
+        
+        return units
+    
+    def send(self):
+        """
+        Hand the link as many queued messages as it has room for,
+        highest priority first, and send() them. Returns the same as
+        link.send().
+        """
+        
+        room = self.low_water - self.link.queued_bytes()
+        
+        batch = []
+        
+        while room > 0:
+            
+            unit = None
+            
+            for ch in self.order:
+                
+                unit = ch.next_unit()
+                
+                if unit != None:
+                    break
+            
+            if unit == None:
+                break
+            
+            nbytes, unit = unit
+            
+            batch.append(unit)
+            room -= nbytes
+        
+        if batch:
+            return self.link.push_many(batch)
+        
+        return self.link.send()
+    
+    def pull(self):
+        """
+        pull() from the link and return a list of (channel name, message)
+        tuples, reassembling fragments and handling credit along the way
+        """
+        
+        out = []
+        
+        # bytes to credit back, by channel name
+        credit = {}
+        
+        for msg in self.link.pull():
+            
+            obj_id = msg.get('obj-id')
+            
+            name = msg.pop(CHAN, '')
+            ch = self.channels.get(name) or self.channel(name)
+            
+            if obj_id == CREDIT:
+                ch.credit(msg['bytes'])
+                continue
+            
+            nbytes = msg.pop(SIZE, 0)
+            
+            if nbytes:
+                credit[name] = credit.get(name, 0) + nbytes
+            
+            if obj_id == FRAG:
+                
+                ch.fragments.append(msg['data'])
+                ch.stats['fragments_in'] += 1
+                
+                if msg['more']:
+                    continue
+                
+                text = ''.join(ch.fragments)
+                ch.fragments = []
+                
+                try:
+                    msg = self.link.loads(text)
+                except ValueError as e:
+                    self.link.log(e.args)
+                    continue
+            
+            ch.stats['msgs_in'] += 1
+            
+            out.append((name, msg))
+        
+        # Give credit back for everything we're handing the application,
+        # once per channel per pull(). Whatever's sent on a windowed
+        # channel stops once the other end runs out of credit, so this
+        # can't turn into a flood.
+        if credit:
+            self.link.push_many([{'obj-id': CREDIT, CHAN: name,
+                'bytes': nbytes} for name, nbytes in credit.items()])
+        
+        # anything waiting on credit may be able to go now
+        if self.link.socket != None:
+            self.send()
+        
+        return out
+    
+    def metrics(self):
+        """
+        Return a dictionary of channel name -> channel stats, plus the
+        number of messages queued and bytes in flight on each
+        """
+        
+        out = {}
+        
+        for name, ch in self.channels.items():
+            m = dict(ch.stats)
+            m['queued'] = ch.queued()
+            m['in_flight'] = ch.in_flight
+            out[name] = m
+        
+        return out
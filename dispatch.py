@@ -0,0 +1,423 @@
+"""
+
+Route recieved messages to handlers by their 'obj-id'.
+
+A dispatcher maps obj-ids to handler functions, and is fed the messages
+pulled from links in each pass through a network loop:
+    
+    def pulse(link, msg):
+        ...
+        return {'obj-id': 'pulse-ok'}
+    
+    def log_lines(pairs):
+        db.insert([msg['line'] for link, msg in pairs])
+    
+    d = dispatcher()
+    d['pulse'] = pulse
+    d.register('log-line', log_lines, batch=True)
+    d.register('rsync', do_rsync, offload=True)
+    d.attach(_listener)
+    
+    while True:
+        
+        readable, new_downlinks = _listener.select(timeout=d.timeout(3))
+        
+        d.dispatch_links(readable)
+        d.collect()
+
+Handlers come in three kinds:
+    
+    plain, called as fn(link, msg) once per message
+    
+    batch, called as fn(pairs) once per pass with a list of every
+    (link, msg) pair for their obj-id, so that work like a database
+    insert is done once for the lot
+    
+    offloaded, plain or batch, but called on a pool of worker threads
+    so a slow handler doesn't hold up the loop. collect() deals with
+    their results back on the loop's thread.
+
+A finished offloaded handler writes to a pipe the dispatcher keeps, to
+wake the loop up for collect(). attach() registers the pipe with a
+listener, whose select() then returns the dispatcher among the
+readable links; its pull() never has anything, so dispatch_links()
+takes it in its stride. Loops of other kinds can wait on the
+dispatcher's fileno() instead.
+
+Whatever a handler returns is sent back: a plain handler may return a
+message, which is pushed to the link its message came from, and a batch
+handler may return a list of (link, msg) replies. None sends nothing.
+Offloaded handlers should only ever talk to links this way, since links
+aren't thread safe.
+
+Every route keeps count of its calls, messages, errors and time spent,
+for metrics().
+
+"""
+
+import os
+import time
+import errno
+import fcntl
+import traceback
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from utils import EVENT_READ
+
+
+class route(object):
+    """
+    A handler and how to call it
+    """
+    
+    def __init__(self, obj_id, fn, batch=False, offload=False):
+        
+        self.obj_id = obj_id
+        self.fn = fn
+        self.batch = batch
+        self.offload = offload
+        
+        self.stats = {
+            'calls': 0,
+            'msgs': 0,
+            'errors': 0,
+            'seconds': 0.0,
+            'max_seconds': 0.0,
+            }
+    
+    def call(self, args):
+        """
+        Call the handler with args. Returns (ok, result, seconds), where
+        result is the traceback if it raised. Safe to use from any
+        thread; it's up to the caller to count it with timed().
+        """
+        
+        t = time.time()
+        
+        try:
+            ok, result = True, self.fn(*args)
+        except Exception:
+            ok, result = False, traceback.format_exc()
+        
+        return ok, result, time.time() - t
+    
+    def timed(self, seconds):
+        
+        stats = self.stats
+        
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        
+        if seconds > stats['max_seconds']:
+            stats['max_seconds'] = seconds
+
+
+class dispatcher(object):
+    """
+    Table of routes by obj-id. See the module docstring.
+    """
+    
+    def __init__(self, threads=4, fallback=None):
+        """
+        @threads:
+            size of the thread pool for offloaded handlers, started the
+            first time one is needed
+        
+        @fallback:
+            if not None, plain handler for messages whose obj-id has no
+            route. Otherwise they're returned from dispatch().
+        """
+        
+        self.threads = threads
+        self.pool = None
+        
+        # route objects by obj-id
+        self.routes = {}
+        
+        self.fallback = None
+        
+        if fallback != None:
+            self.fallback = route(None, fallback)
+        
+        # number of offloaded calls not collect()ed yet
+        self.running = 0
+        
+        # (route, link, result) of offloaded calls that have finished,
+        # appended to by the pool's threads
+        self.finished = deque()
+        
+        # the pool's threads write a byte here when a call finishes,
+        # to wake up whoever's waiting on fileno()
+        self.wake_r, self.wake_w = os.pipe()
+        
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        
+        # True once something waits on the pipe
+        self.watched = False
+        
+        # listeners we're attach()ed to
+        self.listeners = []
+        
+        # (time, obj-id, traceback) for handlers that raised
+        self.errors = deque([], maxlen=512)
+    
+    def register(self, obj_id, fn, batch=False, offload=False):
+        """
+        Route messages with obj-id obj_id to fn, replacing any existing
+        route for obj_id
+        """
+        
+        self.routes[obj_id] = route(obj_id, fn, batch, offload)
+    
+    def unregister(self, obj_id):
+        self.routes.pop(obj_id, None)
+    
+    def __setitem__(self, obj_id, fn):
+        self.register(obj_id, fn)
+    
+    def __getitem__(self, obj_id):
+        return self.routes[obj_id].fn
+    
+    def __delitem__(self, obj_id):
+        del self.routes[obj_id]
+    
+    def __contains__(self, obj_id):
+        return obj_id in self.routes
+    
+    def handler(self, obj_id, batch=False, offload=False):
+        """
+        Decorator version of register()
+        """
+        
+        def decorate(fn):
+            self.register(obj_id, fn, batch, offload)
+            return fn
+        
+        return decorate
+    
+    def attach(self, _listener):
+        """
+        Have _listener's select() return as soon as an offloaded handler
+        finishes, instead of waiting out its timeout
+        """
+        
+        _listener.selector.register(self.wake_r, EVENT_READ, self)
+        
+        self.listeners.append(_listener)
+        self.watched = True
+    
+    def fileno(self):
+        """
+        The wakeup pipe, readable once an offloaded handler has finished
+        """
+        
+        self.watched = True
+        
+        return self.wake_r
+    
+    def wake(self):
+        
+        try:
+            os.write(self.wake_w, b'x')
+        except OSError as e:
+            # a full pipe will wake them up just the same
+            if e.errno != errno.EAGAIN:
+                raise
+    
+    def pull(self):
+        """
+        For listener.select() loops, which take us for a link once
+        we're attach()ed. There are never any messages; collect() has
+        what woke the loop up.
+        """
+        
+        return []
+    
+    def dispatch_links(self, links):
+        """
+        pull() every link in links, and dispatch() everything recieved
+        as one batch. Returns the messages nothing handled, as (link,
+        msg) pairs.
+        """
+        
+        pairs = []
+        
+        for link in links:
+            for msg in link.pull():
+                pairs.append((link, msg))
+        
+        return self.dispatch(pairs)
+    
+    def dispatch(self, pairs):
+        """
+        Hand each (link, msg) in pairs to the handler for its obj-id.
+        Batch handlers get every pair for their obj-id in one call.
+        Returns the pairs nothing handled.
+        """
+        
+        # pairs for each route, in order of first appearance
+        batches = {}
+        order = []
+        
+        unhandled = []
+        
+        routes = self.routes
+        
+        for pair in pairs:
+            
+            r = routes.get(pair[1].get('obj-id'))
+            
+            if r == None:
+                
+                if self.fallback == None:
+                    unhandled.append(pair)
+                    continue
+                
+                r = self.fallback
+            
+            batch = batches.get(r)
+            
+            if batch == None:
+                batch = batches[r] = []
+                order.append(r)
+            
+            batch.append(pair)
+        
+        for r in order:
+            
+            batch = batches[r]
+            r.stats['msgs'] += len(batch)
+            
+            if r.batch:
+                self.call(r, None, (batch,))
+            else:
+                for link, msg in batch:
+                    self.call(r, link, (link, msg))
+        
+        return unhandled
+    
+    def call(self, r, link, args):
+        """
+        Call route r's handler with args, now or on the thread pool
+        """
+        
+        if r.offload:
+            
+            if self.pool == None:
+                self.pool = ThreadPool(self.threads)
+            
+            # called on one of the pool's threads
+            def done(ret):
+                self.finished.append((r, link, ret))
+                self.wake()
+            
+            self.running += 1
+            self.pool.apply_async(r.call, (args,), callback=done)
+        
+        else:
+            self.finish(r, link, r.call(args))
+    
+    def finish(self, r, link, ret):
+        """
+        Deal with what a handler called for a message from link returned
+        """
+        
+        ok, result, seconds = ret
+        
+        r.timed(seconds)
+        
+        if not ok:
+            r.stats['errors'] += 1
+            self.errors.append((time.time(), r.obj_id, result))
+            return
+        
+        if result == None:
+            return
+        
+        if r.batch:
+            for link, msg in result:
+                link.push(msg)
+        else:
+            link.push(result)
+    
+    def collect(self):
+        """
+        Deal with the results of offloaded handlers that have finished.
+        Returns the number still running.
+        """
+        
+        # Empty the pipe first. Calls finish before they write to it,
+        # so any that finish after this are left for the next time.
+        try:
+            while self.wake_r != None and os.read(self.wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        
+        finished = self.finished
+        
+        while finished:
+            
+            r, link, ret = finished.popleft()
+            
+            self.running -= 1
+            self.finish(r, link, ret)
+        
+        return self.running
+    
+    def timeout(self, timeout):
+        """
+        How long a select() should wait so collect() isn't left waiting
+        on finished handlers: timeout, as long as the select() waits on
+        the wakeup pipe too, or less while any are running if it doesn't
+        """
+        
+        if self.running and not self.watched:
+            return min(timeout, 0.01)
+        
+        return timeout
+    
+    def metrics(self):
+        """
+        Return a dictionary of obj-id -> route stats
+        """
+        
+        out = {}
+        
+        for obj_id, r in self.routes.items():
+            out[obj_id] = dict(r.stats)
+        
+        if self.fallback != None:
+            out[None] = dict(self.fallback.stats)
+        
+        return out
+    
+    def close(self):
+        """
+        Wait for offloaded handlers to finish, stop the thread pool and
+        close the wakeup pipe
+        """
+        
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        
+        self.collect()
+        
+        for _listener in self.listeners:
+            try:
+                _listener.selector.unregister(self.wake_r)
+            except (KeyError, ValueError):
+                pass
+        
+        self.listeners = []
+        
+        if self.wake_r != None:
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.wake_r = self.wake_w = None
@@ -0,0 +1,218 @@
+"""
+
+Keep track of which of a large number of clients have missed their
+heartbeat deadlines, without looking at every client every time.
+
+A deadline_tracker is a hashed timing wheel: a ring of slots, each
+covering resolution seconds, and each holding the set of client names
+whose deadlines fall in it. Recording a pulse moves a name from one
+slot to another, which costs the same however many clients there are,
+and expired() only looks at the slots the clock has moved past since
+the last call, so it costs in proportion to the number of deadlines
+that have actually run out, not the number of clients.
+    
+    Example:
+        
+        def check(name):
+            if clients[name].ps_check():
+                # still running, just quiet; give it a while longer
+                tracker.pulse(name)
+            else:
+                restart(name)
+        
+        tracker = deadline_tracker(timeout=30, on_expire=check)
+        
+        while True:
+            
+            for name, msg in recieved():
+                tracker.pulse(name)
+            
+            tracker.expired()
+
+Deadlines are only as precise as the resolution; a deadline is reported
+no earlier than it falls due, and no later than the first call to
+expired() at least resolution seconds after that.
+
+"""
+
+import time
+
+
+class deadline_tracker(object):
+    """
+    Deadlines for a set of names, kept in a hashed timing wheel. See the
+    module docstring.
+    """
+    
+    def __init__(self, timeout=None, resolution=0.1, slots=1024,
+                    on_expire=None):
+        """
+        @timeout:
+            default number of seconds after a pulse until a name's
+            deadline
+        
+        @resolution:
+            seconds covered by each slot of the wheel
+        
+        @slots:
+            number of slots in the wheel. Deadlines further away than
+            slots * resolution seconds work, but are looked at again
+            every time the wheel comes round, so this is best set a
+            little longer than the longest timeout.
+        
+        @on_expire:
+            if not None, function called by expired() as on_expire(name)
+            for every name whose deadline has passed, for follow up
+            checks like client.ps_check(). It's free to pulse() the
+            name again to set a new deadline.
+        """
+        
+        self.timeout = timeout
+        self.resolution = float(resolution)
+        self.on_expire = on_expire
+        
+        self.wheel = [set() for i in range(slots)]
+        
+        # name -> (deadline, tick) for every name being tracked
+        self.deadlines = {}
+        
+        # every tick before this one has been dealt with
+        self.tick = self.tick_of(time.time())
+    
+    def __len__(self):
+        return len(self.deadlines)
+    
+    def __contains__(self, name):
+        return name in self.deadlines
+    
+    def tick_of(self, t):
+        return int(t / self.resolution)
+    
+    def pulse(self, name, timeout=None, t=None):
+        """
+        Record a pulse from name at time t (now, by default), which
+        moves its deadline to timeout seconds (self.timeout, by
+        default) later
+        """
+        
+        if t == None:
+            t = time.time()
+        
+        if timeout == None:
+            timeout = self.timeout
+        
+        self.set_deadline(name, t + timeout)
+    
+    def set_deadline(self, name, deadline):
+        """
+        Make name's deadline time deadline
+        """
+        
+        old = self.deadlines.get(name)
+        tick = self.tick_of(deadline)
+        
+        # deadlines that are already due go in the next slot to be
+        # looked at
+        tick = max(tick, self.tick)
+        
+        if old != None:
+            
+            if old[1] == tick:
+                self.deadlines[name] = (deadline, tick)
+                return
+            
+            self.wheel[old[1] % len(self.wheel)].discard(name)
+        
+        self.wheel[tick % len(self.wheel)].add(name)
+        self.deadlines[name] = (deadline, tick)
+    
+    def forget(self, name):
+        """
+        Stop tracking name
+        """
+        
+        old = self.deadlines.pop(name, None)
+        
+        if old != None:
+            self.wheel[old[1] % len(self.wheel)].discard(name)
+    
+    def deadline(self, name):
+        """
+        Time name's deadline falls due, or None if it isn't tracked
+        """
+        
+        old = self.deadlines.get(name)
+        
+        if old == None:
+            return None
+        
+        return old[0]
+    
+    def expired(self, t=None):
+        """
+        Return a list of the names whose deadlines have passed by time t
+        (now, by default) since the last call, and stop tracking them.
+        Calls on_expire for each of them, if set.
+        """
+        
+        if t == None:
+            t = time.time()
+        
+        now = self.tick_of(t)
+        
+        out = []
+        
+        # once round the wheel covers every slot
+        last = min(now, self.tick + len(self.wheel) - 1)
+        
+        for tick in range(self.tick, last + 1):
+            
+            bucket = self.wheel[tick % len(self.wheel)]
+            
+            if not bucket:
+                continue
+            
+            for name in list(bucket):
+                
+                deadline = self.deadlines[name][0]
+                
+                # a later time round the wheel, or not quite due
+                if deadline > t:
+                    continue
+                
+                bucket.discard(name)
+                del self.deadlines[name]
+                
+                out.append(name)
+        
+        # the current tick may still have deadlines to come
+        self.tick = max(self.tick, now)
+        
+        if self.on_expire != None:
+            for name in out:
+                self.on_expire(name)
+        
+        return out
+    
+    def next_deadline(self):
+        """
+        Earliest deadline being tracked, or None, for working out how
+        long a select() can wait. Looks through the wheel from the
+        current slot for the first one with a deadline this time round.
+        """
+        
+        if not self.deadlines:
+            return None
+        
+        for tick in range(self.tick, self.tick + len(self.wheel)):
+            
+            bucket = self.wheel[tick % len(self.wheel)]
+            
+            due = [self.deadlines[name][0] for name in bucket \
+                if self.deadlines[name][1] == tick]
+            
+            if due:
+                return min(due)
+        
+        # everything's more than once round the wheel away
+        return min(d for d, tick in self.deadlines.values())
@@ -1,9 +1,13 @@
 import os
+import sys
 import json
 import datetime
 from utils import *
 from text import *
 from transport import *
+from rpc import requester
+from dispatch import dispatcher
+from agent import command_agent
 
 now = datetime.datetime.utcnow()
 
@@ -25,24 +29,36 @@ class host_interface(object):
         
     def ping_status(self):
         """
-        Call out to the ping utility to test the route to the host interface.
-        Return True if route is ok. For the moment, sends small number of test
-        packets and only returns True if none of them are lost.
+        Test the route to the host interface. Return True if route is ok,
+        that is if the host accepts or refuses a TCP connection to its ssh
+        port. Results are cached by the shared host_prober (see prober()),
+        so this is always just a lookup; None if the host hasn't been
+        probed yet.
         """
         
-        # Four test packets, 100 millisecond timeout
-        cmd = ['ping','-c','4','-w','.1',self.addr] 
+        return prober().status(self.addr, self.sshport)
         
-        out,err = external_call([cmd])
-        
-        if '0% packet loss' in out[0]:
-            return True
-        return False
+def own_invocation():
+    """
+    The command this process was started with, or None if it wasn't
+    started from a script, as in an interactive session
+    """
+    
+    if not sys.argv or not os.path.isfile(sys.argv[0]):
+        return None
         
+    return [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+
 class leaf(object):
     
-    def __init__(self, name, upstream_host, local_host):
-        
+    def __init__(self, name, upstream_host, local_host, invocation=None):
+        """
+        @invocation:
+            Command, as would be passed to the subprocess module, that
+            starts this leaf, for the node to have the agent run when
+            it starts us. By default, the command this process was
+            started with.
+        """
         
         self.name = name
         self.local = local_host
@@ -54,9 +70,23 @@ class leaf(object):
         self.logs = {}
         
         self.uplink = None
+        self.requests = None
         
         # handler function dispatch table for upstream requests
-        self.dispatch = {}
+        self.dispatch = dispatcher()
+        
+        if invocation == None:
+            invocation = own_invocation()
+        
+        # answers the node's kill, ps, stat and start requests, so it
+        # needn't ssh in for them. The node asks to start us by name.
+        commands = {}
+        
+        if invocation != None:
+            commands[name] = invocation
+        
+        self.agent = command_agent(commands)
+        self.agent.register(self.dispatch)
         
         
         def log
@@ -86,7 +116,24 @@ class leaf(object):
             connect_msg = msgdict
             )
             
+        # matches up replies to our requests upstream
+        self.requests = requester(self.uplink)
+        
+        # the node's answer to check_in()
+        self.dispatch['pulse-ok'] = self.replied
+    
+    def replied(self, link, msg):
+        """
+        Dispatcher handler for replies to our requests
+        """
+        
+        self.requests.handle([msg])
+            
     def check_in(self):
+        """
+        Send a pulse upstream. Returns a pending request, which
+        completes with the reply.
+        """
         
         msgdict = {'obj-id': 'pulse',
                     'clientname': self.name,
@@ -95,9 +142,7 @@ class leaf(object):
                     'time': str(now())
                     }
                     
-        self.uplink.push(msgdict)
-        
-        objs = self.uplink.pull()
+        return self.requests.request(msgdict)
         
         
         
@@ -1,7 +1,6 @@
 import socket
 import select
 import json
-import threading
 import signal
 import shlex
 import subprocess
@@ -9,8 +8,16 @@ import os.path
 import os
 import datetime
 import socket
+import time
 
-from asycnch_json_socket import _socket
+from asynch_json_socket import _socket
+from transport import listener
+from heartbeat import deadline_tracker
+from dispatch import dispatcher
+from utils import supervisor, run_commands, prober, process_handle
+from rpc import requester
+from agent import agent_client, agent_unavailable, agent_error, answer, \
+    REPLY
 
 class host_machine(object):
 
@@ -30,18 +37,13 @@ class host_machine(object):
         self.prefix = prefix
         
     def test_route_to_host(self):
+        """
+        True if the host accepts or refuses a TCP connection to its ssh
+        port, from the shared host_prober's cache. None if the host
+        hasn't been probed yet; a probe is then started in the background.
+        """
         
-        cmd = ['ping','-c','4','-w','.1',self.addr]
-
-        proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-            
-        out,err = proc.communicate()
-        
-        if '0% packet loss' in out:
-            return True
-        else:
-            return False
+        return prober().status(self.addr, self.sshport)
         
     def dump(self):     
         
@@ -114,6 +116,13 @@ class tracked_log(object):
         # false if last download ok; utc time of last attempt if error
         self.err = False 
         
+        # the end of rsync's stderr from the last download
+        self.err_output = b''
+        
+        # bytes of rsync's output to keep
+        self.tail_bytes = 4096
+        
+        # process_handle of the download in progress
         self.worker = None
         self.worker_in_flight = False
 
@@ -127,36 +136,39 @@ class tracked_log(object):
         implementing a function in the server class that finds a set 
         of groups of files that can be each combined into a single rsync
         command, and then launches rsync in parallel on the whole set.
+        
+        rsync runs under the shared process supervisor, and only the
+        end of what it says is kept, in self.err_output, for when it
+        fails.
         """
         
         if self.is_local:
             return
-        
-        def _pull():
             
-            if self.worker_in_flight:
-                return
-                
-            self.worker_in_flight = True
+        if self.worker_in_flight:
+            return
+            
+        self.worker_in_flight = True
         
-            proc = subprocess.Popen(
-                    self.cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                    )
-                
-            out, err = proc.communicate()
+        self.worker = supervisor().run(self.cmd, callback=self.pulled,
+            tail=self.tail_bytes)
             
-            if out == None and err == None:
-                self.last_download = datetime.datetime.utcnow()
-                self.err = False
-            else:
-                self.err = datetime.datetime.utcnow()
+    def pulled(self, handle):
+        """
+        Called on the supervisor's thread when rsync is done
+        """
         
-            self.worker_in_flight = False
+        result = handle.outcome
+        
+        if result.returncode == 0:
+            self.last_download = datetime.datetime.utcnow()
+            self.err = False
+        else:
+            self.err = datetime.datetime.utcnow()
             
-        self.worker = threading.Thread(target=_pull)
-        self.worker.start()
+        self.err_output = result.stderr
+        
+        self.worker_in_flight = False
         
 
 class client(object):
@@ -165,6 +177,9 @@ class client(object):
     remote.
     """
     
+    # seconds to give ps, over ssh if need be, to answer ps_check()
+    ps_timeout = 10
+    
     def __init__(self, name, rootpath, host, invocation=None,
                     sshport=None, sshuser=None):
         """
@@ -212,6 +227,10 @@ class client(object):
         
         self.name = name
         self.host = host
+        self.invocation = invocation
+        
+        # runs commands on the client's machine, if it isn't this one
+        self.cmd_prefix = host.prefix
         
         self.port = None
         self.conn = None
@@ -225,6 +244,13 @@ class client(object):
                 
         self.tracked_logs = {}
         
+        # agent_client for the command_agent in the client process,
+        # tried before ssh for start(), stop() and ps_check(). See
+        # set_agent().
+        self.agent = None
+        
+        # rpc pending or process_handle for the ps_check() in progress
+        self.ps = None
         
         # directory containing all the logs we've fetched
         self.mirror = os.path.join(rootpath,'mirrors',name)
@@ -232,28 +258,140 @@ class client(object):
             os.makedirs(self.mirror)
 
         
+    def set_agent(self, link, dispatch=None):
+        """
+        Talk to the client's command_agent over link, the client's
+        connection to us, from now on. Anything that isn't a reply and
+        turns up while a call to the agent waits goes to dispatch.
+        """
+        
+        self.agent = agent_client(requester(link), dispatch=dispatch)
+    
+    def ssh(self, cmd, timeout=None):
+        """
+        Run cmd in the background, and return its process_handle
+        """
+        
+        return supervisor().run(shlex.split(cmd), timeout=timeout,
+            tail=4096)
+        
     def start(self):
-        subprocess.call(self.invocation,shell=True)
+        """
+        Have the agent start us, if the client's machine has one that
+        knows how, or run the invocation over ssh. Doesn't wait for
+        either.
+        """
+        
+        def started(p):
+            try:
+                answer(p)
+            except (agent_unavailable, agent_error):
+                self.ssh_start()
+        
+        if self.agent != None:
+            try:
+                self.agent.request('start', callback=started, name=self.name)
+                return
+            except agent_unavailable:
+                pass
+                
+        self.ssh_start()
+    
+    def ssh_start(self):
+        
+        supervisor().run(['sh', '-c', self.invocation])
         
     def stop(self,force=False):
+        """
+        Signal the client's process, through the agent if it answers or
+        else over ssh. Doesn't wait for either.
+        """
+        
+        sig = signal.SIGKILL if force else signal.SIGTERM
+        
+        def killed(p):
+            try:
+                answer(p)
+            except (agent_unavailable, agent_error):
+                self.ssh_stop(force)
+        
+        if self.agent != None:
+            try:
+                self.agent.request('kill', callback=killed, pid=self.pid,
+                    signal=int(sig))
+                return
+            except agent_unavailable:
+                pass
+                
+        self.ssh_stop(force)
+    
+    def ssh_stop(self, force=False):
+        
         flags = ""
         if force: flags = "-9"
         cmd = "%s kill %s %i" % (self.cmd_prefix, flags, self.pid)
-        subprocess.call(cmd,shell=True)
+        self.ssh(cmd)
         
     def ps_check(self):
+        """
+        Start finding out whether the client's process is running, from
+        the agent or else with ps -p over ssh. running() has the answer
+        once there is one.
+        """
+        
+        if self.agent != None:
+            try:
+                self.ps = self.agent.request('ps', pid=self.pid)
+                return
+            except agent_unavailable:
+                pass
+                
+        self.ssh_ps()
+    
+    def ssh_ps(self):
         
         cmd = '%s ps -p %i' %(self.cmd_prefix,self.pid)
         
-        proc = subprocess.Popen(
-                    shlex.split(cmd),
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                    )
-                    
-        ret, err = proc.communicate()
+        # ps -p only has a line to say for itself, but keep no more
+        # than a page of whatever ssh might have to say on the way
+        self.ps = self.ssh(cmd, timeout=self.ps_timeout)
+        
+    def running(self):
+        """
+        None while ps_check() is waiting on its answer, then True or
+        False if the client's process is or isn't running, or 'unknown'
+        if there was no finding out, because ssh failed or timed out
+        """
+        
+        ps = self.ps
         
-        return ret
+        if ps == None or not ps.done():
+            return None
+        
+        if isinstance(ps, process_handle):
+            
+            result = ps.result()
+            
+            if result.timed_out:
+                return 'unknown'
+            
+            # ps -p exits 1 when there's no such process; ssh exits 255
+            # when it can't get through, and anything else is a mystery
+            if result.returncode == 1:
+                return False
+            
+            # ps answers in bytes
+            if result.returncode == 0 and \
+                str(self.pid).encode() in result.stdout:
+                return True
+            
+            return 'unknown'
+        
+        try:
+            return answer(ps)['running']
+        except (agent_unavailable, agent_error):
+            self.ssh_ps()
+            return None
 
         
     def pull_logs(self):
@@ -286,8 +424,15 @@ class server(object):
     
     """
     
+    # seconds a client may go without a pulse before we check up on it
+    pulse_timeout = 30
+    
+    # seconds between refresh_routes() calls, well within the prober's
+    # ttl
+    route_refresh = 20
+    
     def __init__(self, name, rootdir, upstream,
-			locations=None leaf=True):
+                    locations=None, leaf=True):
         """
         
         @name:
@@ -311,9 +456,10 @@ class server(object):
 
         """
         if locations == None:
-			locations=[socket.gethostbyname(socket.gethostname()),3141]   
-			    
-		self.locations = locations
+            locations = [(socket.gethostbyname(socket.gethostname()),3141)]
+        
+        self.locations = locations
+        self.leaf = leaf
         
         self.upstream = upstream
 
@@ -321,63 +467,180 @@ class server(object):
         # indexed by name
         self.clients = {}
         
+        # when each client's next pulse is due
+        self.heartbeats = deadline_tracker(timeout=self.pulse_timeout,
+            on_expire=self.missed_pulse)
+        
         # indexed by socket filenumber
         self.active_clients = {}
         
-        # dictionary of functions we may need to call in order to
-        # service json messages. By convention, these functions should
-        # accept loaded json structures as argument.
-        self.dispatch = {}      
+        # handlers we may need to call in order to service json
+        # messages, by obj-id. See dispatch.py for how they're called.
+        self.dispatch = dispatcher()
+        self.dispatch['connect'] = self.checked_in
+        self.dispatch['pulse'] = self.checked_in
+        self.dispatch[REPLY] = self.agent_reply
+        
+        # clients whose ps_check() we're waiting on, by name
+        self.checking = {}
         
         # json objects recieved that require attention from all sources 
         self.rbuf = []
         
-        if not leaf:
-            
-            # need sockets to accept() new connections
-            self.downstream_sockets = []
-            
-            for location in locations:
-				sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				sock.settimeout(0.0)
-				self.downstream_sockets.append(sock)
-				
-
         if upstream != None:
             
             # use a _socket for upstream communication
-            self.upstream_socket = _socket(addr=addr, port=port)
+            self.upstream_socket = _socket(addr=upstream.addr,
+                port=upstream.port)
 
+    def checked_in(self, link, msg):
+        """
+        Handle a client's connect message or pulse: note the pulse, and
+        talk to its agent over link, if link's new. A pulse sent as a
+        request, by leaf.check_in(), is answered with 'pulse-ok'.
+        """
+        
+        name = msg.get('clientname')
+        client = self.clients.get(name)
+        
+        if client == None:
+            return
+        
+        if msg.get('pid') != None:
+            client.pid = msg['pid']
+        
+        if client.agent == None or client.agent.requests.link is not link:
+            client.set_agent(link, self.dispatch)
+        
+        self.record_pulse(name)
+        
+        if msg.get('msg-id') != None:
+            return {'obj-id': 'pulse-ok', 'reply-to': msg['msg-id']}
+    
+    def agent_reply(self, link, msg):
+        """
+        Hand a reply from a client's agent to the client's agent_client
+        """
+        
+        for client in self.clients.values():
+            if client.agent != None and client.agent.requests.link is link:
+                client.agent.handle(link, msg)
+                return
+    
+    def record_pulse(self, name):
+        """
+        Note a pulse from the client called name
+        """
+        
+        self.clients[name].pulse = datetime.datetime.utcnow()
+        self.heartbeats.pulse(name)
+        
+    def refresh_routes(self):
+        """
+        Probe every client's host at once, so that test_route_to_host()
+        answers from the cache. Call this every so often, well within
+        the prober's ttl. The probes run in the background, so this
+        doesn't hold up the loop.
+        """
+        
+        hosts = [c.host for c in self.clients.values()]
+        
+        prober().refresh_later([(h.addr, h.sshport) for h in hosts])
+        
+    def missed_pulse(self, name):
+        """
+        Called by self.heartbeats.expired() for each client whose pulse
+        is overdue. Starts a ps_check() on the client, which
+        check_clients() follows up.
+        """
+        
+        client = self.clients.get(name)
+        
+        if client == None:
+            return
+            
+        if client.pid == None:
+            self.restart(name)
+            return
+            
+        client.ps_check()
+        self.checking[name] = client
+    
+    def check_clients(self):
+        """
+        Follow up the ps_check()s missed_pulse() started: a client
+        that's still running is given another pulse_timeout; one that
+        isn't is restarted. One we couldn't find out about is given
+        another pulse_timeout too, and checked again after that, so a
+        network blip doesn't restart a healthy client. Call once per
+        pass through the loop.
+        """
+        
+        for client in self.clients.values():
+            if client.agent != None:
+                # time out requests the agent never answered
+                client.agent.requests.expire()
+        
+        for name, client in list(self.checking.items()):
+            
+            running = client.running()
+            
+            if running == None:
+                continue
+            
+            del self.checking[name]
+            
+            if running == False:
+                self.restart(name)
+            else:
+                self.heartbeats.pulse(name)
+    
+    def restart(self, name):
+        
+        self.clients[name].start()
+        
+        # give it time to come up before checking again
+        self.heartbeats.pulse(name)
+        
     def serve(self):
-		
-		for i,sock in enumerate(self.downstream_sockets):
-			sock.bind( self.locations[i] )
-			sock.listen(5)
-		
-		timeout = 5
-		
-		waiting = [s for s in self.downstream_sockets]
-		
-		while True:
-		
-			readable,w,e = select.select(waiting,[],[],timeout)
-			
-			for r in readable:
-
-				if r in self.downstream_sockets:
-					conn,addr = r.accept()
-					conn.settimeout(0.0)
-					waiting.append(conn)
-					
-				else:
-					
-					# 
-					
-					
-		
-		
-		
-		
-		
+        """
+        Accept clients' connections and handle what they send, checking
+        up on them as their pulses fall due, forever. A leaf has no
+        downstream, so it only listens for its own clients' agents'
+        replies on connections it already has.
+        """
         
-
+        _listener = listener([] if self.leaf else self.locations)
+        self.dispatch.attach(_listener)
+        
+        next_refresh = 0
+        
+        while True:
+            
+            self.serve_once(_listener, 5)
+            
+            if time.time() >= next_refresh:
+                self.refresh_routes()
+                next_refresh = time.time() + self.route_refresh
+    
+    def serve_once(self, _listener, timeout):
+        """
+        One pass through serve()'s loop: wait up to timeout seconds, or
+        until the next pulse is due, for messages from _listener's links
+        and dispatch them
+        """
+        
+        due = self.heartbeats.next_deadline()
+        
+        if due != None:
+            timeout = max(0, min(timeout, due - time.time()))
+        
+        readable, new_downlinks = _listener.select(
+            timeout=self.dispatch.timeout(timeout))
+        
+        self.dispatch.dispatch_links(readable)
+        self.dispatch.collect()
+        
+        # check up on clients whose pulses are overdue
+        self.heartbeats.expired()
+        self.check_clients()
@@ -0,0 +1,541 @@
+"""
+
+At least once delivery over links, across reconnects and restarts.
+
+A link only knows what it handed to the kernel, not what the other end
+did with it; anything still in flight when a connection drops is lost.
+A reliable_sender wraps a link (usually an uplink) and numbers every
+message it sends on a named stream. The other end runs the messages it
+pulls through a reliable_receiver, which passes on each message once,
+in order, and acknowledges them cumulatively: an ack for seq n covers
+every message up to n. The sender keeps whatever hasn't been acked
+yet, and sends it again after a reconnect, when the receiver reports a
+gap, or when acks stop coming for retransmit_timeout seconds. Nothing
+that's been acked is ever sent again.
+    
+    Example leaf:
+        
+        up = reliable_sender( uplink(addr='localhost',port=31415),
+            'leaf0-log' )
+        
+        up.push(msg)
+        
+        while True:
+            for msg in up.pull():
+                ...
+            up.poll()
+    
+    Example node:
+        
+        rx = reliable_receiver()
+        
+        for r in readable:
+            for msg in rx.pull(r):
+                do_stuff(msg)
+
+On the wire, a message on a stream is the message itself with the
+stream's name and the message's sequence number in 'transport-stream'
+and 'transport-seq' entries, which the receiver takes out again. Acks
+are messages of their own. Messages without a stream name are passed
+on by the receiver untouched, so plain links can talk to it too.
+
+The sender may keep a journal of unacked messages on disk, so that
+a leaf that's restarted picks up its stream where it left off and
+sends again whatever the receiver hadn't acked. The receiver keeps the
+last sequence number it passed on for each stream, which is what lets
+it throw away the duplicates this produces. A receiver that's
+restarted itself starts each stream from the first message it sees.
+
+Every message also carries the epoch of its stream, a number the
+sender picks when it starts a stream from scratch, so that a sender
+restarted without its journal, whose sequence numbers start again from
+1, isn't taken for a stream of duplicates. The epoch is kept in the
+journal along with everything else.
+
+"""
+
+import os
+import json
+import time
+import tempfile
+from collections import deque
+
+STREAM = 'transport-stream'
+SEQ = 'transport-seq'
+EPOCH = 'transport-epoch'
+ACK = 'transport-ack'
+
+# where journals are kept, by stream name
+journal_dir = tempfile.gettempdir()
+
+
+def journal_path(name, directory=None):
+    
+    if directory == None:
+        directory = journal_dir
+    
+    return os.path.join(directory, 'transport-%s.journal' % name)
+
+
+class journal(object):
+    """
+    Append only record of a sender's unacked messages. Every message
+    is a line of JSON, as is every ack, and replay() works out from
+    them which messages are still unacked. Once the acked lines are most
+    of the file, it's rewritten with just the unacked ones.
+    """
+    
+    def __init__(self, path, compact_bytes=1<<20):
+        """
+        @compact_bytes:
+            don't rewrite the file until it's at least this long
+        """
+        
+        self.path = path
+        self.compact_bytes = compact_bytes
+        
+        self.f = open(path, 'a')
+        self.size = self.f.tell()
+    
+    def replay(self):
+        """
+        Return (epoch, acked, messages): the stream's epoch, or None if
+        it hasn't got one yet, the last seq acked, and a list of (seq,
+        message) for every message after it, in order
+        """
+        
+        epoch = None
+        acked = 0
+        msgs = []
+        
+        with open(self.path) as f:
+            for line in f:
+                
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # cut short by a crash
+                    continue
+                
+                if 'ack' in rec:
+                    acked = max(acked, rec['ack'])
+                elif 'epoch' in rec:
+                    epoch = rec['epoch']
+                else:
+                    msgs.append((rec['seq'], rec['msg']))
+        
+        return epoch, acked, [(seq, msg) for seq, msg in msgs \
+            if seq > acked]
+    
+    def write(self, rec):
+        
+        line = json.dumps(rec) + '\n'
+        
+        self.f.write(line)
+        self.f.flush()
+        
+        self.size += len(line)
+    
+    def record(self, seq, msg):
+        self.write({'seq': seq, 'msg': msg})
+    
+    def ack(self, epoch, seq, unacked):
+        """
+        Record that everything up to seq is acked, and compact the file
+        if it's mostly acked messages. unacked is what's left, as (seq,
+        message) pairs.
+        """
+        
+        self.write({'ack': seq})
+        
+        if self.size < self.compact_bytes:
+            return
+        
+        lines = [json.dumps({'epoch': epoch}) + '\n',
+            json.dumps({'ack': seq}) + '\n']
+        
+        for s, msg in unacked:
+            lines.append(json.dumps({'seq': s, 'msg': msg}) + '\n')
+        
+        size = sum(len(line) for line in lines)
+        
+        if size * 2 > self.size:
+            return
+        
+        tmp = self.path + '.tmp'
+        
+        with open(tmp, 'w') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        
+        self.f.close()
+        os.rename(tmp, self.path)
+        
+        self.f = open(self.path, 'a')
+        self.size = size
+    
+    def close(self):
+        self.f.close()
+
+
+class reliable_sender(object):
+    """
+    Number the messages pushed to link on the stream called name, and
+    send them again until they're acked. See the module docstring.
+    """
+    
+    # seconds to wait for an ack before sending everything unacked again
+    retransmit_timeout = 10.0
+    
+    def __init__(self, link, name, window=1024, persist=True,
+                    directory=None):
+        """
+        @link:
+            link to send over
+        
+        @name:
+            name of the stream, unique among everything the other end
+            recieves from, and the same from one run of the program to
+            the next if the journal is to be picked up again
+        
+        @window:
+            most messages to have sent but not acked at once. Past that,
+            messages wait until acks make room.
+        
+        @persist:
+            if True, keep unacked messages on disk, in directory
+            (journal_dir by default), and pick up any left over from
+            before
+        """
+        
+        self.link = link
+        self.name = name
+        self.window = window
+        
+        # (seq, message) for every message not acked yet, in order, and
+        # the number of them that have been handed to the link
+        self.unacked = deque()
+        self.sent = 0
+        
+        self.acked = 0
+        self.next_seq = 1
+        
+        self.epoch = None
+        self.journal = None
+        
+        if persist:
+            
+            self.journal = journal(journal_path(name, directory))
+            
+            self.epoch, self.acked, msgs = self.journal.replay()
+            
+            self.unacked.extend(msgs)
+            self.next_seq = self.acked + 1
+            
+            if msgs:
+                self.next_seq = msgs[-1][0] + 1
+        
+        if self.epoch == None:
+            
+            self.epoch = int(time.time() * 1000)
+            
+            if self.journal != None:
+                self.journal.write({'epoch': self.epoch})
+        
+        # time of the last ack, or of the first send since the last one
+        self.last_progress = time.time()
+        
+        # to notice the link reconnecting
+        self.connection = None
+        
+        self.stats = {
+            'msgs': 0,
+            'acks': 0,
+            'retransmits': 0,
+            'retransmitted_msgs': 0,
+            }
+        
+        self.send()
+    
+    def push(self, msg):
+        """
+        Give msg the next sequence number and send it, if the window has
+        room. Returns the number of messages waiting for acks.
+        """
+        
+        seq = self.next_seq
+        self.next_seq += 1
+        
+        msg = dict(msg)
+        msg[STREAM] = self.name
+        msg[SEQ] = seq
+        msg[EPOCH] = self.epoch
+        
+        if self.journal != None:
+            self.journal.record(seq, msg)
+        
+        self.unacked.append((seq, msg))
+        self.stats['msgs'] += 1
+        
+        self.send()
+        
+        return len(self.unacked)
+    
+    def send(self):
+        """
+        Hand the link whatever the window has room for, and send() it
+        """
+        
+        self.check_connection()
+        
+        end = min(len(self.unacked), self.window)
+        
+        if self.sent < end:
+            
+            if self.sent == 0:
+                self.last_progress = time.time()
+            
+            batch = [self.unacked[i][1] for i in range(self.sent, end)]
+            self.sent = end
+            
+            return self.link.push_many(batch)
+        
+        return self.link.send()
+    
+    def check_connection(self):
+        """
+        Start sending unacked messages again from the beginning if the
+        link has reconnected, since whatever was in flight on the old
+        connection may never have arrived
+        """
+        
+        stats = getattr(self.link, 'stats', {})
+        
+        connection = (stats.get('connect_attempts'), stats.get('reconnects'))
+        
+        if connection != self.connection:
+            self.connection = connection
+            self.rewind()
+    
+    def rewind(self):
+        """
+        Send everything unacked again, on the next send()
+        """
+        
+        if self.sent:
+            self.stats['retransmits'] += 1
+            self.stats['retransmitted_msgs'] += self.sent
+        
+        self.sent = 0
+    
+    def handle_ack(self, msg):
+        
+        if msg.get(EPOCH) != self.epoch:
+            # meant for an earlier run of this stream
+            return
+        
+        seq = msg['seq']
+        
+        self.stats['acks'] += 1
+        
+        if seq > self.acked:
+            
+            while self.unacked and self.unacked[0][0] <= seq:
+                self.unacked.popleft()
+                self.sent = max(0, self.sent - 1)
+            
+            self.acked = seq
+            self.last_progress = time.time()
+            
+            if self.journal != None:
+                self.journal.ack(self.epoch, seq, self.unacked)
+        
+        if msg.get('gap'):
+            # the other end missed something after seq
+            self.rewind()
+    
+    def pull(self):
+        """
+        pull() from the link, handling acks, and return everything else
+        """
+        
+        out = []
+        
+        for msg in self.link.pull():
+            
+            if msg.get('obj-id') == ACK and msg.get(STREAM) == self.name:
+                self.handle_ack(msg)
+            else:
+                out.append(msg)
+        
+        self.send()
+        
+        return out
+    
+    def poll(self, t=None):
+        """
+        Send again if acks have stopped coming, and send() whatever the
+        window has room for. Call this regularly even when there's
+        nothing to push.
+        """
+        
+        if t == None:
+            t = time.time()
+        
+        if self.sent and t - self.last_progress > self.retransmit_timeout:
+            self.last_progress = t
+            self.rewind()
+        
+        return self.send()
+    
+    def pending(self):
+        """
+        Number of messages not acked yet
+        """
+        
+        return len(self.unacked)
+    
+    def close(self):
+        
+        if self.journal != None:
+            self.journal.close()
+
+
+class reliable_receiver(object):
+    """
+    Pass on each message recieved on a stream once, in order, and ack
+    them. Works for any number of streams over any number of links. See
+    the module docstring.
+    """
+    
+    def __init__(self):
+        
+        # (epoch, last seq passed on), by stream name
+        self.delivered = {}
+        
+        # acks to send, as link -> {stream name: gap}
+        self.acks = {}
+        
+        # last seq passed on when we reported a gap after it, by stream
+        # name, so that the rest of a window that follows a lost message
+        # doesn't have the sender start again once for each of them
+        self.gaps = {}
+        
+        self.stats = {
+            'msgs': 0,
+            'duplicates': 0,
+            'gaps': 0,
+            'acks': 0,
+            }
+    
+    def filter(self, link, msgs):
+        """
+        Return msgs recieved from link without duplicates or messages
+        after a gap, and note the acks to send for them. Call ack()
+        once they've been dealt with.
+        """
+        
+        out = []
+        
+        delivered = self.delivered
+        acks = self.acks.setdefault(link, {})
+        
+        for msg in msgs:
+            
+            name = msg.pop(STREAM, None)
+            
+            if name == None:
+                out.append(msg)
+                continue
+            
+            seq = msg.pop(SEQ)
+            epoch = msg.pop(EPOCH, None)
+            
+            last = delivered.get(name)
+            
+            if last == None or last[0] != epoch:
+                # first we've seen of this stream, or of this run of it
+                last = seq - 1
+                self.gaps.pop(name, None)
+            else:
+                last = last[1]
+            
+            if seq <= last:
+                # sent again after we'd already got it; ack again in
+                # case the last ack was lost
+                self.stats['duplicates'] += 1
+                acks.setdefault(name, False)
+                continue
+            
+            if seq > last + 1:
+                # something before this went missing; wait for it
+                if self.gaps.get(name) != last:
+                    self.gaps[name] = last
+                    self.stats['gaps'] += 1
+                    acks[name] = True
+                else:
+                    acks.setdefault(name, False)
+                
+                continue
+            
+            delivered[name] = (epoch, seq)
+            acks.setdefault(name, False)
+            
+            self.stats['msgs'] += 1
+            out.append(msg)
+        
+        return out
+    
+    def ack(self, link=None):
+        """
+        Send the acks noted by filter() to link, or to every link if
+        None
+        """
+        
+        if link == None:
+            links = list(self.acks.keys())
+        else:
+            links = [link]
+        
+        for link in links:
+            
+            acks = self.acks.pop(link, None)
+            
+            if link.socket == None:
+                continue
+            
+            if not acks:
+                # acks queued behind a backlog go nowhere until the
+                # link's sent again, and the sender waits on them
+                if link.queued_bytes():
+                    link.send()
+                continue
+            
+            link.push_many([{'obj-id': ACK, STREAM: name,
+                EPOCH: self.delivered[name][0],
+                'seq': self.delivered[name][1], 'gap': gap} \
+                for name, gap in acks.items()])
+            
+            self.stats['acks'] += len(acks)
+    
+    def pull(self, link):
+        """
+        pull() from link, filter() what's recieved and ack() it right
+        away. Use filter() and ack() separately to ack only once the
+        messages have been dealt with.
+        """
+        
+        msgs = self.filter(link, link.pull())
+        
+        self.ack(link)
+        
+        return msgs
+    
+    def forget(self, name):
+        """
+        Stop tracking the stream called name
+        """
+        
+        self.delivered.pop(name, None)
+        self.gaps.pop(name, None)
@@ -0,0 +1,345 @@
+"""
+
+Requests and replies on top of link push() and pull().
+
+A requester wraps a link (usually an uplink) and tags every request it
+sends with a 'msg-id' unique to that requester. The other end answers
+with reply(), which tags the answer with a matching 'reply-to'. Each
+request gets a pending object back, which completes when its reply
+arrives or its timeout runs out, so any number of requests can be
+outstanding on one link at once, answered in any order.
+    
+    Example client:
+        
+        req = requester( uplink(addr='localhost',port=31415) )
+        
+        a = req.request( {'obj-id': 'pulse'} )
+        b = req.request( {'obj-id': 'ps'}, callback=show_ps )
+        
+        do_stuff(a.result(timeout=5))
+    
+    Example server:
+        
+        for r in readable:
+            
+            for msg in r.pull():
+                
+                if msg.get('obj-id') == 'pulse':
+                    reply(r, msg, {'obj-id': 'pulse-ok'})
+
+A requester only looks at the link when asked to, by poll(), wait() or
+pending.result(). Anything it pulls that isn't a reply is handed back
+from poll(), or kept in self.unsolicited by wait(). Code that pulls
+from the link itself should hand what it gets to requester.handle()
+instead.
+
+"""
+
+import time
+import heapq
+import select
+import itertools
+
+from transport import QUEUE_FULL, DOWNLINK_DEAD, queue_full
+
+
+class request_timeout(Exception):
+    pass
+
+
+class request_failed(Exception):
+    """
+    The request couldn't be sent
+    """
+    pass
+
+
+def reply(link, request, msg):
+    """
+    push() msg to link as the reply to request, a message recieved from
+    a requester
+    """
+    
+    msg = dict(msg)
+    msg['reply-to'] = request['msg-id']
+    
+    return link.push(msg)
+
+
+def _wait_readable(link, timeout):
+    """
+    Block until link may have something to pull() or timeout seconds
+    pass
+    """
+    
+    if link.socket == None:
+        # not connected; nothing to wait on
+        time.sleep(min(timeout, 0.05))
+    else:
+        # poll, unlike select, copes with file descriptors past
+        # FD_SETSIZE
+        p = select.poll()
+        p.register(link, select.POLLIN)
+        p.poll(max(0, int(timeout * 1000)))
+
+
+class pending(object):
+    """
+    A request waiting for its reply
+    """
+    
+    def __init__(self, requester, msg_id, timeout, callback=None):
+        
+        self.requester = requester
+        self.msg_id = msg_id
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        
+        self.reply = None
+        self.error = None
+        
+        self.callbacks = []
+        
+        if callback != None:
+            self.callbacks.append(callback)
+    
+    def done(self):
+        return self.reply != None or self.error != None
+    
+    def add_callback(self, fn):
+        """
+        Call fn(self) once there's a reply or the request has timed
+        out; right away if that's already happened
+        """
+        
+        if self.done():
+            fn(self)
+        else:
+            self.callbacks.append(fn)
+    
+    def result(self, timeout=None):
+        """
+        Return the reply, waiting up to timeout seconds for it (or until
+        the request times out, if None). Raises request_timeout if
+        there's no reply in time, and request_failed if the request
+        couldn't be sent.
+        """
+        
+        if not self.done():
+            self.requester.wait(self, timeout)
+        
+        if self.error != None:
+            raise self.error
+        
+        if self.reply == None:
+            raise request_timeout('no reply to %s yet' % self.msg_id)
+        
+        return self.reply
+    
+    def cancel(self):
+        """
+        Stop waiting for the reply, which will be ignored if it turns up
+        """
+        
+        self.requester.outstanding.pop(self.msg_id, None)
+    
+    def finish(self, reply=None, error=None):
+        
+        self.reply = reply
+        self.error = error
+        
+        callbacks = self.callbacks
+        self.callbacks = []
+        
+        for fn in callbacks:
+            fn(self)
+
+
+class requester(object):
+    """
+    Send requests over link and match up their replies. See the module
+    docstring.
+    """
+    
+    def __init__(self, link, timeout=10.0):
+        """
+        @link:
+            link to send requests over
+        
+        @timeout:
+            default number of seconds to wait for a reply
+        """
+        
+        self.link = link
+        self.timeout = timeout
+        
+        self.ids = itertools.count(1)
+        
+        # pending requests by msg-id
+        self.outstanding = {}
+        
+        # (deadline, msg-id) heap, for timing requests out
+        self.deadlines = []
+        
+        # messages wait() pulled that weren't replies
+        self.unsolicited = []
+        
+        self.stats = {
+            'requests': 0,
+            'replies': 0,
+            'timeouts': 0,
+            'failures': 0,
+            'stray_replies': 0,
+            }
+    
+    def request(self, msg, callback=None, timeout=None):
+        """
+        push() msg as a request and return a pending object for its
+        reply. If callback is given, it's called with the pending
+        object once the reply arrives or the request times out.
+        
+        If the link won't take the request, because its send queue is
+        full (whatever its queue policy) or it's dead, the pending
+        object fails with request_failed straight away, rather than
+        waiting out its timeout.
+        """
+        
+        if timeout == None:
+            timeout = self.timeout
+        
+        msg_id = next(self.ids)
+        
+        msg = dict(msg)
+        msg['msg-id'] = msg_id
+        
+        p = pending(self, msg_id, timeout, callback)
+        
+        self.stats['requests'] += 1
+        
+        try:
+            ret = self.link.push(msg)
+        except queue_full:
+            ret = QUEUE_FULL
+        
+        if ret is QUEUE_FULL or ret is DOWNLINK_DEAD:
+            
+            self.stats['failures'] += 1
+            
+            p.finish(error=request_failed('%s: link %s' % (msg_id,
+                'queue full' if ret is QUEUE_FULL else 'dead')))
+            
+            return p
+        
+        # nothing can answer before push() returns, so it's soon enough
+        # to start waiting now
+        self.outstanding[msg_id] = p
+        heapq.heappush(self.deadlines, (p.deadline, msg_id))
+        
+        return p
+    
+    def handle(self, msgs):
+        """
+        Complete the requests answered by msgs, and return the rest
+        """
+        
+        others = []
+        
+        for msg in msgs:
+            
+            msg_id = msg.get('reply-to')
+            
+            if msg_id == None:
+                others.append(msg)
+                continue
+            
+            p = self.outstanding.pop(msg_id, None)
+            
+            if p == None:
+                # timed out, cancelled, or not one of ours
+                self.stats['stray_replies'] += 1
+                continue
+            
+            self.stats['replies'] += 1
+            p.finish(reply=msg)
+        
+        self.expire()
+        
+        return others
+    
+    def expire(self, t=None):
+        """
+        Time out requests whose deadlines have passed
+        """
+        
+        if t == None:
+            t = time.time()
+        
+        deadlines = self.deadlines
+        
+        while deadlines and deadlines[0][0] <= t:
+            
+            deadline, msg_id = heapq.heappop(deadlines)
+            
+            p = self.outstanding.pop(msg_id, None)
+            
+            if p == None:
+                continue
+            
+            self.stats['timeouts'] += 1
+            p.finish(error=request_timeout('no reply to %s after %.3gs' % \
+                (msg_id, p.timeout)))
+    
+    def next_deadline(self):
+        """
+        Time the next outstanding request times out, or None
+        """
+        
+        deadlines = self.deadlines
+        
+        while deadlines and deadlines[0][1] not in self.outstanding:
+            heapq.heappop(deadlines)
+        
+        if deadlines:
+            return deadlines[0][0]
+        
+        return None
+    
+    def poll(self):
+        """
+        pull() from the link without waiting, completing any requests
+        answered, and return whatever else was recieved
+        """
+        
+        return self.handle(self.link.pull())
+    
+    def wait(self, p, timeout=None):
+        """
+        pull() from the link until pending request p is done, or timeout
+        seconds pass. Other messages recieved meanwhile are kept in
+        self.unsolicited.
+        """
+        
+        t = time.time()
+        
+        if timeout == None:
+            deadline = p.deadline
+        else:
+            deadline = min(p.deadline, t + timeout)
+        
+        while not p.done():
+            
+            # keep sending whatever's queued, including the request
+            self.link.send()
+            
+            self.unsolicited += self.poll()
+            
+            t = time.time()
+            
+            if p.done() or t >= deadline:
+                break
+            
+            _wait_readable(self.link, deadline - t)
+        
+        self.expire()
+        
+        return p.done()
@@ -0,0 +1,422 @@
+"""
+
+Spread a listener's work over several processes.
+
+A single listener parses every leaf's messages on one core. A
+sharded_listener instead forks a number of worker processes, each of
+which runs its own listener on the same locations with SO_REUSEPORT,
+so the kernel shares incoming connections out between them. Workers
+do the receiving, framing and JSON decoding for their own downlinks,
+and optionally run a handler on each message, and forward the results
+to the coordinating process over shared memory links (see
+shm_transport.py). Leaves don't need to know any of this is going on.
+
+Records forwarded to the coordinator are dictionaries:
+    
+    {'event': 'open', 'worker': i, 'link': name}
+        a leaf connected to worker i
+    
+    {'event': 'msg', 'worker': i, 'link': name, 'msg': obj}
+        a message from a leaf, or whatever the handler made of it
+    
+    {'event': 'close', 'worker': i, 'link': name}
+        a leaf went away
+
+where name is the downlink's name, unique within its worker.
+    
+    Example:
+        
+        shards = sharded_listener( [('0.0.0.0',31415)], workers=4 )
+        
+        while True:
+            
+            for rec in shards.select():
+                
+                if rec['event'] == 'msg':
+                    do_stuff(rec['msg'])
+                    
+                    shards.push(rec['worker'], rec['link'], reply)
+
+Workers only listen on TCP, so uplinks on the same machine connect
+over loopback rather than a Unix domain socket. A worker that dies is
+replaced on the next select(), and the leaves it had reconnect to the
+others.
+
+"""
+
+import os
+import time
+import errno
+import signal
+import socket
+import marshal
+import logging
+import multiprocessing
+
+from transport import listener, DOWNLINK_DEAD, SO_REUSEPORT
+from shm_transport import shm_link
+
+logger = logging.getLogger(__name__)
+
+
+class forward_link(shm_link):
+    """
+    shm_link between a worker and its coordinator. Both ends are the
+    same program, so records are marshalled, which costs much less than
+    JSON to decode again.
+    """
+    
+    dumps = staticmethod(marshal.dumps)
+    
+    # set once a record turns up cut short
+    truncated = False
+    
+    def loads(self, data):
+        
+        try:
+            return marshal.loads(data)
+        except EOFError:
+            # only a peer that died partway through writing a record
+            # leaves one like this, so there's nothing more to come
+            self.truncated = True
+            raise ValueError('truncated record')
+    
+    def unpack(self):
+        
+        objs = shm_link.unpack(self)
+        
+        if self.truncated and self.socket != None:
+            self.close()
+        
+        return objs
+
+
+class sharded_listener(object):
+    """
+    Coordinator of a set of worker processes sharing a set of listening
+    locations. See the module docstring.
+    """
+    
+    # bytes a worker lets pile up waiting for the coordinator before it
+    # stops reading from its downlinks, which pushes back on the leaves
+    forward_limit = 1<<22
+    
+    # seconds to give a worker to exit after its channel is closed
+    stop_timeout = 5.0
+    
+    def __init__(self, locations, workers=None, handler=None,
+                    queue_limits=None, name=None, capacity=1<<22):
+        """
+        @locations:
+            a list of (addr,port) tuples to bind to. Port 0 is replaced
+            with a free port, the same for every worker; see
+            self.locations.
+        
+        @workers:
+            number of worker processes, by default one per CPU
+        
+        @handler:
+            function called in the worker as handler(downlink, obj) for
+            every message recieved. Whatever it returns is forwarded in
+            place of the message, unless it's None, in which case
+            nothing is. It's free to push() replies to the downlink
+            itself. If None, messages are forwarded as they are.
+        
+        @queue_limits:
+            as for listener
+        
+        @name:
+            prefix of the names of the shared memory channels to the
+            workers. Must be unique on this machine. By default made up
+            from our pid.
+        
+        @capacity:
+            bytes in each direction of each channel
+        """
+        
+        if workers == None:
+            workers = multiprocessing.cpu_count()
+        
+        if name == None:
+            name = 'shard-%i' % os.getpid()
+        
+        self.name = name
+        self.pid = os.getpid()
+        self.handler = handler
+        self.queue_limits = queue_limits
+        self.capacity = capacity
+        
+        # Sockets bound, but not listening, to every location. They
+        # fix the port of any location given as port 0, and keep it
+        # ours while workers come and go. Only listening sockets get
+        # connections, so these never do.
+        self.reserved = []
+        self.locations = []
+        
+        for addr, port in locations:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind((addr, port))
+            self.reserved.append(sock)
+            self.locations.append((addr, sock.getsockname()[1]))
+        
+        # waits on the channels from the workers
+        self.listener = listener([], local=False)
+        
+        # (pid, forward_link) by worker number
+        self.workers = [None] * workers
+        
+        self.restarts = 0
+        
+        for i in range(workers):
+            self.spawn(i)
+    
+    def __del__(self):
+        
+        if self.workers:
+            self.close()
+    
+    def channel(self, i):
+        return '%s-%i' % (self.name, i)
+    
+    def spawn(self, i):
+        """
+        Start worker number i
+        """
+        
+        link = forward_link(self.channel(i), create=True,
+            capacity=self.capacity)
+        
+        pid = os.fork()
+        
+        if pid == 0:
+            
+            status = 1
+            
+            try:
+                status = self.work(i)
+            finally:
+                os._exit(status)
+        
+        link.worker = i
+        
+        self.listener.register(link)
+        self.workers[i] = (pid, link)
+    
+    def work(self, i):
+        """
+        Worker process body. Returns the exit status.
+        """
+        
+        # The coordinator's channels aren't ours to use, but closing
+        # them properly would close them for the coordinator too, so
+        # leave them be. Its sockets we can just let go of.
+        for sock in self.reserved:
+            sock.close()
+        
+        up = forward_link(self.channel(i))
+        
+        _listener = listener(self.locations, self.queue_limits,
+            local=False, reuse_port=True)
+        _listener.register(up)
+        
+        # downlinks by name
+        links = {}
+        
+        while up.socket != None:
+            
+            # don't outlive a coordinator that died without closing
+            if os.getppid() != self.pid:
+                break
+            
+            if up.queued_bytes() > self.forward_limit:
+                
+                # coordinator's behind; leave the leaves waiting
+                if not up.send():
+                    time.sleep(0.001)
+                
+                continue
+            
+            readable, new_downlinks = _listener.select(None, timeout=1)
+            
+            records = []
+            
+            for link in new_downlinks:
+                links[link.name] = link
+                records.append({'event': 'open', 'worker': i,
+                    'link': link.name})
+            
+            for link in readable:
+                
+                if link is up:
+                    self.command(up, links)
+                    continue
+                
+                status = link.recv()
+                
+                for obj in link.unpack():
+                    
+                    if self.handler != None:
+                        
+                        try:
+                            obj = self.handler(link, obj)
+                        except Exception:
+                            # one bad message mustn't take the worker,
+                            # and every leaf on it, down with it
+                            logger.exception('worker %i: handler failed '
+                                'on a message from %s', i, link.name)
+                            continue
+                        
+                        if obj == None:
+                            continue
+                    
+                    records.append({'event': 'msg', 'worker': i,
+                        'link': link.name, 'msg': obj})
+                
+                if status is DOWNLINK_DEAD or link.socket == None:
+                    
+                    if link.socket != None:
+                        link.close()
+                    
+                    links.pop(link.name, None)
+                    
+                    records.append({'event': 'close', 'worker': i,
+                        'link': link.name})
+            
+            if records:
+                up.push_many(records)
+        
+        # coordinator closed the channel
+        for link in list(links.values()):
+            link.close()
+        
+        _listener.close()
+        
+        return 0
+    
+    def command(self, up, links):
+        """
+        Carry out records sent to a worker by push() and drop()
+        """
+        
+        for rec in up.pull():
+            
+            try:
+                link = links.get(rec['link'])
+                
+                if link == None or link.socket == None:
+                    continue
+                
+                if rec['event'] == 'msg':
+                    link.push(rec['msg'])
+                
+                elif rec['event'] == 'close':
+                    link.close()
+            
+            except Exception:
+                logger.exception('worker: bad command %r', rec)
+    
+    def select(self, timeout=3):
+        """
+        Wait up to timeout seconds for records from the workers, and
+        return a list of them. Replaces any workers that have died.
+        """
+        
+        self.check_workers()
+        
+        readable, new_downlinks = self.listener.select(None, timeout)
+        
+        records = []
+        
+        for link in readable:
+            records += link.pull()
+        
+        return records
+    
+    def push(self, worker, name, msg):
+        """
+        Send msg to the downlink called name in the given worker
+        """
+        
+        link = self.workers[worker][1]
+        
+        return link.push({'event': 'msg', 'link': name, 'msg': msg})
+    
+    def drop(self, worker, name):
+        """
+        Close the downlink called name in the given worker
+        """
+        
+        link = self.workers[worker][1]
+        
+        return link.push({'event': 'close', 'link': name})
+    
+    def check_workers(self):
+        """
+        Replace any workers that have exited
+        """
+        
+        for i, (pid, link) in enumerate(self.workers):
+            
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                done = pid
+            
+            if done == 0:
+                continue
+            
+            if link.socket != None:
+                link.close()
+            
+            self.restarts += 1
+            self.spawn(i)
+    
+    def metrics(self):
+        """
+        Metrics of the coordinator's ends of the channels to the
+        workers, in the same form as listener.metrics()
+        """
+        
+        return self.listener.metrics()
+    
+    def close(self):
+        """
+        Stop every worker and release the locations
+        """
+        
+        for pid, link in self.workers:
+            if link.socket != None:
+                link.close()
+        
+        deadline = time.time() + self.stop_timeout
+        
+        for pid, link in self.workers:
+            
+            while True:
+                
+                try:
+                    done, status = os.waitpid(pid, os.WNOHANG)
+                except OSError:
+                    break
+                
+                if done:
+                    break
+                
+                if time.time() > deadline:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                
+                time.sleep(0.01)
+        
+        self.workers = []
+        
+        for sock in self.reserved:
+            sock.close()
+        
+        self.reserved = []
+        
+        self.listener.close()
@@ -0,0 +1,469 @@
+"""
+
+Shared memory links for high rate producers on the same machine as
+their consumer.
+
+A shm_link carries the same JSON messages as the links in transport.py,
+with the same push() and pull() methods, queue limits, corking and
+metrics, but instead of a socket it reads and writes a pair of single
+producer, single consumer ring buffers in a file in /dev/shm, mapped
+into both processes with mmap. Sending a message is a copy into shared
+memory rather than a system call.
+
+The only system call left is the wakeup. Each end has a FIFO that its
+peer writes a byte to when it adds data to a ring the reader had
+emptied, so a reader that's keeping up gets one wakeup per burst rather
+than one per message, and a reader that's falling behind gets none at
+all. The FIFO is what fileno() returns, so a shm_link can be handed to
+listener.register() or listener.select() alongside ordinary links.
+    
+    Example consumer:
+        
+        _listener = listener( [('localhost',31415)] )
+        
+        _listener.register( shm_link('leaf0', create=True) )
+        
+        while True:
+            
+            readable, new_downlinks = _listener.select()
+            
+            for r in readable:
+                do_stuff(r.pull())
+    
+    Example producer:
+        
+        up = shm_link('leaf0')
+        
+        up.push(msg)
+
+The consumer has to create the channel before the producer attaches to
+it. Either end may close(); the other sees end of file once it has read
+everything already written, just as with a socket.
+
+The rings rely on the writer's copy into the ring becoming visible to
+the other process before its update of the ring's head pointer does,
+which holds on x86 and other strongly ordered machines.
+
+"""
+
+import os
+import mmap
+import errno
+import socket
+import struct
+import tempfile
+
+from transport import link, DOWNLINK_DEAD
+
+# where channels are created, by name
+if os.path.isdir('/dev/shm'):
+    shm_dir = '/dev/shm'
+else:
+    shm_dir = tempfile.gettempdir()
+
+MAGIC = b'pbshm001'
+
+# header layout: magic, capacity, then each ring's head and tail
+# counters and each end's closed flag on cache lines of their own, so
+# the producer and consumer aren't fighting over the same line
+_header = struct.Struct('8sQ')
+_counter = struct.Struct('Q')
+
+_HEADER_SIZE = 4096
+
+_HEAD = (64, 192)
+_TAIL = (128, 256)
+_CLOSED = (320, 384)
+
+
+def shm_path(name):
+    """
+    Path of the file backing the channel called name
+    """
+    
+    return os.path.join(shm_dir, 'transport-%s.shm' % name)
+
+
+class ring(object):
+    """
+    A single producer, single consumer ring of bytes in a shared mapping.
+    head and tail count the total bytes ever written and read, so the
+    ring is empty when they're equal and full when they're capacity
+    apart, and only the writer moves head and only the reader moves
+    tail.
+    """
+    
+    def __init__(self, mm, view, index, capacity):
+        """
+        @mm:
+            the shared mmap
+        
+        @view:
+            memoryview of mm, or mm itself where mmap doesn't support
+            memoryview
+        
+        @index:
+            which of the channel's two rings this is
+        """
+        
+        self.mm = mm
+        self.view = view
+        self.capacity = capacity
+        
+        self.head_at = _HEAD[index]
+        self.tail_at = _TAIL[index]
+        self.base = _HEADER_SIZE + index * capacity
+        
+        # memoryview slices can be assigned directly; mmap slices need
+        # a string
+        self.need_bytes = view is mm
+    
+    def head(self):
+        return _counter.unpack_from(self.mm, self.head_at)[0]
+    
+    def tail(self):
+        return _counter.unpack_from(self.mm, self.tail_at)[0]
+    
+    def store(self, at, value):
+        """
+        Publish a new head or tail. struct.pack_into() zeroes its target
+        before filling it in, so the other process could see 0 in
+        between; a slice assignment of 8 bytes is a single copy.
+        """
+        
+        self.mm[at:at+8] = _counter.pack(value)
+        
+    def __len__(self):
+        return self.head() - self.tail()
+    
+    def write(self, data):
+        """
+        Copy as much of data as fits into the ring. Returns the number
+        of bytes written and whether the reader had emptied the ring
+        before we did, in which case it may be waiting for a wakeup.
+        """
+        
+        head = self.head()
+        
+        n = min(len(data), self.capacity - (head - self.tail()))
+        
+        if n <= 0:
+            return 0, False
+        
+        data = memoryview(data)[:n]
+        
+        start = head % self.capacity
+        first = min(n, self.capacity - start)
+        
+        a = self.base + start
+        
+        if self.need_bytes:
+            self.view[a:a+first] = data[:first].tobytes()
+            self.view[self.base:self.base+n-first] = data[first:].tobytes()
+        else:
+            self.view[a:a+first] = data[:first]
+            self.view[self.base:self.base+n-first] = data[first:]
+        
+        self.store(self.head_at, head + n)
+        
+        # read tail again after publishing, so that either we see the
+        # reader caught up with the old head, or it sees the new one
+        return n, self.tail() == head
+    
+    def read_into(self, buf):
+        """
+        Copy as much as is available and fits into buf, a bytearray.
+        Returns the number of bytes read.
+        """
+        
+        tail = self.tail()
+        
+        n = min(len(buf), self.head() - tail)
+        
+        if n <= 0:
+            return 0
+        
+        start = tail % self.capacity
+        first = min(n, self.capacity - start)
+        
+        a = self.base + start
+        out = memoryview(buf)
+        
+        out[:first] = self.view[a:a+first]
+        out[first:n] = self.view[self.base:self.base+n-first]
+        
+        self.store(self.tail_at, tail + n)
+        
+        return n
+
+
+class shm_socket(object):
+    """
+    One end of a channel, with just enough of the socket interface for
+    link: send(), recv_into(), fileno(), shutdown() and close(). Like a
+    nonblocking socket, send() and recv_into() raise socket.error with
+    EWOULDBLOCK rather than wait, and recv_into() returns 0 at end of
+    file.
+    """
+    
+    def __init__(self, name, create=False, capacity=1<<22):
+        """
+        @name:
+            channel name; see shm_path()
+        
+        @create:
+            If True, create the channel, replacing any left over from
+            before, and be the consumer end. Otherwise attach to an
+            existing channel as the producer end.
+        
+        @capacity:
+            bytes in each direction's ring, when creating
+        """
+        
+        self.path = shm_path(name)
+        self.owner = create
+        
+        # the creator reads ring 0 and writes ring 1; the other end the
+        # reverse
+        side = 0 if create else 1
+        
+        self.side = side
+        
+        if create:
+            
+            for path in self.files():
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            
+            page = mmap.PAGESIZE
+            capacity = (capacity + page - 1) // page * page
+            
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                0o600)
+            
+            try:
+                os.ftruncate(fd, _HEADER_SIZE + 2*capacity)
+                self.mm = mmap.mmap(fd, _HEADER_SIZE + 2*capacity)
+            finally:
+                os.close(fd)
+            
+            self.mm[:_header.size] = _header.pack(MAGIC, capacity)
+            
+            os.mkfifo(self.path + '.wake0', 0o600)
+            os.mkfifo(self.path + '.wake1', 0o600)
+        
+        else:
+            fd = os.open(self.path, os.O_RDWR)
+            
+            try:
+                self.mm = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+            
+            magic, capacity = _header.unpack_from(self.mm, 0)
+            
+            if magic != MAGIC:
+                self.mm.close()
+                raise ValueError('%s is not a shm channel' % self.path)
+        
+        try:
+            view = memoryview(self.mm)
+        except TypeError:
+            view = self.mm
+        
+        self.rx = ring(self.mm, view, side, capacity)
+        self.tx = ring(self.mm, view, 1 - side, capacity)
+        
+        # Opening both FIFOs read-write means neither open() waits for
+        # the other end, and neither ever sees end of file on its FIFO
+        # and becomes permanently readable when the peer goes away
+        flags = os.O_RDWR | os.O_NONBLOCK
+        
+        self.wake_in = os.open('%s.wake%i' % (self.path, side), flags)
+        self.wake_out = os.open('%s.wake%i' % (self.path, 1-side), flags)
+    
+    def files(self):
+        return [self.path, self.path + '.wake0', self.path + '.wake1']
+    
+    def wake(self):
+        """
+        Wake our peer up, if it isn't already due to wake up
+        """
+        
+        try:
+            os.write(self.wake_out, b'!')
+        except OSError as e:
+            # a full FIFO already has a wakeup waiting in it
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+    
+    def peer_closed(self):
+        return self.mm[_CLOSED[1-self.side]:_CLOSED[1-self.side]+1] != \
+            b'\x00'
+    
+    def send(self, data):
+        
+        if self.mm == None:
+            raise socket.error(errno.EBADF, 'channel closed')
+        
+        if self.peer_closed():
+            raise socket.error(errno.EPIPE, 'peer closed the channel')
+        
+        n, was_empty = self.tx.write(data)
+        
+        if n == 0 and len(data):
+            raise socket.error(errno.EWOULDBLOCK, 'ring full')
+        
+        if was_empty:
+            self.wake()
+        
+        return n
+    
+    def recv_into(self, buf):
+        
+        if self.mm == None:
+            raise socket.error(errno.EBADF, 'channel closed')
+        
+        # clear wakeups first, so anything written after this that
+        # finds the ring empty wakes us again
+        try:
+            os.read(self.wake_in, 4096)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        
+        n = self.rx.read_into(buf)
+        
+        if n:
+            return n
+        
+        # check for closing after the ring, since the peer writes
+        # everything before it closes
+        if self.peer_closed() and not len(self.rx):
+            return 0
+        
+        raise socket.error(errno.EWOULDBLOCK, 'ring empty')
+    
+    def wake_self(self):
+        """
+        Make sure select() wakes us again, for when we stop reading with
+        data still in the ring, which wouldn't otherwise wake us
+        """
+        
+        try:
+            os.write(self.wake_in, b'!')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        
+    def fileno(self):
+        return self.wake_in
+    
+    def getpeername(self):
+        return self.path
+    
+    def shutdown(self, how):
+        pass
+    
+    def close(self):
+        
+        if self.mm == None:
+            return
+        
+        self.mm[_CLOSED[self.side]:_CLOSED[self.side]+1] = b'\x01'
+        self.wake()
+        
+        os.close(self.wake_in)
+        os.close(self.wake_out)
+        
+        # the mapping can't be closed while a memoryview of it exists
+        if self.rx.view is not self.mm:
+            self.rx.view.release()
+            
+        self.rx = self.tx = None
+        
+        self.mm.close()
+        self.mm = None
+        
+        # the consumer created the files, so it cleans them up
+        if self.owner:
+            for path in self.files():
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+
+class shm_link(link):
+    """
+    A link over a shared memory channel instead of a socket. See the
+    module docstring.
+    
+    Both ends are shm_links, so length prefixed framing is used from the
+    start without a HELLO exchange.
+    """
+    
+    def __init__(self, name, create=False, capacity=1<<22):
+        """
+        @name, @create, @capacity:
+            as for shm_socket
+        """
+        
+        link.__init__(self)
+        
+        self.socket = shm_socket(name, create, capacity)
+        self.name = 'shm:%s' % name
+        
+        self.use_features({'framing': 'length'})
+    
+    def recv(self):
+        
+        if self.socket == None:
+            # closed already
+            return DOWNLINK_DEAD
+        
+        nbytes = 0
+        
+        while nbytes < self.recv_budget:
+            
+            try:
+                ret = self.recv_once()
+                nbytes += ret
+                
+                if ret == 0:
+                    self.close()
+                    break
+            
+            except socket.error as e:
+                
+                if not self.would_block(e):
+                    self.log(e.args)
+                    nbytes = DOWNLINK_DEAD
+                
+                break
+                
+        else:
+            # out of budget with data left over
+            self.socket.wake_self()
+        
+        return nbytes
+    
+    def send(self):
+        
+        if self.socket == None:
+            return DOWNLINK_DEAD
+        
+        try:
+            nbytes = self.transmit()
+        except socket.error as e:
+            
+            if self.would_block(e):
+                # ring's full; try again on the next send()
+                nbytes = 0
+            else:
+                self.log(e.args)
+                nbytes = DOWNLINK_DEAD
+        
+        return nbytes
@@ -0,0 +1,485 @@
+"""
+
+Outbound queues that spill to disk once memory is full.
+
+A spill_queue holds the bytes a socket hasn't been able to send yet. Up
+to mem_limit bytes are kept in memory, and past that, messages are
+appended to a series of segment files on disk instead, so a leaf whose
+upstream is down for hours keeps everything it produced without its
+memory growing. Once anything has spilled, every later message goes to
+disk too, so that the queue always drains in the order it was filled:
+memory first, then the segments oldest first, each loaded back into
+memory whole once there's room for it.
+    
+    Example:
+        
+        q = spill_queue('leaf0-uplink')
+        
+        q.append(msg)
+        
+        while q:
+            data = q.peek()
+            q.consume( sock.send(data) )
+        
+        # after reconnecting
+        q.restart()
+
+Disk usage is capped at disk_limit bytes. Past that the oldest segment
+on disk is thrown away to make room, and counted in stats['dropped'],
+so a queue that can never drain loses its oldest data rather than
+filling the disk.
+
+After an outage the backlog may be far bigger than what the other end
+is used to getting, so loading segments back is rate limited to
+replay_rate bytes per second.
+
+Segments are written as a sequence of length prefixed records, one per
+message, and flushed as they're written, so they survive a restart of
+the process: a new spill_queue with the same name picks up where the
+old one left off. A record cut short by a crash is thrown away when its
+segment is loaded, rather than sent as half a message.
+
+The queue keeps track of where each message begins and ends. A message
+that's only been partly sent when the connection drops is sent again
+whole on the next one, after restart(), so the new peer never sees the
+tail of a message without its head.
+
+"""
+
+import os
+import time
+import errno
+import struct
+import tempfile
+from collections import deque
+
+# where segments are kept, by queue name
+spill_dir = tempfile.gettempdir()
+
+_record = struct.Struct('!I')
+
+
+def spill_prefix(name, directory=None):
+    """
+    Path prefix of the segment files of the spill_queue called name
+    """
+    
+    if directory == None:
+        directory = spill_dir
+    
+    return os.path.join(directory, 'transport-%s.spill.' % name)
+
+
+class spill_queue(object):
+    """
+    Byte queue kept in memory up to a limit and on disk past it. See the
+    module docstring.
+    """
+    
+    def __init__(self, name, directory=None, mem_limit=int(1e5),
+                    segment_size=1<<16, disk_limit=1<<30,
+                    replay_rate=1<<20):
+        """
+        @name:
+            name of the queue, which its segment files are named after.
+            Must be unique on this machine; see spill_prefix().
+        
+        @directory:
+            where to keep the segments, spill_dir by default
+        
+        @mem_limit:
+            bytes to keep in memory before spilling to disk
+        
+        @segment_size:
+            bytes of messages per segment file. A segment is loaded back
+            into memory all at once, so this should be well below
+            mem_limit.
+        
+        @disk_limit:
+            bytes of segments to keep before dropping the oldest
+        
+        @replay_rate:
+            bytes per second to load back from disk, or None for no
+            limit
+        """
+        
+        self.prefix = spill_prefix(name, directory)
+        
+        self.mem_limit = mem_limit
+        self.segment_size = segment_size
+        self.disk_limit = disk_limit
+        self.replay_rate = replay_rate
+        
+        # unsent bytes in memory and the cursor of the first of them
+        self.buf = bytearray()
+        self.cursor = 0
+        
+        # length of every message in memory not yet sent in full, and
+        # how much of the first of them has been sent. The bytes of a
+        # partly sent message are kept until it's all been sent, in
+        # case it needs sending again.
+        self.records = deque()
+        self.record_pos = 0
+        
+        # sequence numbers of the segments on disk, oldest first. The
+        # last is the one being appended to, through self.out.
+        self.segments = []
+        self.out = None
+        self.out_size = 0
+        
+        # bytes in all segments
+        self.disk_usage = 0
+        
+        # replay rate limiting
+        self.tokens = float(segment_size)
+        self.refilled = time.time()
+        
+        self.stats = {
+            'spilled_msgs': 0,
+            'spilled_bytes': 0,
+            'replayed_bytes': 0,
+            'segments': 0,
+            'dropped': 0,
+            'dropped_bytes': 0,
+            'truncated': 0,
+            }
+        
+        self.recover()
+    
+    def __len__(self):
+        return len(self.buf) - self.cursor + self.disk_usage
+    
+    def __nonzero__(self):
+        return len(self) > 0
+    
+    __bool__ = __nonzero__
+    
+    def path(self, seq):
+        return '%s%08i' % (self.prefix, seq)
+    
+    def recover(self):
+        """
+        Pick up segments left behind by an earlier queue of the same name
+        """
+        
+        directory, base = os.path.split(self.prefix)
+        
+        for fname in os.listdir(directory):
+            
+            if not fname.startswith(base):
+                continue
+            
+            try:
+                seq = int(fname[len(base):])
+            except ValueError:
+                continue
+            
+            self.segments.append(seq)
+            self.disk_usage += os.path.getsize(self.path(seq))
+        
+        self.segments.sort()
+    
+    def spilling(self):
+        """
+        True while anything's on disk, so new messages have to go there
+        too to keep their order
+        """
+        
+        return len(self.segments) > 0
+    
+    def mem_usage(self):
+        return len(self.buf) - self.cursor
+    
+    def append(self, data):
+        """
+        Queue the bytes of one message
+        """
+        
+        if not self.spilling() and \
+            self.mem_usage() + len(data) <= self.mem_limit:
+            
+            self.buf += data
+            self.records.append(len(data))
+            return
+        
+        self.spill(data)
+    
+    def spill(self, data):
+        """
+        Append one message to the newest segment, starting a new one if
+        it's full
+        """
+        
+        if self.out == None or self.out_size >= self.segment_size:
+            self.roll()
+        
+        self.out.write(_record.pack(len(data)))
+        self.out.write(data)
+        self.out.flush()
+        
+        nbytes = _record.size + len(data)
+        
+        self.out_size += nbytes
+        self.disk_usage += nbytes
+        
+        self.stats['spilled_msgs'] += 1
+        self.stats['spilled_bytes'] += len(data)
+        
+        while self.disk_usage > self.disk_limit and len(self.segments) > 1:
+            self.drop_oldest()
+    
+    def roll(self):
+        """
+        Start a new segment
+        """
+        
+        if self.out != None:
+            self.out.close()
+        
+        if self.segments:
+            seq = self.segments[-1] + 1
+        else:
+            seq = 0
+        
+        self.out = open(self.path(seq), 'ab')
+        self.out_size = 0
+        
+        self.segments.append(seq)
+        self.stats['segments'] += 1
+    
+    def close_segment(self, seq):
+        """
+        Stop appending to segment seq, if we are
+        """
+        
+        if self.out != None and seq == self.segments[-1]:
+            self.out.close()
+            self.out = None
+            self.out_size = 0
+    
+    def remove(self, seq):
+        """
+        Forget the oldest segment, seq, and delete its file. Returns its
+        size.
+        """
+        
+        self.close_segment(seq)
+        self.segments.pop(0)
+        
+        path = self.path(seq)
+        
+        try:
+            nbytes = os.path.getsize(path)
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            nbytes = 0
+        
+        self.disk_usage -= nbytes
+        
+        return nbytes
+    
+    def drop_oldest(self):
+        """
+        Throw away the oldest segment to stay under disk_limit
+        """
+        
+        self.stats['dropped'] += 1
+        self.stats['dropped_bytes'] += self.remove(self.segments[0])
+    
+    def refill(self):
+        """
+        Load segments back into memory while there's room for them and
+        the replay rate allows. Returns the number of bytes loaded.
+        """
+        
+        loaded = 0
+        
+        while self.segments:
+            
+            seq = self.segments[0]
+            path = self.path(seq)
+            
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            
+            # always let a segment in if memory's empty, however big
+            if self.mem_usage() and \
+                self.mem_usage() + size > self.mem_limit:
+                break
+            
+            if self.replay_rate != None:
+                
+                t = time.time()
+                burst = max(self.segment_size, self.replay_rate)
+                
+                self.tokens = min(self.tokens + \
+                    (t - self.refilled) * self.replay_rate, burst)
+                self.refilled = t
+                
+                # a segment bigger than a burst waits for a full one,
+                # and leaves the tokens in debt
+                if self.tokens < min(size, burst):
+                    break
+                
+                self.tokens -= size
+            
+            # don't append to a segment while we read it
+            self.close_segment(seq)
+            
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                data = b''
+            
+            self.remove(seq)
+            
+            # reclaim what's been sent before growing the buffer
+            self.compact()
+            
+            nbytes = self.unpack(data)
+            
+            loaded += nbytes
+            self.stats['replayed_bytes'] += nbytes
+        
+        return loaded
+    
+    def unpack(self, data):
+        """
+        Append the records in a segment's data to the buffer. Returns
+        the number of bytes appended.
+        """
+        
+        i = 0
+        nbytes = 0
+        
+        while i + _record.size <= len(data):
+            
+            size, = _record.unpack_from(data, i)
+            i += _record.size
+            
+            if i + size > len(data):
+                break
+            
+            self.buf += data[i:i+size]
+            self.records.append(size)
+            nbytes += size
+            i += size
+        
+        if i < len(data):
+            # cut short by a crash
+            self.stats['truncated'] += 1
+        
+        return nbytes
+    
+    def peek(self, max_bytes=1<<16):
+        """
+        Return up to max_bytes of the bytes in memory waiting to be
+        sent, loading more from disk first if there's room
+        """
+        
+        if self.segments:
+            self.refill()
+        
+        return bytes(self.buf[self.cursor:self.cursor+max_bytes])
+    
+    def consume(self, nbytes):
+        """
+        Drop the first nbytes of the queue, which have been sent
+        """
+        
+        self.cursor += nbytes
+        
+        # the messages that finishes sending, and how far into the next
+        # one it gets
+        pos = self.record_pos + nbytes
+        records = self.records
+        
+        while records and pos >= records[0]:
+            pos -= records.popleft()
+        
+        self.record_pos = pos
+        
+        # don't let sent bytes pile up at the front
+        if self.cursor >= len(self.buf):
+            del self.buf[:]
+            self.cursor = 0
+            self.record_pos = 0
+        
+        elif self.cursor > self.mem_limit:
+            self.compact()
+    
+    def compact(self):
+        """
+        Drop the bytes of messages that have been sent in full from the
+        front of the buffer
+        """
+        
+        start = self.cursor - self.record_pos
+        
+        if start:
+            del self.buf[:start]
+            self.cursor -= start
+    
+    def restart(self):
+        """
+        Send the message that was being sent again from its beginning,
+        for a new connection that never saw the rest of it
+        """
+        
+        self.cursor -= self.record_pos
+        self.record_pos = 0
+    
+    def close(self):
+        """
+        Close the segment being appended to. Whatever's on disk stays
+        for the next spill_queue of the same name; whatever's in memory
+        is lost unless it's spilled first with flush_to_disk().
+        """
+        
+        if self.out != None:
+            self.out.close()
+            self.out = None
+    
+    def flush_to_disk(self):
+        """
+        Move every message in memory onto disk, ahead of what's there
+        already, so it survives the process exiting. A message that's
+        been partly sent is kept whole, to be sent again in full.
+        """
+        
+        if not self.records:
+            return
+        
+        i = self.cursor - self.record_pos
+        
+        # a segment numbered before every other one
+        if self.segments:
+            seq = self.segments[0] - 1
+        else:
+            seq = 0
+        
+        nbytes = 0
+        
+        with open(self.path(seq), 'wb') as f:
+            
+            for size in self.records:
+                f.write(_record.pack(size))
+                f.write(self.buf[i:i+size])
+                
+                i += size
+                nbytes += _record.size + size
+        
+        del self.buf[:]
+        self.cursor = 0
+        self.records.clear()
+        self.record_pos = 0
+        
+        self.segments.insert(0, seq)
+        self.disk_usage += nbytes
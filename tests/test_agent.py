@@ -0,0 +1,142 @@
+import os
+import sys
+import errno
+import socket
+import tempfile
+import threading
+import subprocess
+
+from transport import downlink
+from rpc import requester
+from dispatch import dispatcher
+from agent import command_agent, agent_client, agent_error, answer, \
+    REQUEST, REPLY
+
+
+def link_pair():
+    
+    a, b = socket.socketpair()
+    
+    return downlink(a), downlink(b)
+
+
+def ask(agent, **msg):
+    
+    msg['obj-id'] = REQUEST
+    msg['msg-id'] = 1
+    
+    return agent.handle(None, msg)
+
+
+def test_kill_only_our_own():
+    
+    agent = command_agent()
+    
+    for pid in (1, 0, -1):
+        reply = ask(agent, op='kill', pid=pid, signal=0)
+        assert not reply['ok'] and reply['errno'] == errno.EPERM
+    
+    child = subprocess.Popen([sys.executable, '-c',
+        'import time; time.sleep(30)'])
+    
+    try:
+        assert ask(agent, op='kill', pid=child.pid)['ok']
+        assert child.wait() != 0
+    finally:
+        if child.poll() == None:
+            child.kill()
+            child.wait()
+
+
+def test_stat_only_under_roots():
+    
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, 'log')
+    
+    try:
+        open(path, 'w').close()
+        
+        agent = command_agent(roots=[d])
+        
+        assert ask(agent, op='stat', path=path)['ok']
+        
+        for other in ('/etc/passwd', os.path.join(d, '..', 'elsewhere')):
+            reply = ask(agent, op='stat', path=other)
+            assert not reply['ok'] and reply['errno'] == errno.EACCES
+    
+    finally:
+        os.unlink(path)
+        os.rmdir(d)
+
+
+def test_request_does_not_wait():
+    
+    node_link, leaf_link = link_pair()
+    
+    leaf = dispatcher()
+    command_agent().register(leaf)
+    
+    node = dispatcher()
+    client = agent_client(requester(node_link), dispatch=node)
+    node[REPLY] = client.handle
+    
+    answers = []
+    
+    p = client.request('ps', callback=answers.append, pid=os.getpid())
+    
+    # nothing's been answered, and nothing waited for an answer
+    assert not p.done() and answers == []
+    
+    for i in range(100):
+        
+        leaf.dispatch_links([leaf_link])
+        node.dispatch_links([node_link])
+        
+        if answers:
+            break
+    
+    assert answers == [p]
+    assert answer(p)['running']
+
+
+def test_call_dispatches_other_messages():
+    
+    node_link, leaf_link = link_pair()
+    
+    node = dispatcher()
+    client = agent_client(requester(node_link), dispatch=node)
+    
+    hellos = []
+    node['hello'] = lambda link, msg: hellos.append(msg)
+    
+    leaf = dispatcher()
+    command_agent().register(leaf)
+    
+    # the leaf has its say before it gets round to answering
+    leaf_link.push({'obj-id': 'hello'})
+    
+    stop = threading.Event()
+    
+    def serve():
+        while not stop.is_set():
+            leaf.dispatch_links([leaf_link])
+            stop.wait(0.01)
+    
+    t = threading.Thread(target=serve)
+    t.start()
+    
+    try:
+        assert client.call('ps', pid=os.getpid())['running']
+        
+        try:
+            client.call('kill', pid=1, signal=0)
+            assert False
+        except agent_error as e:
+            assert e.errno == errno.EPERM
+    
+    finally:
+        stop.set()
+        t.join()
+    
+    assert hellos == [{'obj-id': 'hello'}]
+    assert client.requests.unsolicited == []
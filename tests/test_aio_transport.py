@@ -0,0 +1,53 @@
+import json
+import asyncio
+import datetime
+
+from aio_transport import async_uplink
+
+
+class broken_writer(object):
+    """
+    Stands in for a StreamWriter whose connection has just dropped
+    """
+    
+    def __init__(self):
+        self.written = []
+    
+    def write(self, data):
+        self.written.append(data)
+    
+    async def drain(self):
+        raise ConnectionResetError(104, 'Connection reset by peer')
+    
+    def close(self):
+        pass
+
+
+class dated_uplink(async_uplink):
+    
+    dumps = staticmethod(lambda msg: json.dumps(msg, default=str))
+    
+    reconnects = 0
+    
+    def reconnect(self):
+        self.reconnects += 1
+
+
+def test_push_requeues_after_failed_drain():
+    
+    up = dated_uplink('127.0.0.1', 1, connect_msg={'obj-id': 'connect',
+        'at': datetime.datetime(2020, 1, 2)})
+    
+    # the link's own dumps serializes everything
+    assert b'2020-01-02' in up.connect_msg
+    
+    up.writer = broken_writer()
+    up.pending.append(b'{"n": 2}')
+    
+    asyncio.run(up.push({'n': 1, 'at': datetime.datetime(2020, 1, 2)}))
+    
+    assert up.reconnects == 1
+    assert len(up.pending) == 2
+    assert json.loads(up.pending[0].decode()) == {'n': 1,
+        'at': '2020-01-02 00:00:00'}
+    assert up.pending[1] == b'{"n": 2}'
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import json
+import socket
+
+from transport import downlink, DOWNLINK_DEAD
+from channels import channel_mux, split_utf8
+
+
+def link_pair(sndbuf=4096):
+    
+    a, b = socket.socketpair()
+    
+    for s in (a, b):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sndbuf)
+    
+    return downlink(a), downlink(b)
+
+
+def utf8_dumps(msg):
+    return json.dumps(msg, ensure_ascii=False)
+
+
+def handed_to_link(link):
+    return link.stats['bytes_out'] + link.queued_bytes()
+
+
+def test_split_utf8():
+    
+    data = u'aé中€x'.encode('utf-8') * 50
+    
+    for size in (4, 5, 7, 64):
+        
+        parts = split_utf8(data, size)
+        
+        assert b''.join(parts) == data
+        assert max(len(p) for p in parts) <= size
+        
+        for p in parts:
+            p.decode('utf-8')
+
+
+def test_stalled_peer():
+    
+    a, b = link_pair()
+    
+    # non-ASCII text goes out as more bytes than characters
+    a.dumps = b.dumps = utf8_dumps
+    
+    left, right = channel_mux(a), channel_mux(b)
+    
+    window = 1 << 16
+    
+    msgs = [{'n': i, 'text': u'é中' * 5000} for i in range(20)]
+    
+    # both ends push bulk at each other while neither pulls, so both
+    # links end up with a backlog
+    for mux in (left, right):
+        
+        bulk = mux.channel('bulk', priority=10, window=window)
+        
+        for msg in msgs:
+            assert bulk.push(msg) is not DOWNLINK_DEAD
+    
+    for mux in (left, right):
+        
+        for i in range(10):
+            assert mux.send() is not DOWNLINK_DEAD
+        
+        assert mux.link.queued_bytes() > 0
+        
+        # nothing's been consumed, so nothing beyond the window (and
+        # the one unit always let through) has reached the link
+        assert handed_to_link(mux.link) <= window + 2 * mux.frag_size
+        
+        # and what's counted against the window is what was sent, give
+        # or take the tags on each unit
+        bulk = mux.channel('bulk')
+        units = bulk.stats['fragments_out']
+        
+        assert bulk.in_flight <= handed_to_link(mux.link) <= \
+            bulk.in_flight + 150 * units
+        
+        mux.channel('control').push({'pulse': 1})
+    
+    got = {'left': [], 'right': []}
+    
+    for i in range(2000):
+        
+        got['left'] += left.pull()
+        got['right'] += right.pull()
+        
+        if len(got['left']) == len(got['right']) == len(msgs) + 1:
+            break
+    
+    for name in ('left', 'right'):
+        
+        assert ('control', {'pulse': 1}) in got[name]
+        assert [m for ch, m in got[name] if ch == 'bulk'] == msgs
@@ -0,0 +1,96 @@
+import time
+import select
+
+from transport import listener
+from dispatch import dispatcher
+
+
+class sink(object):
+    """
+    Stands in for a link, keeping whatever's pushed to it
+    """
+    
+    def __init__(self):
+        self.pushed = []
+    
+    def push(self, msg):
+        self.pushed.append(msg)
+
+
+def slow(link, msg):
+    time.sleep(0.2)
+    return {'obj-id': 'done', 'n': msg['n']}
+
+
+def test_finished_handler_wakes_listener():
+    
+    _listener = listener([('127.0.0.1', 0)])
+    
+    d = dispatcher()
+    d.register('slow', slow, offload=True)
+    d.attach(_listener)
+    
+    link = sink()
+    
+    try:
+        d.dispatch([(link, {'obj-id': 'slow', 'n': 1})])
+        
+        # no need to poll while it runs
+        assert d.timeout(3) == 3
+        
+        t = time.time()
+        
+        readable, new_downlinks = _listener.select(timeout=d.timeout(3))
+        
+        assert time.time() - t < 2
+        assert readable == [d]
+        
+        assert d.dispatch_links(readable) == []
+        assert d.collect() == 0
+        
+        assert link.pushed == [{'obj-id': 'done', 'n': 1}]
+        
+        # and the pipe's empty again
+        assert _listener.select(timeout=0) == ([], [])
+    
+    finally:
+        d.close()
+        _listener.close()
+
+
+def test_finished_handler_wakes_select():
+    
+    d = dispatcher()
+    d.register('slow', slow, offload=True)
+    
+    link = sink()
+    
+    try:
+        d.dispatch([(link, {'obj-id': 'slow', 'n': 1}),
+            (link, {'obj-id': 'slow', 'n': 2})])
+        
+        deadline = time.time() + 2
+        
+        while d.collect() and time.time() < deadline:
+            select.select([d], [], [], d.timeout(3))
+        
+        assert sorted(m['n'] for m in link.pushed) == [1, 2]
+    
+    finally:
+        d.close()
+
+
+def test_unwatched_dispatcher_still_polls():
+    
+    d = dispatcher()
+    d.register('slow', slow, offload=True)
+    
+    try:
+        d.dispatch([(sink(), {'obj-id': 'slow', 'n': 1})])
+        
+        assert d.timeout(3) < 3
+    
+    finally:
+        d.close()
+    
+    assert d.running == 0
@@ -0,0 +1,123 @@
+import os
+import time
+import shutil
+import tempfile
+
+from transport import listener, uplink
+from rpc import requester
+from utils import process_handle, command_result
+from node import host_machine, client, server
+
+
+def make_client(root, name='c0'):
+    
+    host = host_machine('here', 'localhost', 22, 'nobody')
+    
+    c = client(name, root, host, invocation='true')
+    c.pid = 4242
+    
+    return c
+
+
+def finished_ps(returncode, stdout=b'', timed_out=False):
+    
+    handle = process_handle(['ps'])
+    handle.finish(command_result(['ps'], returncode, stdout, b'', 0.1,
+        timed_out))
+    
+    return handle
+
+
+def test_running_only_decides_on_a_clear_answer():
+    
+    root = tempfile.mkdtemp()
+    
+    try:
+        c = make_client(root)
+        
+        cases = [
+            (finished_ps(0, b'  PID TTY\n 4242 ?\n'), True),
+            (finished_ps(1, b'  PID TTY\n'), False),
+            (finished_ps(255), 'unknown'),
+            (finished_ps(None, timed_out=True), 'unknown'),
+            (finished_ps(0, b''), 'unknown'),
+            ]
+        
+        for ps, expected in cases:
+            c.ps = ps
+            assert c.running() == expected
+        
+        c.ps = process_handle(['ps'])
+        assert c.running() == None
+    
+    finally:
+        shutil.rmtree(root)
+
+
+def test_unknown_doesnt_restart():
+    
+    root = tempfile.mkdtemp()
+    
+    try:
+        s = server('node', root, None)
+        
+        started = []
+        
+        for name, ps in (('up', finished_ps(255)),
+                ('down', finished_ps(1))):
+            
+            c = make_client(root, name)
+            c.start = lambda name=name: started.append(name)
+            c.ps = ps
+            
+            s.clients[name] = c
+            s.checking[name] = c
+        
+        s.check_clients()
+        
+        assert started == ['down']
+        assert 'up' in s.heartbeats and 'down' in s.heartbeats
+        assert s.checking == {}
+    
+    finally:
+        shutil.rmtree(root)
+
+
+def test_pulses_reach_the_dispatcher():
+    
+    root = tempfile.mkdtemp()
+    
+    s = server('node', root, None, locations=[('127.0.0.1', 0)],
+        leaf=False)
+    s.clients['c0'] = make_client(root)
+    
+    _listener = listener(s.locations)
+    s.dispatch.attach(_listener)
+    
+    up = uplink(*_listener.bound_sockets[0].getsockname())
+    
+    try:
+        req = requester(up)
+        p = req.request({'obj-id': 'pulse', 'clientname': 'c0',
+            'pid': 77})
+        
+        deadline = time.time() + 5
+        
+        while not p.done() and time.time() < deadline:
+            up.send()
+            s.serve_once(_listener, 0.05)
+            req.poll()
+        
+        assert p.result()['obj-id'] == 'pulse-ok'
+        
+        c = s.clients['c0']
+        
+        assert c.pid == 77 and c.pulse != None
+        assert c.agent != None
+        assert 'c0' in s.heartbeats
+    
+    finally:
+        up.close()
+        _listener.close()
+        s.dispatch.close()
+        shutil.rmtree(root)
@@ -0,0 +1,52 @@
+import socket
+
+from transport import downlink
+from reliable import reliable_sender, reliable_receiver
+
+
+def link_pair(sndbuf=4096):
+    
+    a, b = socket.socketpair()
+    
+    for s in (a, b):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sndbuf)
+    
+    return downlink(a), downlink(b)
+
+
+def test_send_and_ack_behind_backlog():
+    
+    a, b = link_pair()
+    
+    tx = reliable_sender(a, 'backlog', window=8, persist=False)
+    rx = reliable_receiver()
+    
+    # leave both links with more queued than the socket takes, so
+    # everything after goes out behind an unsent backlog
+    a.push({'pad': 'x' * 100000})
+    b.push({'pad': 'y' * 100000})
+    
+    assert a.queued_bytes() > 0 and b.queued_bytes() > 0
+    
+    msgs = [{'n': i, 'pad': 'z' * 3000} for i in range(40)]
+    
+    for msg in msgs:
+        tx.push(msg)
+    
+    got = []
+    
+    for i in range(2000):
+        
+        for msg in rx.pull(b):
+            if 'n' in msg:
+                got.append(msg)
+        
+        tx.pull()
+        
+        if len(got) == len(msgs) and not tx.pending():
+            break
+    
+    assert got == msgs
+    assert tx.pending() == 0
+    assert rx.stats['duplicates'] == 0
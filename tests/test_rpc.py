@@ -0,0 +1,101 @@
+import os
+import sys
+import socket
+import resource
+
+from transport import downlink
+from rpc import requester, request_timeout, request_failed
+
+
+def test_request_fails_when_queue_full():
+    
+    a, b = socket.socketpair()
+    
+    link = downlink(a)
+    link.limit(max_msgs=1, policy='drop-newest')
+    
+    # nobody reads b, so this stays queued
+    link.push({'pad': 'x' * 1000000})
+    
+    req = requester(link)
+    p = req.request({'obj-id': 'ps'})
+    
+    assert p.done() and isinstance(p.error, request_failed)
+    assert req.outstanding == {} and req.stats['failures'] == 1
+    
+    b.close()
+
+
+def test_request_fails_when_queue_rejects():
+    
+    a, b = socket.socketpair()
+    
+    link = downlink(a)
+    link.limit(max_msgs=1, policy='reject')
+    
+    link.push({'pad': 'x' * 1000000})
+    
+    req = requester(link)
+    p = req.request({'obj-id': 'ps'})
+    
+    assert p.done() and isinstance(p.error, request_failed)
+    assert req.outstanding == {} and req.deadlines == []
+    assert req.stats['failures'] == 1
+    
+    b.close()
+
+
+def test_request_fails_when_link_dead():
+    
+    a, b = socket.socketpair()
+    b.close()
+    
+    failed = []
+    
+    req = requester(downlink(a))
+    p = req.request({'obj-id': 'ps'}, callback=failed.append)
+    
+    assert failed == [p]
+    
+    try:
+        p.result()
+        assert False
+    except request_failed:
+        pass
+
+
+def test_wait_on_high_fd():
+    
+    if sys.version_info[0] < 3:
+        # no way to wrap a given fd without dup()ing it
+        return
+    
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    
+    if hard != resource.RLIM_INFINITY and hard < 1200:
+        return
+    
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 1200), hard))
+    
+    a, b = socket.socketpair()
+    
+    try:
+        # past what select() can handle
+        os.dup2(a.fileno(), 1100)
+        high = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0, 1100)
+        a.close()
+        
+        req = requester(downlink(high))
+        p = req.request({'obj-id': 'ps'}, timeout=0.05)
+        
+        try:
+            p.result()
+            assert False
+        except request_timeout:
+            pass
+        
+        high.close()
+    
+    finally:
+        b.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
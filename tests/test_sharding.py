@@ -0,0 +1,64 @@
+import os
+import time
+import marshal
+
+from transport import uplink
+from sharding import forward_link, sharded_listener
+
+
+def test_truncated_record_is_a_hang_up():
+    
+    name = 'test-truncated-%i' % os.getpid()
+    
+    coordinator = forward_link(name, create=True)
+    worker = forward_link(name)
+    
+    worker.push({'event': 'msg', 'n': 1})
+    
+    # as if the worker died partway through the next one
+    worker.dumps = lambda rec: marshal.dumps(rec)[:-3]
+    worker.push({'event': 'msg', 'n': 2})
+    
+    assert coordinator.pull() == [{'event': 'msg', 'n': 1}]
+    assert coordinator.socket == None
+    
+    worker.close()
+
+
+def fussy(link, obj):
+    
+    if obj.get('bad'):
+        raise ValueError('no thanks')
+    
+    return obj
+
+
+def test_handler_errors_dont_kill_the_worker():
+    
+    shards = sharded_listener([('127.0.0.1', 0)], workers=1,
+        handler=fussy, name='test-fussy-%i' % os.getpid())
+    
+    try:
+        up = uplink(*shards.locations[0])
+        
+        up.push({'bad': True})
+        up.push({'n': 1})
+        
+        msgs = []
+        deadline = time.time() + 10
+        
+        while not msgs and time.time() < deadline:
+            
+            up.send()
+            
+            for rec in shards.select(timeout=0.1):
+                if rec['event'] == 'msg':
+                    msgs.append(rec['msg'])
+        
+        assert msgs == [{'n': 1}]
+        assert shards.restarts == 0
+        
+        up.close()
+    
+    finally:
+        shards.close()
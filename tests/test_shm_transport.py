@@ -0,0 +1,22 @@
+import os
+
+from transport import DOWNLINK_DEAD
+from shm_transport import shm_link
+
+
+def test_closed_link_is_dead():
+    
+    name = 'test-closed-%i' % os.getpid()
+    
+    consumer = shm_link(name, create=True)
+    producer = shm_link(name)
+    
+    producer.push({'n': 1})
+    
+    assert consumer.pull() == [{'n': 1}]
+    
+    producer.close()
+    consumer.close()
+    
+    assert consumer.recv() is DOWNLINK_DEAD
+    assert consumer.send() is DOWNLINK_DEAD
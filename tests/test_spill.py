@@ -0,0 +1,212 @@
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+
+from spill import spill_queue
+from asynch_json_socket import _socket, recv_overflow
+
+
+def make_queue(directory, **kwargs):
+    return spill_queue('test', directory=directory, replay_rate=None,
+        **kwargs)
+
+
+def test_restart_sends_partial_message_whole():
+    
+    d = tempfile.mkdtemp()
+    
+    try:
+        q = make_queue(d, mem_limit=64)
+        
+        msgs = [b'{"n": %i, "pad": "%s"}' % (i, b'x' * 30) for i in range(6)]
+        
+        for msg in msgs:
+            q.append(msg)
+        
+        # all of the first message, and some of the second, then the
+        # connection drops
+        q.consume(len(msgs[0]) + 10)
+        q.restart()
+        
+        assert q.peek().startswith(msgs[1])
+        
+        # the same again past mem_limit, so the front gets compacted
+        # away in the meantime
+        q.consume(len(msgs[1]) + len(msgs[2]) + 5)
+        q.restart()
+        
+        assert q.peek() == b''.join(msgs[3:])
+    
+    finally:
+        shutil.rmtree(d)
+
+
+def test_flush_to_disk_keeps_partial_message_whole():
+    
+    d = tempfile.mkdtemp()
+    
+    try:
+        q = make_queue(d)
+        
+        msgs = [b'{"n": %i}' % i for i in range(5)]
+        
+        for msg in msgs:
+            q.append(msg)
+        
+        q.consume(len(msgs[0]) + 3)
+        q.flush_to_disk()
+        q.close()
+        
+        q = make_queue(d)
+        
+        assert q.peek() == b''.join(msgs[1:])
+        assert q.stats['truncated'] == 0
+    
+    finally:
+        shutil.rmtree(d)
+
+
+def test_peek_is_bounded():
+    
+    d = tempfile.mkdtemp()
+    
+    try:
+        q = make_queue(d)
+        
+        q.append(b'x' * 1000)
+        
+        assert q.peek(100) == b'x' * 100
+        
+        q.consume(100)
+        
+        assert len(q.peek()) == 900
+    
+    finally:
+        shutil.rmtree(d)
+
+
+def pump(s, conn, until, timeout=5.0):
+    """
+    send() from s and read conn until until(data) is true
+    """
+    
+    data = b''
+    deadline = time.time() + timeout
+    
+    while not until(data) and time.time() < deadline:
+        
+        s.send()
+        
+        try:
+            data += conn.recv(65536)
+        except socket.timeout:
+            pass
+    
+    return data
+
+
+def test_reconnect_resends_partial_message_whole():
+    
+    d = tempfile.mkdtemp()
+    
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    server.settimeout(5)
+    
+    port = server.getsockname()[1]
+    
+    big = json.dumps({'n': 0, 'pad': 'x' * 500000}).encode()
+    small = json.dumps({'n': 1}).encode()
+    
+    s = _socket(addr='127.0.0.1', port=port, directory=d,
+        replay_rate=None, mem_limit=1 << 20)
+    
+    # so that the big message can't all fit in the kernel's buffers
+    s.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    
+    try:
+        s.send(big)
+        s.send(small)
+        
+        conn, addr = server.accept()
+        conn.settimeout(0.01)
+        
+        # some of the big message, then the connection's lost
+        data = pump(s, conn, lambda data: len(data) > 1000)
+        
+        assert 1000 < len(data) < len(big)
+        
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+            b'\x01\x00\x00\x00\x00\x00\x00\x00')
+        conn.close()
+        
+        deadline = time.time() + 5
+        
+        while s.connected and time.time() < deadline:
+            s.send()
+        
+        # reconnects
+        s.send()
+        
+        conn, addr = server.accept()
+        conn.settimeout(0.01)
+        
+        data = pump(s, conn, lambda data: len(data) >= len(big + small))
+        
+        assert data == big + small
+    
+    finally:
+        s.close()
+        server.close()
+        shutil.rmtree(d)
+
+
+def test_recv_stops_reading_at_high_water():
+    
+    if sys.version_info[0] >= 3:
+        # _socket.recv() still queues str, as on python 2
+        return
+    
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    server.settimeout(5)
+    
+    port = server.getsockname()[1]
+    
+    d = tempfile.mkdtemp()
+    
+    s = _socket(addr='127.0.0.1', port=port, directory=d)
+    s.high_water_mark = 100
+    
+    try:
+        s.connect()
+        conn, addr = server.accept()
+        
+        # one object, bigger than we're willing to hold
+        conn.sendall(json.dumps({'pad': 'x' * 1000}))
+        time.sleep(0.1)
+        
+        try:
+            s.recv()
+        except recv_overflow:
+            pass
+        else:
+            assert False
+        
+        # nothing's thrown away: the rest is still waiting in the socket
+        assert len(s.rq) == 100
+        assert s.rq.startswith('{"pad"')
+        assert len(s.socket.recv(4096)) > 900
+    
+    finally:
+        conn.close()
+        s.close()
+        server.close()
+        shutil.rmtree(d)
@@ -0,0 +1,798 @@
+import os
+import json
+import stat
+import random
+import shutil
+import socket
+import tempfile
+import time
+import threading
+
+from collections import deque
+
+import transport
+from transport import downlink, uplink, listener, local_dir, local_path, \
+    DOWNLINK_DEAD, QUEUE_FULL, OLDEST_DROPPED, queue_full
+
+
+def link_pair(sndbuf=None):
+    
+    a, b = socket.socketpair()
+    
+    if sndbuf != None:
+        a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sndbuf)
+    
+    return downlink(a), downlink(b)
+
+
+def exchange(sender, reciever, count, timeout=5.0):
+    """
+    send() and pull() until reciever has count messages
+    """
+    
+    got = []
+    deadline = time.time() + timeout
+    
+    while len(got) < count and time.time() < deadline:
+        assert sender.send() is not DOWNLINK_DEAD
+        got += reciever.pull()
+    
+    return got
+
+
+def feed(chunks):
+    """
+    Hand chunks to a link's recieve queue one at a time, as recv()
+    would, and return the objects it finds along with the link
+    """
+    
+    l = transport.link()
+    got = []
+    
+    for chunk in chunks:
+        l.rq += chunk
+        got += l.unpack()
+    
+    return got, l
+
+
+def chunked(data, sizes):
+    
+    out = []
+    pos = 0
+    
+    for n in sizes:
+        out.append(data[pos:pos+n])
+        pos += n
+    
+    return out + [data[pos:]]
+
+
+def test_framer_under_arbitrary_chunking():
+    
+    msgs = [
+        {'n': 0},
+        {'s': '{not a brace}', 'nested': {'a': [{'b': {}}]}},
+        {'s': 'a quote " then a } and a backslash \\'},
+        {'s': '\\"}{\\'},
+        {'s': u'\u00e9\u4e2d {', 'empty': ''},
+        {'pad': 'x' * 10000},
+        ]
+    
+    # whitespace between objects is skipped
+    data = b' \n'.join(json.dumps(m).encode() for m in msgs) + b'\n'
+    
+    rng = random.Random(0)
+    
+    splits = [[1] * len(data)]
+    splits += [[n] * (len(data) // n) for n in range(2, 14)]
+    splits += [[rng.randint(1, 200) for i in range(len(data) // 100)]
+        for j in range(20)]
+    
+    for sizes in splits:
+        
+        got, l = feed(chunked(data, sizes))
+        
+        assert got == msgs
+        assert l.stats['parse_errors'] == 0
+        
+        # nothing's kept past the last object
+        assert len(l.rq) == 0
+
+
+def unix_server(name):
+    
+    path = os.path.join(tempfile.mkdtemp(), name)
+    
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    
+    return server, path
+
+
+def test_mixed_framing_under_arbitrary_chunking():
+    
+    l = transport.link()
+    l.framing = 'length'
+    
+    msgs = [{'n': i, 's': '}{' * i} for i in range(20)]
+    
+    # brace framed, then length prefixed, as when a link switches over
+    data = b''.join(json.dumps(m).encode() for m in msgs[:10])
+    data += b''.join(l.encode(json.dumps(m).encode()) for m in msgs[10:])
+    
+    for n in range(1, 20):
+        got, l = feed(chunked(data, [n] * (len(data) // n)))
+        assert got == msgs
+        assert len(l.rq) == 0
+
+
+def test_length_framing_negotiated():
+    
+    server, path = unix_server('length.sock')
+    
+    try:
+        up = uplink(path, None, framing='length')
+        
+        conn, addr = server.accept()
+        down = downlink(conn)
+        
+        # brace framed until the downlink agrees
+        assert up.framing == 'brace'
+        
+        up.push({'n': 0})
+        assert exchange(up, down, 1) == [{'n': 0}]
+        
+        assert down.framing == 'length'
+        
+        deadline = time.time() + 5
+        
+        while up.framing != 'length' and time.time() < deadline:
+            assert up.pull() == []
+        
+        assert up.framing == 'length'
+        
+        msgs = [{'n': i, 'pad': '{' * 1000} for i in range(1, 10)]
+        
+        up.push_many(msgs)
+        assert exchange(up, down, 9) == msgs
+        
+        down.push({'n': 'back'})
+        assert exchange(down, up, 1) == [{'n': 'back'}]
+        
+        up.close()
+        down.close()
+    
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def test_length_framing_falls_back_to_braces():
+    
+    server, path = unix_server('braces.sock')
+    
+    try:
+        up = uplink(path, None, framing='length')
+        
+        conn, addr = server.accept()
+        conn.settimeout(5)
+        
+        up.push({'n': 0})
+        up.push({'n': 1})
+        
+        # a peer that's never heard of HELLO just sees one more object
+        framer = transport.brace_framer()
+        data = b''
+        spans = []
+        
+        while len(spans) < 3:
+            data += conn.recv(4096)
+            spans += framer.scan(data)
+        
+        hello, first, second = [json.loads(data[start:end].decode())
+            for start, end, kind in spans]
+        
+        assert hello['obj-id'] == transport.HELLO
+        assert hello['framing'] == ['length']
+        assert (first, second) == ({'n': 0}, {'n': 1})
+        
+        # and never answers, so nothing changes
+        assert up.pull() == []
+        assert up.framing == 'brace'
+        
+        up.push({'n': 2})
+        assert conn.recv(4096) == b'{"n": 2}'
+        
+        up.close()
+        conn.close()
+    
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def test_zlib_negotiated():
+    
+    server, path = unix_server('zlib.sock')
+    
+    try:
+        up = uplink(path, None, compress=True)
+        
+        conn, addr = server.accept()
+        down = downlink(conn)
+        
+        up.push({'n': 0})
+        assert exchange(up, down, 1) == [{'n': 0}]
+        
+        deadline = time.time() + 5
+        
+        while up.compress == None and time.time() < deadline:
+            assert up.pull() == []
+        
+        assert (up.framing, up.compress) == ('length', 'zlib')
+        assert (down.framing, down.compress) == ('length', 'zlib')
+        
+        small = {'n': 1}
+        big = {'n': 2, 'pad': 'abc' * 10000}
+        
+        up.push_many([small, big])
+        
+        assert exchange(up, down, 2) == [small, big]
+        
+        # only the big one was worth compressing
+        assert up.stats['zlib_in'] == len(json.dumps(big))
+        assert up.compression_ratio() < 0.1
+        assert up.stats['bytes_out'] < 1000
+        
+        up.close()
+        down.close()
+    
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def test_zlib_falls_back():
+    
+    path = os.path.join(tempfile.mkdtemp(), 'nobody.sock')
+    
+    # compression isn't used unless we offered it...
+    up = uplink(path, None, framing='length')
+    up.hello({'obj-id': transport.HELLO, 'framing': 'length',
+        'compress': 'zlib'})
+    
+    assert (up.framing, up.compress) == ('length', None)
+    
+    # ...and isn't offered to a downlink that wasn't asked
+    down, other = link_pair()
+    
+    assert down.answer_offer({'obj-id': transport.HELLO,
+        'framing': ['length']}) == {'obj-id': transport.HELLO,
+        'framing': 'length'}
+    
+    # whatever was agreed with the last downlink, the next one gets
+    # plain braces until it agrees too
+    up = uplink(path, None, compress=True)
+    up.use_features({'framing': 'length', 'compress': 'zlib'})
+    
+    small = {'n': 0}
+    big = {'n': 1, 'pad': 'abc' * 10000}
+    
+    for msg in (small, big):
+        up.enqueue(up.encode(json.dumps(msg).encode()))
+    
+    up.requeue()
+    
+    assert (up.framing, up.compress) == ('brace', None)
+    
+    got, l = feed([up.unsent().tobytes()])
+    
+    assert got == [small, big]
+
+
+def test_send_gathered_behind_backlog():
+    
+    a, b = link_pair()
+    
+    a.enqueue(b'{"n": 0}')
+    a.gather_frame(b'{"n": 1}')
+    
+    assert a.send() is not DOWNLINK_DEAD
+    
+    assert exchange(a, b, 2) == [{'n': 0}, {'n': 1}]
+    assert a.queued_bytes() == 0
+
+
+def test_push_many_after_partial_write():
+    
+    a, b = link_pair(sndbuf=4096)
+    
+    big = {'n': 0, 'pad': 'x' * 200000}
+    
+    # more than the socket takes at once, so some of it's left queued
+    a.push(big)
+    assert a.queued_bytes() > 0
+    
+    msgs = [{'n': i, 'pad': 'y' * 5000} for i in range(1, 50)]
+    
+    for i in range(0, len(msgs), 10):
+        assert a.push_many(msgs[i:i+10]) is not DOWNLINK_DEAD
+    
+    got = exchange(a, b, 50)
+    
+    assert got == [big] + msgs
+    assert a.queued_bytes() == 0
+
+
+def test_queues_drain_in_place():
+    
+    a, b = link_pair(sndbuf=4096)
+    
+    big = {'n': 0, 'pad': 'x' * 500000}
+    frame = json.dumps(big).encode()
+    
+    a.push(big)
+    
+    assert isinstance(a.sq, bytearray) and isinstance(b.rq, bytearray)
+    
+    sizes = set()
+    got = []
+    deadline = time.time() + 5
+    
+    while not got and time.time() < deadline:
+        
+        # whatever's been sent, the rest is still there, in order
+        sent = len(frame) - a.queued_bytes()
+        assert a.unsent().tobytes() == frame[sent:]
+        sizes.add(len(a.sq))
+        
+        assert a.send() is not DOWNLINK_DEAD
+        got += b.pull()
+        
+        # nothing's scanned twice while the object trickles in
+        assert b.framer.offset == len(b.rq)
+    
+    assert got == [big]
+    
+    # the sent part was cut off the front on the way, once it was big
+    # enough to be worth it, rather than on every send() or not at all
+    assert 1 < len(sizes - set([0, len(frame)])) < 10
+    
+    assert len(a.sq) == a.sq_pos == 0
+    assert len(b.rq) == 0
+
+
+def backed_up(policy, timeout=1.0):
+    """
+    A link pair with a message partway out of the sender, and room for
+    two more in its queue
+    """
+    
+    a, b = link_pair(sndbuf=4096)
+    
+    big = {'n': 0, 'pad': 'x' * 200000}
+    
+    a.push(big)
+    a.limit(max_msgs=3, policy=policy, timeout=timeout)
+    
+    assert a.push({'n': 1}) == 0
+    assert a.push({'n': 2}) == 0
+    
+    return a, b, big
+
+
+def test_drop_oldest():
+    
+    a, b, big = backed_up('drop-oldest')
+    
+    assert a.push({'n': 3}) is OLDEST_DROPPED
+    
+    # the partly sent message stays, being of no use to anyone in part
+    assert exchange(a, b, 3) == [big, {'n': 2}, {'n': 3}]
+    assert a.stats['dropped'] == 1
+
+
+def test_drop_newest():
+    
+    a, b, big = backed_up('drop-newest')
+    
+    assert a.push({'n': 3}) is QUEUE_FULL
+    assert a.push_many([{'n': 4}, {'n': 5}]) is QUEUE_FULL
+    
+    assert exchange(a, b, 3) == [big, {'n': 1}, {'n': 2}]
+    assert a.stats['dropped'] == 3
+
+
+def test_reject():
+    
+    a, b, big = backed_up('reject')
+    
+    try:
+        a.push({'n': 3})
+        assert False
+    except queue_full:
+        pass
+    
+    assert exchange(a, b, 3) == [big, {'n': 1}, {'n': 2}]
+    assert a.stats['rejected'] == 1 and a.stats['dropped'] == 0
+
+
+def test_block():
+    
+    a, b, big = backed_up('block', timeout=0.2)
+    
+    # nobody's reading, so it gives up
+    t = time.time()
+    assert a.push({'n': 3}) is QUEUE_FULL
+    assert time.time() - t >= 0.2
+    
+    got = []
+    
+    def read():
+        deadline = time.time() + 5
+        while len(got) < 4 and time.time() < deadline:
+            got.extend(b.pull())
+            time.sleep(0.001)
+    
+    reader = threading.Thread(target=read)
+    reader.start()
+    
+    # someone is, so it waits its turn
+    a.limit(max_msgs=3, policy='block', timeout=5)
+    assert a.push({'n': 4}) is not QUEUE_FULL
+    
+    while a.queued_bytes():
+        a.send()
+        time.sleep(0.001)
+    
+    reader.join()
+    
+    assert got == [big, {'n': 1}, {'n': 2}, {'n': 4}]
+    assert a.stats['dropped'] == 1
+
+
+def test_link_metrics():
+    
+    a, b = link_pair()
+    
+    msgs = [{'n': i} for i in range(5)]
+    nbytes = sum(len(json.dumps(m)) for m in msgs)
+    
+    a.push_many(msgs)
+    assert exchange(a, b, 5) == msgs
+    
+    out = a.metrics()
+    
+    assert out['msgs_out'] == 5 and out['bytes_out'] == nbytes
+    assert 1 <= out['send_calls'] <= 5
+    assert out['queued_bytes'] == out['queued_msgs'] == 0
+    assert 0 <= out['idle_seconds'] < 5
+    
+    b.rq += b'{"n": }'
+    assert b.unpack() == []
+    
+    out = b.metrics()
+    
+    assert out['msgs_in'] == 5 and out['bytes_in'] == nbytes
+    assert out['parse_errors'] == 1 and out['errors'] == 1
+    assert len(b.errors) == 1
+
+
+def test_listener_metrics_prometheus():
+    
+    l = listener([])
+    
+    try:
+        a, b = link_pair()
+        a.name = 'leaf "one"\n'
+        b.name = 'b'
+        
+        l.register(a)
+        l.register(b)
+        
+        a.push({'n': 0})
+        
+        snapshot = json.loads(l.metrics_json())
+        
+        assert sorted(snapshot) == ['b', 'leaf "one"\n']
+        assert snapshot['leaf "one"\n']['msgs_out'] == 1
+        
+        text = l.metrics_prometheus()
+        
+        assert '# TYPE pb_link_msgs_out_total counter\n' \
+            'pb_link_msgs_out_total{link="b"} 0\n' \
+            'pb_link_msgs_out_total{link="leaf \\"one\\"\\n"} 1\n' \
+            in text
+        assert '# TYPE pb_link_queued_bytes gauge\n' in text
+    
+    finally:
+        l.close()
+    
+    text = transport.prometheus_text({'x': {'dropped': 3,
+        'queued_msgs': 2}}, prefix='q')
+    
+    assert text == '# TYPE q_dropped_total counter\n' \
+        'q_dropped_total{link="x"} 3\n' \
+        '# TYPE q_queued_msgs gauge\n' \
+        'q_queued_msgs{link="x"} 2\n'
+
+
+def test_uplink_greeting_then_push_many():
+    
+    path = os.path.join(tempfile.mkdtemp(), 'greeting.sock')
+    
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    
+    try:
+        up = uplink(path, None, connect_msg={'hello': 'node'})
+        
+        conn, addr = server.accept()
+        down = downlink(conn)
+        
+        assert up.push_many([{'n': i} for i in range(3)]) \
+            is not DOWNLINK_DEAD
+        
+        got = exchange(up, down, 4)
+        
+        assert got == [{'hello': 'node'}] + [{'n': i} for i in range(3)]
+        
+        up.close()
+        down.close()
+    
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def test_connect_backoff_and_jitter():
+    
+    path = os.path.join(tempfile.mkdtemp(), 'nobody.sock')
+    
+    # nothing's listening, so the first attempt fails straight away
+    up = uplink(path, None)
+    
+    assert up.state == 'disconnected' and up.failures == 1
+    
+    up.backoff_base = 1.0
+    up.backoff_max = 8.0
+    
+    for failures in range(8):
+        
+        full = min(8.0, 2**failures)
+        delays = set()
+        
+        for i in range(20):
+            up.failures = failures
+            t = time.time()
+            up.failed()
+            delays.add(up.next_attempt - t)
+        
+        assert up.failures == failures + 1
+        
+        # between half and all of the full delay, and spread out
+        assert 0.5*full - 0.01 < min(delays) and max(delays) < full + 0.01
+        assert len(delays) > 10
+    
+    # not before time
+    attempts = up.stats['connect_attempts']
+    
+    assert up.poll_connect() == False
+    assert up.stats['connect_attempts'] == attempts
+
+
+def test_connect_retry_budget():
+    
+    path = os.path.join(tempfile.mkdtemp(), 'later.sock')
+    
+    up = uplink(path, None, retry_budget=(3, 60.0))
+    up.backoff_base = 0
+    up.next_attempt = 0
+    
+    for i in range(10):
+        assert up.poll_connect() == False
+    
+    # backoff or no backoff
+    assert up.stats['connect_attempts'] == 3
+    
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    
+    try:
+        assert up.poll_connect() == False
+        
+        # once the period's up, it's back
+        up.attempts = deque(t - 60.0 for t in up.attempts)
+        
+        assert up.poll_connect() == True
+        assert up.stats['connect_attempts'] == 4
+        assert up.stats['reconnects'] == 1
+        assert up.failures == 0
+        
+        up.close()
+    
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def test_select_list_only_rewatched_when_changed():
+    
+    l = listener([])
+    
+    watched = []
+    watch = l.watch
+    
+    def counted(wlist):
+        watched.append(len(wlist))
+        watch(wlist)
+    
+    l.watch = counted
+    
+    try:
+        a, b = link_pair()
+        c, d = link_pair()
+        
+        links = [a]
+        
+        for i in range(5):
+            l.select(links, timeout=0)
+        
+        links.append(c)
+        l.select(links, timeout=0)
+        l.select(links, timeout=0)
+        
+        assert watched == [1, 2]
+        assert set(l.links) == set([a, c])
+        
+        # a different list is looked through, whatever its length
+        l.select([c, d], timeout=0)
+        
+        assert watched == [1, 2, 2]
+        assert set(l.links) == set([c, d])
+        
+        b.push({'n': 0})
+        
+        assert l.select([c, d], timeout=0.1) == ([], [])
+        assert l.select(None, timeout=0.1) == ([], [])
+        
+        c.push({'n': 1})
+        
+        assert l.select(timeout=1) == ([d], [])
+    
+    finally:
+        l.close()
+
+
+def local_sockets(fn):
+    """
+    Run fn with local_path()s under a fresh temporary directory
+    """
+    
+    root = tempfile.mkdtemp()
+    saved = transport.local_root
+    transport.local_root = root
+    
+    try:
+        fn()
+    finally:
+        transport.local_root = saved
+        shutil.rmtree(root)
+
+
+def test_local_sockets_are_opt_in_and_private():
+    
+    def check():
+        
+        l = listener([('127.0.0.1', 0)])
+        port = l.bound_sockets[0].getsockname()[1]
+        
+        assert l.bound_paths == []
+        assert not os.path.exists(local_path(port))
+        
+        l.close()
+        
+        l = listener([('127.0.0.1', 0)], local=True)
+        port = l.bound_sockets[0].getsockname()[1]
+        path = local_path(port)
+        
+        st = os.stat(local_dir())
+        assert st.st_uid == os.getuid()
+        assert stat.S_IMODE(st.st_mode) == 0o700
+        
+        assert os.path.dirname(path) == local_dir()
+        assert stat.S_ISSOCK(os.stat(path).st_mode)
+        
+        up = uplink('127.0.0.1', port, local=True)
+        assert up.unix
+        
+        # the default is TCP, even with the socket there
+        assert not uplink('127.0.0.1', port).unix
+        
+        up.close()
+        l.close()
+        
+        assert not os.path.exists(path)
+    
+    local_sockets(check)
+
+
+def test_local_sockets_removed_at_exit():
+    
+    def check():
+        
+        l = listener([('127.0.0.1', 0)], local=True)
+        path = local_path(l.bound_sockets[0].getsockname()[1])
+        
+        assert os.path.exists(path)
+        
+        transport._unlink_all_unix()
+        
+        assert not os.path.exists(path)
+        
+        l.close()
+    
+    local_sockets(check)
+
+
+def test_someone_elses_local_socket_is_left_alone():
+    
+    if os.getuid() != 0:
+        # can't make one that isn't ours
+        return
+    
+    def check():
+        
+        l = listener([('127.0.0.1', 0)])
+        port = l.bound_sockets[0].getsockname()[1]
+        path = local_path(port)
+        
+        # someone else's socket, where ours would go
+        other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        other.bind(path)
+        other.listen(1)
+        os.chown(path, 12345, 12345)
+        
+        try:
+            up = uplink('127.0.0.1', port, local=True)
+            assert not up.unix
+            up.close()
+            
+            try:
+                l.bind_unix(path)
+                assert False
+            except OSError:
+                pass
+        
+        finally:
+            other.close()
+            l.close()
+        
+        # not ours to remove
+        assert os.path.exists(path)
+    
+    local_sockets(check)
+
+
+def test_local_dir_must_be_private():
+    
+    def check():
+        
+        os.chmod(local_dir(), 0o755)
+        
+        try:
+            local_dir()
+            assert False
+        except OSError:
+            pass
+        
+        l = listener([('127.0.0.1', 0)], local=True)
+        assert l.bound_paths == []
+        l.close()
+    
+    local_sockets(check)
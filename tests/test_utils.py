@@ -0,0 +1,244 @@
+import os
+import time
+import socket
+import threading
+
+from utils import command_pool, process_handle, run_commands, tail_buffer
+from utils import command_stream, external_call_async
+from utils import host_prober
+
+
+def test_close_pool_with_queued_commands():
+    
+    pool = command_pool(parallel=1, kill_after=0.2)
+    
+    handles = [process_handle(['sleep', '30']) for i in range(5)]
+    
+    for handle in handles:
+        pool.submit(handle)
+    
+    # starts the first, which leaves the rest waiting for its slot
+    pool.step(timeout=0)
+    
+    started = [h for h in handles if h.command != None]
+    assert len(started) == 1
+    
+    closer = threading.Thread(target=pool.close)
+    closer.daemon = True
+    closer.start()
+    closer.join(10)
+    
+    assert not closer.is_alive()
+    
+    # nothing else was started on the way out, and the one that was
+    # isn't running any more
+    assert [h for h in handles if h.command != None] == started
+    assert started[0].command.proc.poll() != None
+    
+    for handle in handles:
+        assert handle.done()
+    
+    for handle in handles[1:]:
+        assert handle.result().stderr == b'cancelled'
+
+
+def test_background_child_holding_output():
+    
+    # exits straight away, but the sleep keeps stderr open
+    cmd = ['sh', '-c', 'sleep 30 > /dev/null & echo $!']
+    
+    t = time.time()
+    result, = run_commands([cmd], timeout=20)
+    
+    assert time.time() - t < 5
+    assert result.returncode == 0 and not result.timed_out
+    
+    # and whatever it left running is left alone
+    pid = int(result.stdout)
+    
+    os.kill(pid, 0)
+    os.kill(pid, 9)
+
+
+def test_tail_buffer_limits():
+    
+    for limit, expected in ((0, b''), (3, b'def'), (None, b'abcdef')):
+        
+        buf = tail_buffer(limit)
+        
+        for chunk in (b'ab', b'', b'cdef'):
+            buf.write(chunk)
+        
+        assert buf.getvalue() == expected
+        assert buf.total == 6
+
+
+def test_commands_get_process_groups_of_their_own():
+    
+    out = run_commands([['sh', '-c', 'ps -o pgid= -p $$; echo $$']],
+        timeout=5)[0].stdout.split()
+    
+    assert out[0] == out[1]
+
+
+def test_command_stream_lines_as_they_come():
+    
+    script = '''
+        printf '10%%\\r20%%\\r'
+        echo oops >&2
+        sleep 1
+        printf '\\n\\ndone\\r\\nno newline'
+    '''
+    
+    stream = command_stream(['sh', '-c', script], timeout=10, tail=4)
+    
+    t = time.time()
+    got = []
+    
+    for name, line in stream:
+        got.append((name, line, time.time() - t < 0.9))
+    
+    assert sorted(got[:3]) == [('stderr', b'oops', True),
+        ('stdout', b'10%', True), ('stdout', b'20%', True)]
+    assert got[3:] == [('stdout', b'done', False),
+        ('stdout', b'no newline', False)]
+    
+    r = stream.result
+    
+    assert r.returncode == 0 and not r.timed_out
+    
+    # only the tail is kept
+    assert r.stdout == b'line' and r.stderr == b'ops\n'
+
+
+def test_command_stream_chunks_and_close():
+    
+    stream = command_stream(['sh', '-c', 'echo a; sleep 30'],
+        lines=False, kill_after=0.5)
+    
+    t = time.time()
+    
+    for name, data in stream:
+        assert (name, data) == ('stdout', b'a\n')
+        stream.close()
+    
+    assert time.time() - t < 5
+    
+    r = stream.result
+    
+    assert r.returncode != 0 and r.stdout == b'a\n'
+
+
+def test_external_call_async_as_before():
+    
+    call = external_call_async([['sh', '-c', 'sleep 0.5; echo a'],
+        ['sh', '-c', 'echo b >&2']], timeout=5)
+    
+    assert call.worker.is_alive()
+    assert call.stdout == None and call.stderr == None
+    
+    call.worker.join()
+    
+    assert not call.worker.is_alive() and call.done()
+    assert call.stdout == [b'a\n', b''] and call.stderr == [b'', b'b\n']
+    
+    call = external_call_async([])
+    call.join()
+    
+    assert call.stdout == call.stderr == []
+
+
+def test_slow_lookup_holds_up_nothing_else():
+    
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+    
+    real = socket.getaddrinfo
+    
+    def getaddrinfo(host, *args):
+        if host == 'slow.invalid':
+            if len(args) > 4 and args[4] & socket.AI_NUMERICHOST:
+                raise socket.gaierror(socket.EAI_NONAME, 'not numeric')
+            time.sleep(2)
+            return real('127.0.0.1', *args)
+        return real(host, *args)
+    
+    socket.getaddrinfo = getaddrinfo
+    
+    try:
+        p = host_prober(timeout=0.5)
+        
+        t = time.time()
+        
+        slow, fast, local = p.probe([('slow.invalid', port),
+            ('127.0.0.1', port), ('localhost', port)])
+        
+        assert time.time() - t < 1.5
+        
+        assert slow.state == 'timeout'
+        assert fast.state == 'open'
+        assert local.state == 'open'
+        
+        # the slow answer still turns up for next time
+        time.sleep(2)
+        
+        assert p.probe([('slow.invalid', port)])[0].state == 'open'
+    
+    finally:
+        socket.getaddrinfo = real
+        server.close()
+
+
+def test_status_answers_from_the_cache_without_waiting():
+    
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+    
+    p = host_prober(ttl=0.1)
+    
+    real = p.probe
+    probing = threading.Event()
+    
+    def probe(targets):
+        probing.set()
+        time.sleep(1)
+        return real(targets)
+    
+    p.probe = probe
+    
+    try:
+        t = time.time()
+        
+        # nothing known yet: no answer, but a probe on its way
+        assert p.status('127.0.0.1', port) == None
+        assert time.time() - t < 0.5
+        assert probing.wait(1)
+        
+        # and only the one
+        assert p.refresh_later([('127.0.0.1', port)]) == False
+        
+        p.refreshing.join(5)
+        assert p.status('127.0.0.1', port) == True
+        
+        # once stale, the old answer stands while it's refreshed
+        time.sleep(0.2)
+        probing.clear()
+        
+        t = time.time()
+        assert p.status('127.0.0.1', port) == True
+        assert time.time() - t < 0.5
+        assert probing.wait(1)
+        
+        p.refreshing.join(5)
+        
+        # unless we'd rather wait
+        t = time.time()
+        assert p.status('127.0.0.1', port, max_age=0, wait=True) == True
+        assert time.time() - t >= 1
+    
+    finally:
+        server.close()
@@ -15,10 +15,13 @@ message being sent is a JSON object at its outer level.
 
 Usage is slightly different than TCP sockets. A server creates a
 listener instance, which listens for connections on a list of IP
-addresses and ports. listener.select() blocks on a list of link objects
-passed to it and the (address, port) pairs it's initialized with,
+addresses and ports. listener.select() blocks on the links registered
+with it and the (address, port) pairs it's initialized with,
 returning any link(up- or down-) objects that are ready for reading, and
-new downlink objects resulting from new connections.
+new downlink objects resulting from new connections, which are
+registered for it automatically. Links are kept registered with an
+epoll (or equivalent) selector between calls, so a listener can serve
+far more links than select.select() allows.
 
 Clients create uplink objects that connect() to a server. Importantly,
 an uplink can connect() and push() before the server is ready through 
@@ -28,13 +31,11 @@ use of internal buffering and automatic reconnection attempts.
 
     Example server:
     
-        links = [] 
-    
         _listener = listener( ['localhost',31415] )
         
         while True:
         
-            readable, new_downlinks = _listener.select(links)
+            readable, new_downlinks = _listener.select()
             
             for r in readable:
                 
@@ -42,8 +43,6 @@ use of internal buffering and automatic reconnection attempts.
                  
                  do_stuff(json_obj)
             
-            links += new_downlinks
-            
     Example client:
     
         msg =  { 'payload': 'Hello, World!' } 
@@ -56,25 +55,483 @@ use of internal buffering and automatic reconnection attempts.
 Presently, uplink and downlink are implemented as synchronous TCP socket
 wrappers. 
 
+On the wire, messages are by default framed only by their own braces,
+which means the receiver has to look at every byte to find where one
+message ends. An uplink created with framing='length' offers the
+downlink length prefixed framing in a HELLO message sent ahead of its
+connect_msg. A downlink that understands it replies in kind, and both
+ends switch over. Receivers accept either framing at any time, so old
+and new peers can be mixed freely. Length prefixed frames may also be
+zlib compressed, if offered with compress=True and agreed the same way.
+
+Leaves often run on the same machine as their node, where TCP is
+wasted effort. A listener created with local=True also binds a Unix
+domain socket at local_path(port) for every TCP location (and any
+listener binds a location given as a path string), and an uplink
+created with local=True to a local address connects through it when
+it's there, falling back to TCP when it isn't. Both kinds of
+connection behave identically otherwise. local_path()s are in a
+directory only the user can get into, so the listener and uplink must
+run as the same user for this to work.
+
 """
 
+import os
+import stat
+import atexit
 import socket
 import select
 import inspect
-import datetime
 import json
 import errno
+import re
+import struct
+import time
+import random
+import zlib
+import tempfile
+import logging
 from collections import deque
 
+from utils import default_selector, EVENT_READ
+
 class _DOWNLINK_DEAD(object):
     def __init__(self):
         pass
 
 DOWNLINK_DEAD = _DOWNLINK_DEAD()
 
+logger = logging.getLogger(__name__)
+
+# Linux's value, for Pythons whose socket module doesn't know it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# addresses an uplink may reach over a Unix domain socket instead
+LOCAL_ADDRS = ('localhost', '127.0.0.1', '::1')
+
+# directory under which each user gets a private directory for the
+# Unix domain sockets listeners bind alongside TCP
+local_root = tempfile.gettempdir()
+
+def local_dir():
+    """
+    Path of this user's private directory for local_path()s, created
+    with mode 0700 if need be. Raises OSError if it's anything but a
+    directory of ours that nobody else can get into.
+    """
+    
+    path = os.path.join(local_root, 'transport-%i' % os.getuid())
+    
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    
+    st = os.lstat(path)
+    
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+        st.st_mode & 0o077:
+        raise OSError(errno.EPERM, 'not a private directory of ours', path)
+    
+    return path
+
+def local_path(port):
+    """
+    Path of the Unix domain socket a listener on TCP port port binds,
+    and a local uplink to that port looks for
+    """
+    
+    return os.path.join(local_dir(), 'transport-%s.sock' % port)
+
+def ours(path):
+    """
+    True if path is a socket belonging to this user
+    """
+    
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+# (path, inode) of every Unix domain socket bound and not yet removed,
+# so they're removed even if their listeners aren't closed
+_bound_unix = set()
+
+def _unlink_unix(path, ino):
+    """
+    Remove the socket file we bound at path, unless something else has
+    replaced it since
+    """
+    
+    _bound_unix.discard((path, ino))
+    
+    try:
+        if os.lstat(path).st_ino == ino:
+            os.unlink(path)
+    except OSError:
+        pass
+
+@atexit.register
+def _unlink_all_unix():
+    
+    for path, ino in list(_bound_unix):
+        _unlink_unix(path, ino)
+    
+    
+# push() results when a link's send queue is at its limit. QUEUE_FULL
+# means the message was not queued, OLDEST_DROPPED that it was, at the
+# expense of older messages that hadn't been sent yet.
+
+class _QUEUE_FULL(object):
+    def __init__(self):
+        pass
+        
+QUEUE_FULL = _QUEUE_FULL()
+
+class _OLDEST_DROPPED(object):
+    def __init__(self):
+        pass
+        
+OLDEST_DROPPED = _OLDEST_DROPPED()
+
+class queue_full(Exception):
+    """
+    Raised by push() when a link's send queue is at its limit and its
+    policy is 'reject'
+    """
+    pass
+
+# obj-id of the message links use to negotiate transport features
+# with each other. Never returned from pull().
+HELLO = 'transport-hello'
+
+
+def _bytes(s):
+    """
+    Encode s for the wire if it isn't already bytes
+    """
+    
+    if isinstance(s, bytes):
+        return s
+        
+    return s.encode('utf-8')
+
+
+def _writable(sock):
+    """
+    True if sock is writable right now
+    """
+    
+    if hasattr(select, 'poll'):
+        p = select.poll()
+        p.register(sock, select.POLLOUT)
+        return len(p.poll(0)) > 0
+        
+    r,w,e = select.select([], [sock], [], 0)
+    
+    return len(w) > 0
+    
+
+def _wait_writable(sock, timeout):
+    """
+    Block until sock is writable or timeout seconds pass
+    """
+    
+    if sock == None:
+        # not connected; nothing to wait on
+        time.sleep(min(timeout, 0.05))
+        
+    elif hasattr(select, 'poll'):
+        p = select.poll()
+        p.register(sock, select.POLLOUT)
+        p.poll(int(1000 * timeout))
+    else:
+        select.select([], [sock], [], timeout)
+        
+
+def prometheus_text(snapshot, prefix='pb_link'):
+    """
+    Format a dictionary of link name -> link.metrics() (for example
+    from listener.metrics()) in the Prometheus text exposition format
+    """
+    
+    names = set()
+    
+    for m in snapshot.values():
+        names.update(m)
+        
+    lines = []
+    
+    for name in sorted(names):
+    
+        if name in _gauges:
+            metric = '%s_%s' % (prefix, name)
+            lines.append('# TYPE %s gauge' % metric)
+        else:
+            metric = '%s_%s_total' % (prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            
+        for link in sorted(snapshot):
+            
+            value = snapshot[link].get(name)
+            
+            if value == None:
+                continue
+                
+            label = str(link).replace('\\', '\\\\').replace('"', '\\"')
+            label = label.replace('\n', '\\n')
+            
+            lines.append('%s{link="%s"} %r' % (metric, label, value))
+            
+    return '\n'.join(lines) + '\n'
+    
+# link.metrics() entries that aren't running totals
+_gauges = set(['queued_bytes', 'queued_msgs', 'idle_seconds'])
+    
+
+class brace_framer(object):
+    """
+    Incremental scanner that finds complete toplevel JSON objects in a
+    recieve buffer by brace matching.
+    
+    All scanning state (brace depth, whether we're inside a JSON string,
+    and how far into the buffer we've looked) is kept between calls to
+    scan(), so each byte of the buffer is examined exactly once no
+    matter how many calls it takes for an object to arrive. Braces
+    inside JSON string values are ignored.
+    
+    The scanning itself is done by compiled regular expressions that
+    jump straight to the next brace, over any strings on the way, so
+    the python level loop runs once per brace rather than once per
+    byte.
+    """
+    
+    # frame kinds reported by scan(). Brace matched objects are always
+    # plain JSON; length prefixed frames carry their kind in their
+    # header.
+    JSON = 0
+    ZLIB = 1
+    
+    # everything up to the next brace outside of a string, skipping
+    # whole strings on the way. Stops short at the opening quote of a
+    # string that runs past the end of the buffer.
+    _skip = re.compile(
+        b'(?:[^{}"]+|"[^"\\\\]*(?:\\\\.[^"\\\\]*)*")*', re.S)
+    _string_body = re.compile(b'[^"\\\\]*(?:\\\\.[^"\\\\]*)*', re.S)
+    
+    def __init__(self):
+        
+        # index in the buffer of the next byte to look at
+        self.offset = 0
+        
+        # index in the buffer of the opening brace of the object being
+        # assembled, or None if we're between objects
+        self.start = None
+        
+        self.depth = 0
+        self.in_string = False
+        
+    def scan(self, buf):
+        """
+        Look at everything in buf past self.offset and return a list of
+        (start,end,kind) tuples for the complete toplevel objects found,
+        so that buf[start:end] is a candidate JSON object if kind is
+        JSON, or a zlib compressed one if kind is ZLIB.
+        """
+        
+        spans = []
+        
+        pos = self.offset
+        n = len(buf)
+        
+        while pos < n:
+            
+            if self.depth == 0:
+                
+                pos, more = self.between_objects(buf, pos, spans)
+                
+                if not more:
+                    break
+                
+            elif self.in_string:
+            
+                # one match runs over the rest of the string, escapes
+                # and all, stopping at the closing quote, at the end of
+                # the buffer, or at an escape split across recv() calls
+                pos = self._string_body.match(buf, pos).end()
+                
+                if buf[pos:pos+1] == b'"':
+                    self.in_string = False
+                    pos += 1
+                    
+                else:
+                    # look at the rest of the string (or the dangling
+                    # backslash) next time
+                    break
+                    
+            else:
+            
+                # one match runs over everything up to the next brace,
+                # strings and all, unless a string runs past the end of
+                # the buffer
+                pos = self._skip.match(buf, pos).end()
+                
+                if pos >= n:
+                    break
+                
+                c = buf[pos:pos+1]
+                pos += 1
+                
+                if c == b'"':
+                    self.in_string = True
+                    
+                elif c == b'{':
+                    self.depth += 1
+                    
+                else:
+                    self.depth -= 1
+                    
+                    if self.depth == 0:
+                        spans.append( (self.start,pos,self.JSON) )
+                        self.start = None
+                        
+        self.offset = pos
+        
+        return spans
+        
+    def between_objects(self, buf, pos, spans):
+        """
+        Called when scanning from pos between toplevel objects. Skip
+        anything up to the next opening brace and enter it. Returns
+        the position to continue scanning from and whether there's
+        anything more to scan.
+        """
+        
+        i = buf.find(b'{', pos)
+        
+        if i < 0:
+            return len(buf), False
+            
+        self.start = i
+        self.depth = 1
+        
+        return i+1, True
+        
+    def consumed(self):
+        """
+        Number of bytes at the front of the buffer that have been fully
+        dealt with and can be discarded.
+        """
+        
+        if self.start != None:
+            return self.start
+            
+        return self.offset
+        
+    def discard(self, nbytes):
+        """
+        Shift internal indices to account for nbytes having been removed
+        from the front of the buffer.
+        """
+        
+        self.offset -= nbytes
+        
+        if self.start != None:
+            self.start -= nbytes
+            
+    def reset(self):
+        
+        self.__init__()
+        
+
+class length_framer(brace_framer):
+    """
+    Framer that accepts both brace matched objects and length prefixed
+    frames, in any mix, so that a link can switch framing mid stream.
+    
+    A length prefixed frame is a single frame type byte followed by
+    the payload length as a 4 byte big endian unsigned integer, then
+    the payload. Frame type bytes are ASCII control characters that
+    can never appear in JSON text, which is what lets a receiver tell
+    the two framings apart at an object boundary. Length prefixed
+    frames are sliced straight out of the buffer without looking at
+    their contents.
+    """
+    
+    header = struct.Struct('!BI')
+    
+    _boundary = re.compile(b'[{\\x00-\\x08]')
+    
+    def between_objects(self, buf, pos, spans):
+        
+        n = len(buf)
+        hsize = self.header.size
+        
+        while pos < n:
+        
+            kind = ord(buf[pos:pos+1])
+            
+            if kind > 8:
+                # not a frame header; find the next brace or header
+                
+                m = self._boundary.search(buf, pos)
+                
+                if m == None:
+                    return n, False
+                    
+                pos = m.start()
+                
+                if buf[pos:pos+1] == b'{':
+                    return brace_framer.between_objects(self, buf, pos,
+                        spans)
+                
+                continue
+                
+            if n - pos < hsize:
+                return pos, False
+            
+            kind, size = self.header.unpack_from(buf, pos)
+            
+            if n - pos - hsize < size:
+                # wait for the rest of the frame, but don't look at any
+                # of it in the meantime
+                return pos, False
+                
+            if kind <= self.ZLIB:
+                spans.append( (pos+hsize, pos+hsize+size, kind) )
+                
+            pos += hsize + size
+            
+        return pos, False
+        
 
 class link(object):
     
+    # bytes to ask for per recv() call
+    recv_size = 65536
+    
+    # most bytes to read per pull(), so that one busy peer can't keep a
+    # server from getting around to the others
+    recv_budget = 1048576
+    
+    # don't bother compacting queues smaller than this
+    compact_size = 65536
+    
+    # most buffers to hand to a single sendmsg() call
+    iov_max = 1024
+    
+    # messages shorter than this aren't worth compressing
+    compress_threshold = 512
+    compress_level = 6
+    
+    # how messages are turned into bytes and back again; both ends of
+    # a link have to agree
+    dumps = staticmethod(json.dumps)
+    loads = staticmethod(json.loads)
+    
     def __init__(self):
         
         # Reference to containing object. This is a convenience that
@@ -84,29 +541,151 @@ class link(object):
         
         self.socket = None
         
-        # strings are immutable and therefore not the most efficient way
-        # to store send and recieve queues, but they are convenient
-        self.rq = ''
-        self.sq = ''
+        # listener this link is registered with, if any
+        self.listener = None
+        
+        # Send and recieve queues. Bytes are only ever appended to the
+        # back of these; the front is tracked by a cursor (self.sq_pos,
+        # or self.framer.consumed() for self.rq) and only physically
+        # removed once it's at least half the buffer, so partial sends
+        # and recieves don't copy the whole queue.
+        self.rq = bytearray()
+        self.sq = bytearray()
+        self.sq_pos = 0
+        
+        # preallocated buffer for socket.recv_into()
+        self.rbuf = bytearray(self.recv_size)
+        
+        # incremental JSON object scanner over self.rq. Understands
+        # either framing, whatever we've agreed to send.
+        self.framer = length_framer()
+        
+        # framing used for outgoing messages, 'brace' or 'length'.
+        # Always starts out as 'brace', which every peer understands.
+        self.framing = 'brace'
+        
+        # compression used for outgoing messages of at least
+        # compress_threshold bytes, None or 'zlib'. Needs length
+        # prefixed framing.
+        self.compress = None
+        
+        # [nbytes, greeting] pair for every frame in self.sq, in order,
+        # where greeting is True for frames sent automatically on
+        # connect. The first frame may have been partially sent.
+        self.sq_frames = deque()
+        self.sq_partial = False
+        
+        # frames held back by cork() or push_many(), to be sent after
+        # the send queue
+        self.gather = []
+        self.gather_bytes = 0
+        
+        self.corked = False
+        self.max_delay = None
+        
+        # time the first frame in self.gather was held back
+        self.cork_time = None
         
-        # circular buffer of (utc datetime object, function name,
-        # err message) tuples
+        # Running totals, cheap enough to keep unconditionally. See
+        # metrics() for what they mean. msgs_out/send_calls is the
+        # average number of messages per system call.
+        self.stats = {
+            'send_calls': 0,
+            'msgs_out': 0,
+            'bytes_out': 0,
+            'msgs_in': 0,
+            'bytes_in': 0,
+            'parse_errors': 0,
+            'would_block': 0,
+            'errors': 0,
+            'dropped': 0,
+            'rejected': 0,
+            
+            # bytes of messages considered for compression, and what
+            # they were sent as
+            'zlib_in': 0,
+            'zlib_out': 0,
+            }
+            
+        # send queue limits; see limit()
+        self.max_bytes = None
+        self.max_msgs = None
+        self.policy = 'drop-oldest'
+        self.block_timeout = 1.0
+        
+        # time.time() of the last time we sent or recieved anything
+        self.last_activity = time.time()
+        
+        # name to report metrics under
+        self.name = None
+        
+        # circular buffer of (unix time, err message) tuples
         self.errors = deque([],maxlen=512)        
         
     def log(self,msg):
         """
-        Record a message, current utc time, and name of the caller in
-        self.errors
+        Record an error message and the current time in self.errors.
+        With debug logging enabled for this module, also log it along
+        with the name of the caller.
+        """
+        
+        self.stats['errors'] += 1
+        self.errors.append( (time.time(),msg) )
+        
+        if logger.isEnabledFor(logging.DEBUG):
+        
+            # May return None if not CPython
+            frame = inspect.currentframe()
+            
+            if frame != None:
+                fname = frame.f_back.f_code.co_name
+            else:
+                fname = 'no stack frame support'
+                
+            logger.debug('%s %s: %r', self.name, fname, msg)
+            
+    def would_block(self, e):
+        """
+        True, and counted, if socket.error e just means the socket
+        isn't ready
         """
         
-        t = datetime.datetime.utcnow()
+        if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+            self.stats['would_block'] += 1
+            return True
+            
+        return False
         
-        # May return None if not CPython
-        fname = inspect.currentframe().f_back.f_code.co_name
+    def metrics(self):
+        """
+        Return a snapshot of this link's counters as a dictionary:
+        
+            send_calls      system calls made to send
+            msgs_out        messages sent
+            bytes_out       bytes sent
+            msgs_in         messages recieved
+            bytes_in        bytes recieved
+            parse_errors    frames recieved that weren't valid JSON
+            would_block     socket operations that would have blocked
+            errors          other errors; see self.errors
+            dropped         messages dropped by the queue policy
+            rejected        messages rejected by the queue policy
+            zlib_in         bytes of messages considered for compression
+            zlib_out        bytes they were sent as
+            queued_bytes    bytes waiting to be sent
+            queued_msgs     messages waiting to be sent
+            idle_seconds    time since anything was sent or recieved
+            
+        plus whatever subclasses add.
+        """
         
-        if fname == None: fname='no stack frame support'
+        out = dict(self.stats)
         
-        self.errors.append( (t,fname,msg) )
+        out['queued_bytes'] = self.queued_bytes()
+        out['queued_msgs'] = self.queued_msgs()
+        out['idle_seconds'] = time.time() - self.last_activity
+        
+        return out
         
         
     def socket_status(self):
@@ -120,8 +699,14 @@ class link(object):
             
     def close(self):
         
-        if self.socket_status():
+        if self.listener != None:
+            self.listener.unregister(self)
+        
+        try:
             self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # wasn't connected
+            pass
         
         self.socket.close()
             
@@ -135,61 +720,549 @@ class link(object):
         """
         Add msg to send buffer and attempt to send() all of it. Returns
         the number of bytes send()'ed or an error object.
+        
+        If the link is corked, msg is instead held back until flush()
+        is called or the cork's max_delay runs out, and 0 is returned.
+        """
+        
+        frame = self.encode(_bytes(self.dumps(msg)))
+        
+        status = self.admit(len(frame))
+        
+        if status is QUEUE_FULL:
+            return status
+        
+        if not self.corked:
+            self.ungather()
+            self.enqueue(frame)
+            ret = self.send()  
+            
+        else:
+            self.gather_frame(frame)
+        
+            if self.flush_due(time.time()):
+                ret = self.flush()
+            else:
+                ret = 0
+                
+        if status is OLDEST_DROPPED and ret is not DOWNLINK_DEAD:
+            return status
+            
+        return ret
+        
+    def push_many(self, msgs):
+        """
+        Queue every message in msgs and send() them all with as few
+        system calls as possible. Returns the same as push(), except
+        that QUEUE_FULL means at least one message wasn't queued.
+        """
+        
+        full = False
+        
+        for msg in msgs:
+        
+            frame = self.encode(_bytes(self.dumps(msg)))
+            
+            if self.admit(len(frame)) is QUEUE_FULL:
+                full = True
+                continue
+                
+            self.gather_frame(frame)
+            
+        ret = self.flush()
+        
+        if full and ret is not DOWNLINK_DEAD:
+            return QUEUE_FULL
+            
+        return ret
+        
+    def limit(self, max_bytes=None, max_msgs=None, policy='drop-oldest',
+                timeout=1.0):
+        """
+        Bound the send queue.
+        
+        @max_bytes:
+            most bytes to hold in the send queue, or None
+            
+        @max_msgs:
+            most messages to hold in the send queue, or None
+        
+        @policy:
+            what push() does with a message that would take the queue
+            over a limit:
+            
+            'block'         send() until there's room, giving up after
+                            timeout seconds and returning QUEUE_FULL
+            'drop-oldest'   drop unsent messages from the front of the
+                            queue to make room and return OLDEST_DROPPED
+            'drop-newest'   don't queue the message; return QUEUE_FULL
+            'reject'        raise queue_full
+                            
+            A message that can't fit even in an empty queue is never
+            queued.
+        """
+        
+        if not policy in ('block', 'drop-oldest', 'drop-newest',
+                'reject'):
+            raise ValueError('unknown queue policy %r' % (policy,))
+        
+        self.max_bytes = max_bytes
+        self.max_msgs = max_msgs
+        self.policy = policy
+        self.block_timeout = timeout
+        
+    def queued_bytes(self):
+        """
+        Number of bytes waiting to be sent
+        """
+        
+        return len(self.sq) - self.sq_pos + self.gather_bytes
+        
+    def queued_msgs(self):
+        """
+        Number of messages (including partially sent ones) waiting to
+        be sent
+        """
+        
+        return len(self.sq_frames) + len(self.gather)
+        
+    def fits(self, nbytes):
+        """
+        True if a frame of nbytes can be queued without going over the
+        send queue limits
+        """
+        
+        if self.max_bytes != None and \
+                self.queued_bytes() + nbytes > self.max_bytes:
+            return False
+            
+        if self.max_msgs != None and \
+                self.queued_msgs() + 1 > self.max_msgs:
+            return False
+            
+        return True
+        
+    def admit(self, nbytes):
+        """
+        Apply the queue policy to a new frame of nbytes. Returns None
+        if it can be queued, or QUEUE_FULL or OLDEST_DROPPED as
+        described in limit().
+        """
+        
+        if self.fits(nbytes):
+            return None
+            
+        if self.policy == 'reject':
+            self.stats['rejected'] += 1
+            raise queue_full('%i bytes, %i messages queued' % \
+                (self.queued_bytes(), self.queued_msgs()))
+                
+        if self.policy == 'drop-oldest':
+        
+            self.drop_oldest(nbytes)
+            
+            if self.fits(nbytes):
+                return OLDEST_DROPPED
+        
+        elif self.policy == 'block':
+        
+            deadline = time.time() + self.block_timeout
+            
+            while True:
+                
+                if self.send() is DOWNLINK_DEAD:
+                    break
+                
+                if self.fits(nbytes):
+                    return None
+                    
+                remaining = deadline - time.time()
+                
+                if remaining <= 0:
+                    break
+                    
+                _wait_writable(self.socket, remaining)
+                
+        self.stats['dropped'] += 1
+        
+        return QUEUE_FULL
+        
+    def drop_oldest(self, nbytes):
+        """
+        Drop the oldest unsent messages from the send queue until a
+        frame of nbytes would fit. Partially sent frames and connection
+        greetings are never dropped.
+        """
+        
+        self.ungather()
+        
+        frames = self.sq_frames
+        
+        need_bytes = need_msgs = 0
+        
+        if self.max_bytes != None:
+            need_bytes = self.queued_bytes() + nbytes - self.max_bytes
+        if self.max_msgs != None:
+            need_msgs = self.queued_msgs() + 1 - self.max_msgs
+            
+        keep = []
+        start = self.sq_pos
+        
+        while frames and (frames[0][1] or (not keep and self.sq_partial)):
+            frame = frames.popleft()
+            keep.append(frame)
+            start += frame[0]
+            
+        end = start
+            
+        while frames and not frames[0][1] and \
+                (need_bytes > 0 or need_msgs > 0):
+            
+            frame = frames.popleft()
+            end += frame[0]
+            need_bytes -= frame[0]
+            need_msgs -= 1
+            self.stats['dropped'] += 1
+            
+        del self.sq[start:end]
+        frames.extendleft(reversed(keep))
+        
+    def flush(self):
+        """
+        send() everything queued, including messages held back by a
+        cork
+        """
+        
+        self.cork_time = None
+        
+        return self.send()
+        
+    def cork(self, max_delay=None):
+        """
+        Hold back push()'ed messages so bursts go out in a single system
+        call. If max_delay is not None, messages are flushed by the next
+        push() (or listener.select()) at least max_delay seconds after
+        the first one held back.
+        """
+        
+        self.corked = True
+        self.max_delay = max_delay
+        
+    def uncork(self):
+        """
+        Stop holding back messages and flush() the ones we have
+        """
+        
+        self.corked = False
+        self.max_delay = None
+        
+        return self.flush()
+        
+    def flush_due(self, t):
+        """
+        True if held back messages should be flushed at time t
+        """
+        
+        return self.cork_time != None and self.max_delay != None and \
+            t - self.cork_time >= self.max_delay
+        
+    def gather_frame(self, frame):
+        """
+        Hold a frame back for the next transmit()
+        """
+        
+        if not self.gather:
+        
+            self.cork_time = time.time()
+            
+            if self.listener != None and self.max_delay != None:
+                self.listener.corked.add(self)
+        
+        self.gather.append(frame)
+        self.gather_bytes += len(frame)
+        
+    def ungather(self):
         """
+        Move held back frames to the send queue
+        """
+        
+        for frame in self.gather:
+            self.enqueue(frame)
+            
+        self.gather = []
+        self.gather_bytes = 0
+        
+    def transmit(self):
+        """
+        send() as much of the send queue and any held back frames as the
+        socket will take, in a single system call. Held back frames are
+        handed to the kernel directly with sendmsg() where available,
+        rather than first being copied into the send queue. Returns the
+        number of bytes sent.
+        """
+        
+        gather = self.gather
+        
+        if not gather or not hasattr(self.socket, 'sendmsg'):
+            self.ungather()
+            nbytes = self.socket.send(self.unsent())
+            self.consume(nbytes)
+            self.stats['send_calls'] += 1
+            return nbytes
+            
+        self.gather = []
+        self.gather_bytes = 0
+        
+        bufs = gather[:self.iov_max-1]
+        queued = len(self.sq) - self.sq_pos
+        
+        if queued:
+            bufs.insert(0, self.unsent())
+        
+        try:
+            nbytes = self.socket.sendmsg(bufs)
+        except socket.error:
+            del bufs[:]
+            self.gather = gather
+            self.ungather()
+            raise
+        
+        # the send queue can't be resized while a view of it is around
+        del bufs[:]
+        
+        self.stats['send_calls'] += 1
+        
+        if nbytes:
+            self.last_activity = time.time()
+        
+        sent = min(nbytes, queued)
+        self.consume(sent)
+        sent = nbytes - sent
+        
+        for frame in gather:
+            
+            if sent >= len(frame):
+                sent -= len(frame)
+                self.stats['msgs_out'] += 1
+                self.stats['bytes_out'] += len(frame)
+                continue
+                
+            self.enqueue(frame)
+            
+            if sent:
+                self.consume(sent)
+                sent = 0
+                
+        return nbytes
+        
+    def encode(self, payload):
+        """
+        Frame a serialized JSON object according to self.framing,
+        compressing it if agreed and worthwhile
+        """
+        
+        if self.framing != 'length':
+            return payload
+            
+        kind = self.framer.JSON
+            
+        if self.compress == 'zlib' and \
+                len(payload) >= self.compress_threshold:
+            
+            data = zlib.compress(payload, self.compress_level)
+            
+            self.stats['zlib_in'] += len(payload)
+            self.stats['zlib_out'] += min(len(data), len(payload))
+            
+            if len(data) < len(payload):
+                kind = self.framer.ZLIB
+                payload = data
+            
+        header = self.framer.header.pack(kind, len(payload))
+        
+        return header + payload
+        
+    def compression_ratio(self):
+        """
+        Compressed size over original size for every message considered
+        for compression so far, or None if there haven't been any
+        """
+        
+        if not self.stats['zlib_in']:
+            return None
+            
+        return float(self.stats['zlib_out']) / self.stats['zlib_in']
+        
+    def enqueue(self, frame, greeting=False):
+        """
+        Add a complete frame to the back of the send queue
+        """
+        
+        self.sq += frame
+        self.sq_frames.append([len(frame), greeting])
+        
+    def unsent(self):
+        """
+        memoryview of everything in the send queue not yet send()'ed
+        """
+        
+        return memoryview(self.sq)[self.sq_pos:]
+        
+    def consume(self, nbytes):
+        """
+        Remove nbytes that have been send()'ed from the front of the
+        send queue
+        """
+        
+        self.sq_pos += nbytes
+        self.stats['bytes_out'] += nbytes
+        
+        if nbytes:
+            self.last_activity = time.time()
         
-        self.sq += json.dumps(msg)
-        return self.send()  
+        if self.sq_pos == len(self.sq):
+            del self.sq[:]
+            self.sq_pos = 0
+            
+        elif self.sq_pos > self.compact_size and \
+                2*self.sq_pos > len(self.sq):
+            del self.sq[:self.sq_pos]
+            self.sq_pos = 0
+        
+        while nbytes:
+        
+            frame = self.sq_frames[0]
+            
+            if nbytes < frame[0]:
+                frame[0] -= nbytes
+                self.sq_partial = True
+                break
+                
+            nbytes -= frame[0]
+            self.sq_frames.popleft()
+            self.sq_partial = False
+            self.stats['msgs_out'] += 1
+            
+    def hello(self, msg):
+        """
+        Handle a HELLO message from our peer. Subclasses decide what to
+        do about it.
+        """
+        pass
+        
+    def answer_offer(self, msg):
+        """
+        Given a HELLO offering transport features, return the HELLO
+        reply agreeing to those we understand, or None if there are
+        none. The reply should be sent before calling use_features()
+        with it.
+        """
+        
+        reply = {}
+        
+        if 'length' in msg.get('framing', []):
+            
+            reply['framing'] = 'length'
+            
+            # compressed frames need length prefixed framing
+            if 'zlib' in msg.get('compress', []):
+                reply['compress'] = 'zlib'
+                
+        if not reply:
+            return None
+            
+        reply['obj-id'] = HELLO
+        
+        return reply
+        
+    def use_features(self, agreed):
+        """
+        Start using the transport features in a HELLO reply
+        """
+        
+        if agreed.get('framing') == 'length':
+            self.framing = 'length'
+            
+            if agreed.get('compress') == 'zlib':
+                self.compress = 'zlib'
     
     def pull(self):
         """
         recv() data and return a list of JSON objects subsequently found
         in the recieve buffer. Purges the recieve buffer through the
-        last JSON object found
+        last JSON object found. Only newly recieved data is scanned, so
+        a large object trickling in over many calls costs the same as
+        one arriving all at once.
         """
         # update the recieve buffer        
         self.recv()
         
-        # look for json objects in the recieve buffer
+        return self.unpack()
+        
+    def unpack(self):
+        """
+        Return a list of the JSON objects found in the recieve buffer
+        since the last call, handling any HELLO messages along the way
+        """
         
         objs = []
-        stack = [None]
-    
-        cursor = 0
-        end = None
-    
-        for i,c in enumerate(self.rq):
         
-            if c == '{' or c == '}':
-            
-                stack.append(c)
+        spans = self.framer.scan(self.rq)
+        view = memoryview(self.rq)
+        
+        for start,end,kind in spans:
             
-                if stack[-2] == '{' and stack[-1] == '}':
-                    # matching braces found
+            try:
+                data = view[start:end].tobytes()
+                
+                if kind == self.framer.ZLIB:
+                    data = zlib.decompress(data)
                     
-                    if len(stack) == 3:
-                        # matching braces are outer
-                        
-                        candidate = self.rq[cursor:i+1]
-                        
-                        try:
-                            objs.append(json.loads(candidate))
-                        except:
-                            pass
-                        
-                        end = i+1
-                        cursor = i+1
+                obj = self.loads(data)
+                
+            except (ValueError, zlib.error) as e:
+                self.stats['parse_errors'] += 1
+                self.log(e.args)
+                continue
                 
-                    stack.pop()
-                    stack.pop()
+            self.stats['msgs_in'] += 1
+                
+            if obj.get('obj-id') == HELLO:
+                self.hello(obj)
+            else:
+                objs.append(obj)
+                
+        del view
+        
+        # Everything before the start of the object currently being
+        # assembled, or everything we've looked at if we're between
+        # objects, is done with. Clear it out when it's worth it.
+        
+        consumed = self.framer.consumed()
+        
+        if consumed == len(self.rq) or (consumed > self.compact_size \
+                and 2*consumed > len(self.rq)):
+            del self.rq[:consumed]
+            self.framer.discard(consumed)
+            
+        return objs
+            
+    def recv_once(self):
+        """
+        recv() once into the preallocated buffer and append what we got
+        to the recieve queue. Returns the number of bytes recieved, 0
+        meaning the peer closed the connection.
+        """
+        
+        nbytes = self.socket.recv_into(self.rbuf)
+        self.rq += memoryview(self.rbuf)[:nbytes]
+        self.stats['bytes_in'] += nbytes
+        
+        if nbytes:
+            self.last_activity = time.time()
         
-        # clear the recieve buffer up to the end of the last object
-        # just found
+        return nbytes
         
-        if end != None:
-            self.rq = self.rq[end:]
-            
-        return objs
-            
     def recv(self):
         """
         Just here as a reminder that subclasses must implement this
@@ -207,12 +1280,58 @@ class uplink(link):
     Wrap a nonblocking TCP socket intended to connect() to a host.
     Uplinks are uniquely repsonsible for reconnecting and will always
     seek to reestablish a lost connection.
+    
+    Connecting never blocks. An uplink is always in one of the states
+    'disconnected', 'connecting' (a nonblocking connect() is in
+    progress) or 'connected', and every send() or recv() moves things
+    along as far as they'll go without waiting. Failed attempts are
+    retried with exponential backoff and jitter, so a restarting node
+    isn't hammered by its leaves, and the total rate of attempts is
+    capped by a retry budget. Messages pushed in the meantime are
+    queued.
     """
     
-    def __init__(self,addr,port,connect_msg=''):
+    # seconds to wait after the first failed attempt; doubles with
+    # every further failure up to backoff_max
+    backoff_base = 0.1
+    backoff_max = 30.0
+    
+    # seconds to wait for a nonblocking connect() to finish
+    connect_timeout = 10.0
+    
+    def __init__(self,addr,port,connect_msg='',framing='brace',
+                    compress=False, retry_budget=(20,60.0), local=False):
         """
+        @addr, @port:
+            Where to connect. If port is None, addr is the path of a
+            Unix domain socket.
+            
         @connect_msg:
             Message to automatically send() on connect or reconnect
+            
+        @framing:
+            'brace' or 'length'. If 'length', offer length prefixed
+            framing to the downlink on every connect. It's only used
+            once the downlink agrees, so it's safe to ask a downlink
+            that doesn't know about it.
+            
+        @compress:
+            If True, also offer zlib compression of messages of at
+            least compress_threshold bytes, which trades some CPU for
+            bandwidth on slow links. Implies framing='length'.
+            
+        @retry_budget:
+            (attempts, seconds) tuple: make no more than this many
+            connection attempts in any period of this many seconds,
+            whatever the backoff says. This keeps a connection that
+            keeps dropping as soon as it's made from turning into a
+            reconnect storm. None for no limit.
+            
+        @local:
+            If True and addr is one of LOCAL_ADDRS, connect through the
+            listener's Unix domain socket at local_path(port) if there
+            is one of ours, which costs less per message than loopback
+            TCP.
         """
         
         link.__init__(self)
@@ -220,43 +1339,290 @@ class uplink(link):
         self.addr=addr
         self.port=port
         
+        # Unix domain socket path to try before TCP, if any
+        self.path = None
+        
+        if port == None:
+            self.path = addr
+        elif local and addr in LOCAL_ADDRS:
+            try:
+                self.path = local_path(port)
+            except OSError as e:
+                logger.warning('not connecting locally: %s', e)
+            
+        # True while the current attempt is over the Unix socket
+        self.unix = False
+        
+        self.state = 'disconnected'
+        
+        # consecutive failed connection attempts
+        self.failures = 0
+        
+        # time before which we won't start another attempt
+        self.next_attempt = 0
+        
+        # time the attempt in progress started
+        self.attempt_started = None
+        
+        self.retry_budget = retry_budget
+        
+        # start times of recent attempts, for the retry budget
+        self.attempts = deque()
+        
+        self.stats['connect_attempts'] = 0
+        self.stats['reconnects'] = 0
+        
+        if port == None:
+            self.name = addr
+        else:
+            self.name = '%s:%s' % (addr, port)
+        
         if isinstance(connect_msg, dict):
-            self.connect_msg = json.dumps(connect_msg)
+            self.connect_msg = _bytes(json.dumps(connect_msg))
         else:
-            self.connect_msg = connect_msg
+            self.connect_msg = _bytes(connect_msg)
+            
+        self.offer = {}
+        
+        if framing != 'brace' or compress:
+            self.offer['framing'] = ['length']
+            
+        if compress:
+            self.offer['compress'] = ['zlib']
         
         self.connect()
         
     def connect(self):
+        """
+        Start a new connection attempt now, regardless of backoff,
+        abandoning any existing connection
+        """
         
         if self.socket != None:
             self.close()
+            
+        # Use the Unix socket if there is one, except straight after it
+        # failed us, so a stale socket file left by a listener that's
+        # been replaced by a TCP-only one doesn't lock us out for good
+        retry_tcp = self.unix and self.failures and self.port != None
+        
+        self.unix = self.path != None and not retry_tcp and \
+            (self.port == None or ours(self.path))
         
-        self.socket = socket.socket(socket.AF_INET,
+        if self.unix:
+            self.socket = socket.socket(socket.AF_UNIX,
                 socket.SOCK_STREAM)
+            where = self.path
+        else:
+            self.socket = socket.socket(socket.AF_INET,
+                socket.SOCK_STREAM)
+            where = (self.addr, self.port)
+            
         self.socket.settimeout(0.0)
+        
+        # whatever partial object we had belongs to the old connection
+        del self.rq[:]
+        self.framer.reset()
+        
+        self.requeue()
+        
+        if self.listener != None:
+            self.listener.register(self)
+            
+        t = time.time()
+        
+        self.attempt_started = t
+        self.attempts.append(t)
+        self.stats['connect_attempts'] += 1
+        
+        err = self.socket.connect_ex(where)
+        
+        # for a Unix socket, EAGAIN means the listen backlog is full
+        # and nothing is in progress
+        if self.unix:
+            pending = (errno.EINPROGRESS,)
+        else:
+            pending = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+        
+        if err == 0:
+            self.connected()
+            
+        elif err in pending:
+            self.state = 'connecting'
+            
+        else:
+            self.log(err)
+            self.failed()
+            
+    def connected(self):
+        
+        if self.stats['connect_attempts'] > 1:
+            self.stats['reconnects'] += 1
+        
+        self.state = 'connected'
+        self.failures = 0
+        self.attempt_started = None
+        
+    def failed(self):
+        """
+        Give up on the current connection (attempt) and schedule the
+        next one
+        """
+        
+        self.close()
+        
+        delay = min(self.backoff_max, self.backoff_base * 2**self.failures)
+        
+        # somewhere between half and all of the full delay, so a fleet
+        # of leaves that lost their node at the same moment don't all
+        # come back at the same moment
+        delay *= 0.5 + 0.5*random.random()
+        
+        self.failures += 1
+        self.next_attempt = time.time() + delay
+        
+    def close(self):
+        
+        if self.socket != None:
+            link.close(self)
+            
+        self.state = 'disconnected'
+        self.attempt_started = None
+        
+    def within_budget(self, t):
+        """
+        True if another connection attempt at time t would stay within
+        the retry budget
+        """
+        
+        if self.retry_budget == None:
+            return True
+            
+        attempts, period = self.retry_budget
+        
+        while self.attempts and self.attempts[0] <= t - period:
+            self.attempts.popleft()
+            
+        return len(self.attempts) < attempts
+        
+    def poll_connect(self):
+        """
+        Advance the connection state machine without blocking. Returns
+        True if connected.
+        """
+        
+        if self.state == 'connected':
+            return True
+            
+        t = time.time()
+            
+        if self.state == 'connecting':
+            
+            if _writable(self.socket):
                 
-        try:
-            self.socket.connect( (self.addr,self.port) )
+                err = self.socket.getsockopt(socket.SOL_SOCKET,
+                    socket.SO_ERROR)
+                
+                if err == 0:
+                    self.connected()
+                    return True
+                    
+                self.log(err)
+                self.failed()
+                
+            elif t - self.attempt_started > self.connect_timeout:
+                self.log('connect timed out')
+                self.failed()
+                
+            return False
+            
+        if t >= self.next_attempt and self.within_budget(t):
+            self.connect()
+            
+        return self.state == 'connected'
+            
+    def requeue(self):
+        """
+        Prepare the send queue for a new connection. A partially sent
+        frame is useless to the new peer and is dropped, as is any
+        unsent greeting from the last connection attempt. Everything
+        else is rewritten in brace framing, since we don't know what the
+        new peer understands yet, and a fresh greeting is put in front.
+        """
+        
+        self.ungather()
+        
+        old = self.sq
+        first = pos = self.sq_pos
+        partial = self.sq_partial
+        frames = self.sq_frames
+        
+        self.sq = bytearray()
+        self.sq_pos = 0
+        self.sq_frames = deque()
+        self.sq_partial = False
+        self.framing = 'brace'
+        self.compress = None
+        
+        if self.offer:
+            msg = dict(self.offer)
+            msg['obj-id'] = HELLO
+            self.enqueue(_bytes(json.dumps(msg)), greeting=True)
+        
+        if self.connect_msg:
+            self.enqueue(self.connect_msg, greeting=True)
+        
+        hsize = self.framer.header.size
+        
+        for nbytes, greeting in frames:
+        
+            start = pos
+            pos += nbytes
             
-            if not self.connect_msg in self.sq:
-                self.sq += self.connect_msg
+            if greeting or (start == first and partial):
+                continue
                 
-        except socket.error as e:
-            self.log(e.args)
+            kind = old[start]
+            
+            if kind > 8:
+                self.enqueue(old[start:pos])
+            elif kind == self.framer.ZLIB:
+                self.enqueue(zlib.decompress(bytes(old[start+hsize:pos])))
+            else:
+                self.enqueue(old[start+hsize:pos])
+            
+    def hello(self, msg):
+        """
+        Use whatever the downlink agreed to, provided we offered it
+        """
+        
+        if msg.get('framing') in self.offer.get('framing', []):
+        
+            if not msg.get('compress') in self.offer.get('compress', []):
+                msg.pop('compress', None)
+                
+            self.use_features(msg)
                    
     def send(self):
+        """
+        send() as much of the queue as possible if connected. Returns 0
+        while not connected; everything stays queued for when we are.
+        """
         
-        if self.socket_status() == False:
-            self.connect()
+        if not self.poll_connect():
+            return 0
         
         nbytes = None
         
         try:
-            nbytes = self.socket.send(self.sq)
-            self.sq = self.sq[nbytes:]
+            nbytes = self.transmit()
         except socket.error as e:
-            self.log(e.args)
+            
+            if self.would_block(e):
+                nbytes = 0
+            else:
+                self.log(e.args)
+                self.failed()
         
         return nbytes
         
@@ -264,22 +1630,27 @@ class uplink(link):
         
         nbytes = 0
         
-        if self.socket_status() != True:
-            self.connect()
+        if not self.poll_connect():
+            return nbytes
             
-        while True:
+        while nbytes < self.recv_budget:
             
             try:
-                ret = self.socket.recv(4096)
-                self.rq += ret
-                nbytes += len(ret)
+                ret = self.recv_once()
+                nbytes += ret
                 
-                if ret == '':
-                    self.close()
+                if ret == 0:
+                    # closed by the other end; reconnect, but not
+                    # immediately
+                    self.failed()
                     break
                     
             except socket.error as e:
-                self.log(e.args)
+                
+                if not self.would_block(e):
+                    self.log(e.args)
+                    self.failed()
+                    
                 break
         
         return nbytes
@@ -297,25 +1668,54 @@ class downlink(link):
         self.socket = sock
         self.socket.settimeout(0.0)
         
+        try:
+            peer = sock.getpeername()
+            
+            if isinstance(peer, tuple):
+                self.name = '%s:%s' % peer[:2]
+            else:
+                # Unix domain socket peers are usually anonymous
+                self.name = 'unix:%s:%i' % (sock.getsockname(),
+                    sock.fileno())
+                
+        except socket.error:
+            pass
+        
+    def hello(self, msg):
+        """
+        Agree to whatever transport features offered we understand, and
+        start using them once our reply is queued.
+        """
+        
+        reply = self.answer_offer(msg)
+        
+        if reply != None:
+            self.enqueue(self.encode(_bytes(json.dumps(reply))))
+            self.use_features(reply)
+            self.send()
+        
     def recv(self):
         
+        if self.socket == None:
+            # closed already
+            return DOWNLINK_DEAD
+            
         nbytes = 0
         
-        while True:
+        while nbytes < self.recv_budget:
             
             try:
-                ret = self.socket.recv(4096)
-                self.rq += ret
-                nbytes += len(ret)
+                ret = self.recv_once()
+                nbytes += ret
                 
-                if ret == '':
+                if ret == 0:
                     self.close()
                     break
                 
             except socket.error as e:
-                self.log(e.args)
                 
-                if e.errno != errno.EWOULDBLOCK:
+                if not self.would_block(e):
+                    self.log(e.args)
                     nbytes = DOWNLINK_DEAD
                 
                 break
@@ -325,15 +1725,21 @@ class downlink(link):
 
     def send(self):
         
+        if self.socket == None:
+            return DOWNLINK_DEAD
+            
         nbytes = None
         
         try:
-            nbytes = self.socket.send(self.sq)
-            self.sq = self.sq[nbytes:]
+            nbytes = self.transmit()
         except socket.error as e:
             
-            self.log(e.args)
-            nbytes = DOWNLINK_DEAD
+            if self.would_block(e):
+                # socket buffer's full; not a problem with the link
+                nbytes = 0
+            else:
+                self.log(e.args)
+                nbytes = DOWNLINK_DEAD
             
         return nbytes
             
@@ -341,65 +1747,334 @@ class downlink(link):
 class listener(object):
     """
     Wrap a nonblocking TCP socket intended to bind() and listen()
+    
+    If local is True, each TCP location also gets a Unix domain socket
+    at local_path(port) for uplinks on the same machine run by the same
+    user.
+    
+    Bound sockets and links are registered with a selector (epoll on
+    Linux) once, rather than handed to select.select() on every call, so
+    the number of links isn't limited by FD_SETSIZE and the cost of
+    select() depends on the number of ready links, not the total.
     """
     
-    def __init__(self, locations):
+    def __init__(self, locations, queue_limits=None, local=False,
+                    reuse_port=False):
         """
         
         @locations:
-            a list of (addr,port) tuples to bind to
+            a list of (addr,port) tuples to bind to, or strings giving
+            the paths of Unix domain sockets to bind to
+            
+        @queue_limits:
+            dictionary of keyword arguments to link.limit() for every
+            new downlink, or None for unbounded send queues
+            
+        @local:
+            If True, bind local_path(port) for every TCP location too
+            
+        @reuse_port:
+            If True, set SO_REUSEPORT on TCP sockets, so several
+            listeners in different processes can bind the same
+            locations and have the kernel share connections out
+            between them
         
         """
         
         self.locations = locations
+        self.queue_limits = queue_limits
+        
+        self.selector = default_selector()
         
         self.bound_sockets = []
         
+        # (path, inode) of bound Unix domain sockets, to remove on the
+        # way out
+        self.bound_paths = []
+        
+        # registered link objects, mapped to the socket they were
+        # registered with
+        self.links = {}
+        
+        # registered links holding back messages with a max_delay
+        self.corked = set()
+        
+        # the last list given to watch(), and its length then
+        self.watched = None
+        self.watched_len = 0
+        
+        ports = []
+        
         for addr__port in locations:
+            
+            if not isinstance(addr__port, tuple):
+                self.bind_unix(addr__port)
+                continue
+                
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.settimeout(0.0)
+            
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+                
             sock.bind(addr__port) #bind() expects an (addr,port) tuple
-            sock.listen(5)
+            sock.listen(socket.SOMAXCONN)
             self.bound_sockets.append(sock)
+            self.selector.register(sock, EVENT_READ, None)
+            
+            # the real port, if we were asked for any free one
+            port = sock.getsockname()[1]
+            
+            if local and port not in ports:
+                ports.append(port)
+                
+                try:
+                    self.bind_unix(local_path(port))
+                except (socket.error, OSError) as e:
+                    # uplinks will just have to use TCP
+                    logger.warning('not listening locally: %s', e)
+    
+    def bind_unix(self, path):
+        """
+        Bind and listen on a Unix domain socket at path, replacing a
+        stale socket file of ours left behind by a listener that died
+        """
+        
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        
+        try:
+            if os.path.lexists(path):
+            
+                if not ours(path):
+                    raise OSError(errno.EPERM,
+                        'not a socket of ours', path)
+                
+                # only take the path over if nobody's listening there
+                if sock.connect_ex(path) == 0:
+                    raise socket.error(errno.EADDRINUSE,
+                        '%s is in use' % path)
+                        
+                sock.close()
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                os.unlink(path)
+                
+            sock.bind(path)
+            sock.listen(socket.SOMAXCONN)
+            
+        except (socket.error, OSError):
+            sock.close()
+            raise
+            
+        sock.settimeout(0.0)
+        self.bound_sockets.append(sock)
+        
+        bound = (path, os.lstat(path).st_ino)
+        self.bound_paths.append(bound)
+        _bound_unix.add(bound)
+        
+        self.selector.register(sock, EVENT_READ, None)
 
     def __del__(self):
         
+        self.close()
+        
+    def close(self):
+        """
+        Stop listening, and remove any Unix domain sockets we bound.
+        Registered links hold a reference to their listener, so don't
+        count on __del__ for this.
+        """
+        
         for sock in self.bound_sockets:
-            sock.shutdown(socket.SHUT_RDWR)
+            
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+                
             sock.close()
             
-
-
+        for path, ino in self.bound_paths:
+            _unlink_unix(path, ino)
+            
+        self.bound_sockets = []
+        self.bound_paths = []
+            
+        self.selector.close()
         
-    def select(self, wlist ,timeout=3):
+    def register(self, link):
         """
-        @wlist
-            list of downlink or uplink objects to wait on
+        Start waiting on link in select(). Links keep their registration
+        up to date themselves when they reconnect or close.
+        """
+        
+        sock = self.links.get(link)
+        
+        if sock is link.socket:
+            return
+            
+        if sock != None:
+            self.unregister(link)
+            
+        link.listener = self
+        
+        if link.socket == None:
+            return
+            
+        self.selector.register(link.socket, EVENT_READ, link)
+        self.links[link] = link.socket
+        
+    def unregister(self, link):
+        """
+        Stop waiting on link in select()
+        """
+        
+        sock = self.links.pop(link, None)
+        
+        self.corked.discard(link)
+        
+        if sock == None:
+            return
+            
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+            
+    def watch(self, wlist):
+        """
+        Make the set of registered links match wlist
         """
         
+        self.watched = wlist
+        self.watched_len = len(wlist)
+        
+        current = set(wlist)
+        
+        for link in current.difference(self.links):
+            self.register(link)
+            
+        for link in set(self.links).difference(current):
+            self.unregister(link)
+        
+    def select(self, wlist=None, timeout=3):
+        """
+        @wlist
+            list of downlink or uplink objects to wait on. If None, wait
+            on whatever links are already registered, which includes
+            every downlink returned by a previous call, and is the way
+            to go: register() and unregister() links as they come and
+            go, and it costs nothing per call.
+            
+            Passing the same list of links every time still works, but
+            is only kept for older code. The list is only looked through
+            again when it's a different list or its length has changed,
+            so swapping one link in it for another goes unnoticed;
+            register() the new one.
+        """
         
-        wdict = {}
-        for link in wlist:
-            wdict[link.fileno()] = link
+        if wlist != None and (wlist is not self.watched or \
+                len(wlist) != self.watched_len):
+            self.watch(wlist)
+            
+        if self.corked:
+            timeout = self.flush_corked(timeout)
         
         new_downlinks = []
         readable_links = []
         
-        waiting = self.bound_sockets + [link.socket for link in wlist]
+        for key, events in self.selector.select(timeout):
+            
+            if key.data == None:
+                new_downlinks += self.accept(key.fileobj)
+                
+            else:
+                readable_links.append(key.data)
+                
+        return readable_links, new_downlinks
+        
+    def queue_depths(self):
+        """
+        Return a dictionary mapping every registered link to a
+        (bytes, messages) tuple describing its send queue
+        """
         
-        readable,w,e = select.select(waiting,[],[],timeout)
+        out = {}
         
-        for sock in readable:
+        for link in self.links:
+            out[link] = (link.queued_bytes(), link.queued_msgs())
             
-            if sock in self.bound_sockets:
-                conn,addr = sock.accept()
-                conn.settimeout(0.0)
-                new_downlinks.append(downlink(conn))
+        return out
+        
+    def metrics(self):
+        """
+        Return a snapshot of the metrics of every registered link, as a
+        dictionary mapping link names to link.metrics()
+        """
+        
+        out = {}
+        
+        for link in self.links:
+            out[link.name or str(id(link))] = link.metrics()
+            
+        return out
+        
+    def metrics_json(self):
+        
+        return json.dumps(self.metrics(), sort_keys=True)
+        
+    def metrics_prometheus(self):
+        
+        return prometheus_text(self.metrics())
+        
+    def flush_corked(self, timeout):
+        """
+        flush() corked links whose max_delay has run out, and return
+        timeout shortened to wake up in time for the next one
+        """
+        
+        t = time.time()
+        
+        for link in list(self.corked):
+            
+            if not link.gather:
+                self.corked.discard(link)
+                
+            elif link.flush_due(t):
+                link.flush()
+                self.corked.discard(link)
                 
             else:
-                readable_links.append(wdict[sock.fileno()])
+                wait = link.cork_time + link.max_delay - t
                 
-        return readable_links, new_downlinks
-      
-      
-
+                if timeout == None or wait < timeout:
+                    timeout = wait
+                    
+        return timeout
+        
+    def accept(self, sock):
+        """
+        accept() every pending connection on bound socket sock and
+        return a list of registered downlinks
+        """
+        
+        out = []
+        
+        while True:
+        
+            try:
+                conn,addr = sock.accept()
+            except socket.error as e:
+                break
+                
+            conn.settimeout(0.0)
+            
+            link = downlink(conn)
+            
+            if self.queue_limits != None:
+                link.limit(**self.queue_limits)
+                
+            self.register(link)
+            out.append(link)
+            
+        return out
@@ -1,11 +1,94 @@
+import os
+import re
+import sys
+import time
+import heapq
+import fcntl
+import signal
+import itertools
+import traceback
 import subprocess
 import threading
 import datetime
+import select
+import socket
+import errno
+from collections import namedtuple, deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    import selectors
+except ImportError:
+    # python 2
+    selectors = None
+
+# event masks, the same values the selectors module uses
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+# Popen() arguments that start a command in a process group of its own.
+# start_new_session does it without running any python between fork()
+# and exec(), which isn't safe with other threads about, as there are
+# in a process_supervisor. python 2 only has preexec_fn.
+if sys.version_info[0] >= 3:
+    _own_group = {'start_new_session': True}
+else:
+    _own_group = {'preexec_fn': os.setpgrp}
+
+
+command_result = namedtuple('command_result',
+    ['cmd', 'returncode', 'stdout', 'stderr', 'seconds', 'timed_out'])
+
+# what command_stream splits lines on; rsync and friends redraw progress
+# lines with a bare carriage return
+_line_end = re.compile(b'\r\n|\r|\n')
+
+class tail_buffer(object):
+    """
+    Keeps the last max_bytes bytes written to it, or everything if
+    max_bytes is None, so that a chatty command's output can be kept
+    for error reporting without keeping all of it
+    """
+    
+    def __init__(self, max_bytes=None):
+    
+        self.max_bytes = max_bytes
+        
+        self.chunks = deque()
+        self.size = 0
+        
+        # bytes written altogether, kept or not
+        self.total = 0
+        
+    def write(self, data):
+    
+        self.chunks.append(data)
+        self.size += len(data)
+        self.total += len(data)
+        
+        if self.max_bytes == None:
+            return
+            
+        # drop whole chunks while what's left is still long enough;
+        # getvalue() trims the rest
+        while self.chunks and \
+                self.size - len(self.chunks[0]) >= self.max_bytes:
+            self.size -= len(self.chunks.popleft())
+            
+    def getvalue(self):
+    
+        data = b''.join(self.chunks)
+        
+        if self.max_bytes != None and len(data) > self.max_bytes:
+            data = data[len(data) - self.max_bytes:]
+            
+        return data
 
 
 def external_call(cmds, timeout=1, parent=None):
     """
-    Make a series of blocking external calls that time out safely.
+    Make a series of blocking external calls that time out safely. They
+    run at the same time, with run_commands().
     
     @cmds:
         list of lists containing the external calls, each just as would be
@@ -17,47 +100,864 @@ def external_call(cmds, timeout=1, parent=None):
     Parent is optionally any object with list fields named stdout and stderr,
     and is only used by external_call_async
     """
-    PIPE = subprocess.PIPE
+    
     out,err = [],[]
     
-    for cmd in cmds:
+    for result in run_commands(cmds, timeout):
     
-        proc = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
+        out.append(result.stdout)
+        err.append(result.stderr)
+        
+        if parent != None:
+            parent.stdout.append(result.stdout)
+            parent.stderr.append(result.stderr)
     
-        # python has closure support
-        def _call():
+    return out,err
+    
+def run_commands(cmds, timeout=1, parallel=16, kill_after=1.0, tail=None):
+    """
+    Run a batch of external commands at the same time and wait for them
+    all, killing any that run too long. Returns a list of
+    command_result tuples, one for each entry in cmds and in the same
+    order, with the command, its exit status, its stdout and stderr,
+    the seconds it ran for and whether it was timed out.
+    
+    @cmds:
+        list of commands, each just as would be passed to the
+        subprocess module
+        
+    @timeout:
+        seconds each command may run for before it's sent SIGTERM
+        
+    @parallel:
+        most commands to run at once. The rest wait for a slot.
         
-            _out,_err = proc.communicate() 
-            out.append(_out)
-            err.append(_err)
+    @kill_after:
+        seconds after SIGTERM before SIGKILL, and after that before we
+        give up waiting for the command's output, in case something it
+        started is still holding on to its stdout or stderr
         
-            if parent != None:
-                parent.stdout.append(_out)
-                parent.stderr.append(_err)
+    @tail:
+        if not None, keep only the last tail bytes of each command's
+        stdout and stderr
     
-        worker = threading.Thread(target=_call)
-
-        worker.start()
-        worker.join(timeout)
+    Each command runs in a process group of its own, and the signals go
+    to the whole group, so that nothing a command started is left
+    behind either.
     
-    if worker.is_alive():
-        proc.terminate()
-        worker.join()
+    A command that can't be started at all gets a returncode of None and
+    the reason in stderr.
     
-    return out,err
+    Everything happens in the calling thread, in a command_pool: one
+    selector waits on the output of every command, so a whole batch
+    takes about as long as its slowest command rather than the sum of
+    them all. See process_supervisor for the same without waiting.
+    """
+    
+    pool = command_pool(parallel, kill_after)
+    
+    handles = [process_handle(cmd, timeout, tail=tail) for cmd in cmds]
+    
+    try:
+        for handle in handles:
+            pool.submit(handle)
+            
+        while pool.busy():
+            pool.step()
+            
+    finally:
+        pool.close()
+    
+    return [handle.result() for handle in handles]
+    
+class process_timeout(Exception):
+    pass
+    
+class process_handle(object):
+    """
+    A command handed to a command_pool or process_supervisor, and in the
+    end its command_result
+    """
+    
+    def __init__(self, cmd, timeout=None, callback=None, on_output=None,
+                    tail=None):
+        """
+        @timeout:
+            seconds the command may run for before it's sent SIGTERM,
+            or None for as long as it likes
+            
+        @callback:
+            if not None, called as callback(handle) once the command is
+            done. See add_callback().
+            
+        @on_output:
+            if not None, called as on_output(handle, name, data) with
+            every chunk of output as it arrives, where name is 'stdout'
+            or 'stderr'. It's called from the same thread as callbacks.
+            
+        @tail:
+            if not None, keep only the last tail bytes of stdout and
+            stderr for the command_result
+        """
+        
+        self.cmd = cmd
+        self.timeout = timeout
+        self.supervisor = None
+        
+        self.on_output = on_output
+        self.buffers = {'stdout': tail_buffer(tail),
+            'stderr': tail_buffer(tail)}
+        
+        # the _command running it, once it's started
+        self.command = None
+        self.cancelled = False
+        
+        self.outcome = None
+        self.finished = threading.Event()
+        
+        self.lock = threading.Lock()
+        self.callbacks = []
+        
+        if callback != None:
+            self.callbacks.append(callback)
+            
+    def done(self):
+        return self.finished.is_set()
+        
+    def output(self, name, data):
+    
+        self.buffers[name].write(data)
+        
+        if self.on_output != None:
+            self.on_output(self, name, data)
+        
+    def add_callback(self, fn):
+        """
+        Call fn(self) once the command is done; right away if it already
+        is. Callbacks of commands run by a process_supervisor are called
+        on its thread, so they should be quick, and careful with
+        anything they share with other threads.
+        """
+        
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(fn)
+                return
+                
+        fn(self)
+        
+    def result(self, timeout=None):
+        """
+        Return the command_result, waiting up to timeout seconds for it
+        (forever, if None). Raises process_timeout if the command isn't
+        done in time.
+        """
+        
+        if not self.finished.wait(timeout):
+            raise process_timeout('%r still running' % (self.cmd,))
+            
+        return self.outcome
+        
+    def cancel(self):
+        """
+        Kill the command, or don't start it if it hasn't been yet
+        """
+        
+        if self.supervisor != None:
+            self.supervisor.cancel(self)
+            
+    def finish(self, outcome):
+    
+        with self.lock:
+            self.outcome = outcome
+            self.finished.set()
+            
+            callbacks = self.callbacks
+            self.callbacks = []
+            
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+                
+class command_pool(object):
+    """
+    Runs the commands of process_handles, at most parallel at once.
+    One selector waits on the output of all of them, and their deadlines
+    are kept in a heap, so step() only looks at the commands that have
+    something to say or have run out of time.
+    
+    Not thread safe; run_commands() drives one from its caller's thread
+    and process_supervisor from a thread of its own.
+    
+    A command that exits while something it left running in the
+    background still has its output open is done once that's had
+    exit_grace seconds to finish writing. Running commands are checked
+    for that every exit_check seconds at first, and less often the
+    longer they run, up to every exit_check_max seconds.
+    """
+    
+    exit_grace = 0.1
+    exit_check = 0.05
+    exit_check_max = 1.0
+    
+    def __init__(self, parallel=16, kill_after=1.0):
+        """
+        @parallel, @kill_after:
+            as for run_commands()
+        """
+        
+        self.parallel = parallel
+        self.kill_after = kill_after
+        
+        self.selector = default_selector()
+        
+        # handles waiting for a slot, and _commands running
+        self.waiting = deque()
+        self.running = set()
+        
+        # _commands that have closed their output but may not have
+        # exited yet, which can only be polled
+        self.exiting = set()
+        
+        # (deadline, n, _command) heap. Entries for commands that have
+        # finished, or whose deadlines have moved, are skipped.
+        self.deadlines = []
+        self.counter = itertools.count()
+        
+        # (time, n, _command) heap of when to next check whether running
+        # commands have exited with their output still open
+        self.checks = []
+    
+    def submit(self, handle):
+        self.waiting.append(handle)
+        
+    def busy(self):
+        return len(self.waiting) > 0 or len(self.running) > 0
+        
+    def start(self):
+        """
+        Start waiting commands while there are slots for them
+        """
+        
+        while self.waiting and len(self.running) < self.parallel:
+        
+            handle = self.waiting.popleft()
+            
+            if handle.cancelled:
+                self.finish_cancelled(handle)
+                continue
+                
+            try:
+                c = _command(handle, self)
+            except EnvironmentError as e:
+                handle.finish(command_result(handle.cmd, None, b'',
+                    str(e).encode(), 0.0, False))
+                continue
+                
+            handle.command = c
+            
+            self.running.add(c)
+            self.schedule(c)
+            self.schedule_check(c, self.exit_check)
+            
+    def finish_cancelled(self, handle):
+        """
+        Finish handle, which was cancelled before its command started
+        """
+        
+        handle.finish(command_result(handle.cmd, None, b'', b'cancelled',
+            0.0, False))
+    
+    def schedule(self, c):
+    
+        if c.deadline != None:
+            heapq.heappush(self.deadlines, (c.deadline, next(self.counter), c))
+            
+    def schedule_check(self, c, delay):
+        
+        c.check_delay = delay
+        heapq.heappush(self.checks, (time.time() + delay,
+            next(self.counter), c))
+    
+    def check_exited(self, t):
+        """
+        Look for commands due a check that have exited with their output
+        still open, and give them exit_grace seconds before they're done
+        """
+        
+        checks = self.checks
+        
+        while checks and checks[0][0] <= t:
+            
+            when, n, c = heapq.heappop(checks)
+            
+            if not c in self.running or c in self.exiting:
+                continue
+            
+            if not c.poll_exit(t):
+                self.schedule_check(c, min(2*c.check_delay,
+                    self.exit_check_max))
+                continue
+            
+            deadline = t + self.exit_grace
+            
+            if c.deadline == None or deadline < c.deadline:
+                c.deadline = deadline
+                self.schedule(c)
+    
+    def cancel(self, handle):
+        """
+        Don't start handle's command, or kill it now if it's running
+        """
+        
+        handle.cancelled = True
+        
+        c = handle.command
+        
+        if c != None and c in self.running:
+            c.deadline = time.time()
+            self.schedule(c)
+            
+    def step(self, timeout=None):
+        """
+        Start what there's room for, wait up to timeout seconds (or
+        until the next deadline) for anything to happen, and deal with
+        whatever does. Returns the handles of the commands that finished.
+        
+        Anything else registered with self.selector should have a
+        read(fd) method, which is called when it's readable.
+        """
+        
+        self.start()
+        
+        wait = timeout
+        
+        for heap in (self.deadlines, self.checks):
+            
+            if heap:
+                t = heap[0][0] - time.time()
+                wait = t if wait == None else min(wait, t)
+            
+        if self.exiting:
+            wait = 0.01 if wait == None else min(wait, 0.01)
+            
+        if wait != None:
+            wait = max(wait, 0)
+            
+        for key, events in self.selector.select(wait):
+            key.data.read(key.fd)
+            
+        t = time.time()
+        
+        done = []
+        
+        for c in list(self.exiting):
+            if c.poll_exit(t):
+                done.append(c)
+                
+        self.check_exited(t)
+        
+        deadlines = self.deadlines
+        
+        while deadlines and deadlines[0][0] <= t:
+        
+            deadline, n, c = heapq.heappop(deadlines)
+            
+            if not c in self.running or deadline != c.deadline:
+                continue
+                
+            if c.escalate(t, self.kill_after):
+                done.append(c)
+            else:
+                self.schedule(c)
+                
+        handles = []
+        
+        for c in done:
+        
+            if not c in self.running:
+                continue
+                
+            self.running.remove(c)
+            self.exiting.discard(c)
+            
+            c.handle.finish(c.result())
+            handles.append(c.handle)
+            
+        return handles
+        
+    def close(self):
+        """
+        Kill everything still running, and give up on everything still
+        waiting
+        """
+        
+        for c in self.running:
+            c.abandon()
+            c.handle.finish(c.result())
+            
+        self.running.clear()
+        self.exiting.clear()
+        
+        # without start()ing any of them, which would only take their
+        # slots back up again
+        while self.waiting:
+            handle = self.waiting.popleft()
+            handle.cancelled = True
+            self.finish_cancelled(handle)
+            
+        self.selector.close()
+        
+class _command(object):
+    """
+    A command being run by a command_pool
+    """
+    
+    def __init__(self, handle, pool):
+    
+        PIPE = subprocess.PIPE
+        
+        self.handle = handle
+        self.cmd = handle.cmd
+        self.pool = pool
+        
+        self.started = time.time()
+        self.exited = None
+        
+        self.deadline = None
+        
+        if handle.timeout != None:
+            self.deadline = self.started + handle.timeout
+            
+        # 0 running, 1 sent SIGTERM, 2 sent SIGKILL
+        self.stage = 0
+        
+        # in a process group of its own, so that signals reach anything
+        # it started too
+        self.proc = subprocess.Popen(self.cmd, stdout=PIPE, stderr=PIPE,
+            close_fds=True, **_own_group)
+            
+        self.out_fd = self.proc.stdout.fileno()
+        self.err_fd = self.proc.stderr.fileno()
+        
+        # which is which, and the descriptors we're still reading
+        self.names = {self.out_fd: 'stdout', self.err_fd: 'stderr'}
+        self.fds = [self.out_fd, self.err_fd]
+        
+        for fd in self.fds:
+            pool.selector.register(fd, EVENT_READ, self)
+            
+    def read(self, fd):
+    
+        try:
+            data = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = b''
+            
+        if data:
+            self.handle.output(self.names[fd], data)
+        else:
+            self.close_fd(fd)
+            
+    def close_fd(self, fd):
+    
+        self.pool.selector.unregister(fd)
+        self.fds.remove(fd)
+        
+        if not self.fds:
+            self.pool.exiting.add(self)
+            
+    def poll_exit(self, t):
+        """
+        True if the command has exited by time t. Only asked once its
+        output is closed.
+        """
+        
+        if self.exited == None and self.proc.poll() != None:
+            self.exited = t
+            
+        return self.exited != None
+        
+    def escalate(self, t, kill_after):
+        """
+        The command's deadline has come at time t: signal it, and move
+        the deadline on kill_after seconds. Returns True if we've given
+        up on it altogether.
+        
+        If the command has already exited, its deadline is the end of
+        the grace given to whatever it left with its output open. That
+        isn't ours to kill, so we just stop reading.
+        """
+        
+        if self.stage == 0:
+            self.poll_exit(t)
+        
+        if self.exited != None:
+            
+            for fd in list(self.fds):
+                self.close_fd(fd)
+            
+            return True
+        
+        if self.stage == 0:
+            self.signal(signal.SIGTERM)
+        elif self.stage == 1:
+            self.signal(signal.SIGKILL)
+        else:
+            # whatever still has our pipes open isn't going away
+            for fd in list(self.fds):
+                self.close_fd(fd)
+                
+            if self.exited == None:
+                self.exited = t
+                
+            return True
+            
+        self.stage += 1
+        self.deadline = t + kill_after
+        
+        return False
+        
+    def signal(self, sig):
+    
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+                
+    def result(self):
+    
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        
+        # SIGKILL has been sent if we gave up on the output, so this
+        # won't be long
+        returncode = self.proc.wait()
+        
+        return command_result(self.cmd, returncode,
+            self.handle.buffers['stdout'].getvalue(),
+            self.handle.buffers['stderr'].getvalue(),
+            self.exited - self.started, self.stage > 0)
+            
+    def abandon(self):
+        """
+        Kill the command, if it's still going, and let go of it
+        """
+        
+        for fd in list(self.fds):
+            self.close_fd(fd)
+            
+        if self.proc.poll() == None:
+            self.signal(signal.SIGKILL)
+            self.stage = max(self.stage, 2)
+            self.proc.wait()
+            
+        if self.exited == None:
+            self.exited = time.time()
+            
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        
+class process_supervisor(object):
+    """
+    Runs external commands in the background, all from one thread.
+    
+    run() hands a command to the supervisor's thread and returns a
+    process_handle for it straight away. The thread runs a command_pool,
+    so however many commands are running, there's just the one thread
+    reading their output and keeping track of their deadlines, which
+    sleeps when there's nothing to do.
+    
+    Usage:
+    
+        ps = supervisor().run(['ps', '-p', pid], timeout=5)
+        
+        do_something_else()
+        
+        if ps.result().returncode != 0:
+            restart()
+    
+    or, without waiting at all:
+    
+        supervisor().run(['rsync', ...], timeout=600, callback=synced)
+    """
+    
+    def __init__(self, parallel=64, kill_after=1.0):
+        """
+        @parallel, @kill_after:
+            as for run_commands()
+        """
+        
+        self.pool = command_pool(parallel, kill_after)
+        
+        # (function, handle) calls for the thread to make
+        self.requests = deque()
+        self.lock = threading.Lock()
+        
+        # other threads write a byte here to wake the thread up
+        self.wake_r, self.wake_w = os.pipe()
+        
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                
+        self.pool.selector.register(self.wake_r, EVENT_READ, self)
+        
+        self.thread = None
+        self.stopping = False
+        
+    def run(self, cmd, timeout=None, callback=None, on_output=None,
+                tail=None):
+        """
+        Start cmd as soon as there's a slot for it. Returns a
+        process_handle. The rest of the arguments are as for
+        process_handle.
+        """
+        
+        handle = process_handle(cmd, timeout, callback, on_output, tail)
+        handle.supervisor = self
+        
+        self.request(self.pool.submit, handle)
+        
+        return handle
+        
+    def run_many(self, cmds, timeout=None):
+        """
+        run() every command in cmds. Returns a list of process_handles.
+        """
+        
+        return [self.run(cmd, timeout) for cmd in cmds]
+        
+    def cancel(self, handle):
+        self.request(self.pool.cancel, handle)
+        
+    def request(self, fn, handle):
+        """
+        Have the thread call fn(handle), starting the thread if need be
+        """
+        
+        with self.lock:
+        
+            if self.stopping:
+                raise RuntimeError('process_supervisor is closed')
+                
+            self.requests.append((fn, handle))
+            
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.loop,
+                    name='process_supervisor')
+                self.thread.daemon = True
+                self.thread.start()
+                
+        self.wake()
+        
+    def wake(self):
+    
+        try:
+            os.write(self.wake_w, b'x')
+        except OSError as e:
+            # already plenty of bytes waiting
+            if e.errno != errno.EAGAIN:
+                raise
+                
+    def read(self, fd):
+        """
+        Called by the pool when we've been woken up
+        """
+        
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+                
+    def loop(self):
+    
+        pool = self.pool
+        
+        while True:
+        
+            with self.lock:
+                requests = list(self.requests)
+                self.requests.clear()
+                stopping = self.stopping
+                
+            for fn, handle in requests:
+                fn(handle)
+                
+            if stopping and not pool.busy():
+                break
+                
+            pool.step()
+            
+    def close(self, timeout=None):
+        """
+        Stop taking commands, wait up to timeout seconds for the ones
+        already taken to finish, and kill any that haven't
+        """
+        
+        with self.lock:
+            self.stopping = True
+            thread = self.thread
+            
+        self.wake()
+        
+        if thread != None:
+            thread.join(timeout)
+            
+            if thread.is_alive():
+                with self.lock:
+                    for handle in list(self.pool.waiting):
+                        self.requests.append((self.pool.cancel, handle))
+                    for c in list(self.pool.running):
+                        self.requests.append((self.pool.cancel, c.handle))
+                        
+                self.wake()
+                thread.join()
+                
+        self.pool.close()
+        
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        
+class command_stream(object):
+    """
+    Run a command and go through its output as it arrives, in the
+    calling thread, rather than waiting for all of it at the end. Only
+    the last tail bytes of stdout and stderr are kept, for result.
+    
+    Usage:
+    
+        stream = command_stream(['rsync', '-a', '--info=progress2',
+            src, dst], timeout=600)
+            
+        for name, line in stream:
+        
+            if name == 'stdout':
+                show_progress(line)
+                
+            if giving_up:
+                stream.close()
+                
+        if stream.result.returncode != 0:
+            report(stream.result.stderr)
+    
+    Iterating gives (name, data) pairs, where name is 'stdout' or
+    'stderr' and data is a line without its line ending, or with lines
+    False, whatever chunk of output turned up. Lines end in a newline or
+    a carriage return, and blank ones are skipped. Once the command's
+    done, result is its command_result.
+    """
+    
+    def __init__(self, cmd, timeout=None, tail=65536, lines=True,
+                    kill_after=1.0):
+        """
+        @timeout, @kill_after:
+            as for run_commands()
+            
+        @tail:
+            bytes of the end of stdout and stderr to keep for result, or
+            None for all of it
+        """
+        
+        self.lines = lines
+        self.result = None
+        
+        # (name, data) ready to hand out, and the unfinished last line
+        # of each stream so far
+        self.pending = deque()
+        self.partial = {'stdout': b'', 'stderr': b''}
+        
+        self.handle = process_handle(cmd, timeout, on_output=self.output,
+            tail=tail)
+        
+        self.pool = command_pool(1, kill_after)
+        self.pool.submit(self.handle)
+        
+    def output(self, handle, name, data):
+    
+        if not self.lines:
+            self.pending.append((name, data))
+            return
+            
+        parts = _line_end.split(self.partial[name] + data)
+        
+        self.partial[name] = parts.pop()
+        
+        for line in parts:
+            if line:
+                self.pending.append((name, line))
+                
+    def __iter__(self):
+    
+        while True:
+        
+            while self.pending:
+                yield self.pending.popleft()
+                
+            if self.result != None:
+                return
+                
+            if self.pool.busy():
+                self.pool.step()
+                continue
+                
+            # done; hand out what's left of the last lines
+            for name in ('stdout', 'stderr'):
+                if self.partial[name]:
+                    self.pending.append((name, self.partial[name]))
+                    self.partial[name] = b''
+                    
+            self.result = self.handle.result()
+            self.pool.close()
+            
+    def close(self):
+        """
+        Kill the command now if it's still running. result is still
+        set, with whatever output there was.
+        """
+        
+        if self.result == None:
+            self.pool.close()
+            self.result = self.handle.result()
+            
+_supervisor = None
+_shared_lock = threading.Lock()
 
+def supervisor():
+    """
+    Return the process_supervisor shared by everything in this process,
+    starting it if need be
+    """
+    
+    global _supervisor
+    
+    with _shared_lock:
+    
+        if _supervisor == None:
+            _supervisor = process_supervisor()
+            
+        return _supervisor
+        
 class external_call_async(object):
     """
-    Make a set of nonblocking external calls inside a worker thread that will
-    safely time out if the external programs don't terminate.
+    Make a set of nonblocking external calls that will safely time out if
+    the external programs don't terminate.
     
-    stdout and stderr end up in the stdout and stderr members.
+    stdout and stderr are None until every call has finished, then lists
+    of their output in the same order as cmds.
     
     Usage:
     
         ping = external_call_async([['ping', 'equatorialbear.ucsd.edu']])
     
-        if ping.worker.is_alive():
+        if not ping.done():
             sleep(1) # or something else while we wait
             
         if ping.stderr[0]:
@@ -66,9 +966,10 @@ class external_call_async(object):
         ret = ping.stdout[0]
     
     
-    The current implementation involves launching a new thread within a new
-    thread, so definitely try to batch call external programs within a single
-    external_call_async.
+    The calls are run by the shared process_supervisor, so no threads are
+    started for them. handles has the process_handle of each of them, for
+    more than just their output. Code written for the thread that used to
+    run them can still use worker.is_alive() and worker.join(), or join().
     """
     
     def __init__(self,cmds,timeout=1):
@@ -79,9 +980,508 @@ class external_call_async(object):
         self.stdout = None
         self.stderr = None
         
-        self.worker = threading.Thread(target=external_call,
-            args=(cmds,timeout,self))
-        self.worker.start()
+        # set once stdout and stderr are
+        self.ready = threading.Event()
+        
+        self.worker = _call_worker(self)
+        
+        self.handles = supervisor().run_many(cmds, timeout)
+        
+        if not self.handles:
+            self.finished(None)
+        
+        for handle in self.handles:
+            handle.add_callback(self.finished)
+            
+    def done(self):
+        return self.ready.is_set()
+        
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds for every call to finish. Returns
+        True if they have.
+        """
+        
+        return self.ready.wait(timeout)
+        
+    def join(self, timeout=None):
+        """
+        As for threading.Thread.join()
+        """
+        
+        self.wait(timeout)
+        
+    def finished(self, handle):
+    
+        if not all(h.done() for h in self.handles):
+            return
+            
+        results = [h.outcome for h in self.handles]
+        
+        self.stderr = [r.stderr for r in results]
+        self.stdout = [r.stdout for r in results]
+        self.ready.set()
+
+class _call_worker(object):
+    """
+    Stands in for the thread external_call_async used to run its calls on
+    """
+    
+    def __init__(self, call):
+        self.call = call
+        
+    def is_alive(self):
+        return not self.call.done()
+    
+    isAlive = is_alive
+    
+    def join(self, timeout=None):
+        self.call.join(timeout)
+        
+probe_result = namedtuple('probe_result',
+    ['addr', 'port', 'reachable', 'state', 'seconds', 'checked'])
+    
+class host_prober(object):
+    """
+    Finds out which hosts can be reached, without a process per host.
+    
+    probe() starts a nonblocking TCP connect to a port on every host it's
+    given (their ssh port, say) and waits on all of them at once with a
+    selector, so a whole fleet takes about one timeout. A connection
+    that's accepted or refused means the host is up and routable; one
+    that times out or fails any other way means it isn't. Results are
+    cached for ttl seconds, so asking about a host again soon after is a
+    dictionary lookup.
+    
+    Usage:
+    
+        p = prober()
+        
+        # once in a while, for everything at once, without waiting
+        p.refresh_later([(h.addr, h.sshport) for h in hosts])
+        
+        # whenever a decision needs making
+        if p.status(addr, 22):
+            route_via(addr)
+    
+    status() never waits on a probe unless asked to; with nothing fresh
+    in the cache it answers from whatever is there, and has it brought
+    up to date in the background.
+    
+    Each probe_result has the state of the connection: 'open',
+    'refused', 'timeout', 'unresolved', or the name of the errno it
+    failed with, lower cased, such as 'ehostunreach'.
+    """
+    
+    # seconds a looked up address stays fresh
+    resolve_ttl = 300.0
+    
+    # threads to look addresses up on
+    resolvers = 16
+    
+    def __init__(self, ttl=30.0, timeout=1.0, parallel=512):
+        """
+        @ttl:
+            seconds a result stays fresh
+            
+        @timeout:
+            seconds to wait for each connect, and for each address to be
+            looked up
+            
+        @parallel:
+            most connects to have in progress at once
+        """
+        
+        self.ttl = ttl
+        self.timeout = timeout
+        self.parallel = parallel
+        
+        # probe_result by (addr, port)
+        self.cache = {}
+        self.lock = threading.Lock()
+        
+        # (getaddrinfo() entry, time looked up) by (addr, port)
+        self.addresses = {}
+        
+        # ThreadPool for getaddrinfo(), started the first time a name
+        # needs looking up
+        self.pool = None
+        
+        # thread running refresh_later()'s refresh, if any
+        self.refreshing = None
+    
+    def cached(self, addr, port, max_age=None):
+        """
+        The cached probe_result for addr and port if it's no older than
+        max_age seconds (self.ttl by default), otherwise None
+        """
+        
+        if max_age == None:
+            max_age = self.ttl
+            
+        r = self.cache.get((addr, port))
+        
+        if r == None or time.time() - r.checked > max_age:
+            return None
+            
+        return r
+        
+    def status(self, addr, port, max_age=None, wait=False):
+        """
+        True if addr can be reached on port, from the cache if possible.
+        If the cached result is older than max_age, it's used anyway and
+        refreshed in the background, unless wait is True, in which case
+        we probe and wait for the answer. None if there's nothing in the
+        cache to go on.
+        """
+        
+        r = self.cached(addr, port, max_age)
+        
+        if r == None:
+            
+            if wait:
+                r = self.probe([(addr, port)])[0]
+            else:
+                self.refresh_later([(addr, port)], max_age)
+                r = self.cache.get((addr, port))
+                
+                if r == None:
+                    return None
+            
+        return r.reachable
+        
+    def refresh_later(self, targets, max_age=None):
+        """
+        refresh() targets on a thread of its own, and return straight
+        away. Does nothing if an earlier refresh_later() is still going.
+        Returns True if it started one.
+        """
+        
+        with self.lock:
+            
+            if self.refreshing != None and self.refreshing.is_alive():
+                return False
+            
+            self.refreshing = threading.Thread(target=self.refresh,
+                args=(list(targets), max_age), name='host_prober')
+            self.refreshing.daemon = True
+            self.refreshing.start()
+        
+        return True
+    
+    def refresh(self, targets, max_age=None):
+        """
+        probe() whichever of targets, a list of (addr, port) pairs,
+        don't have fresh results. Returns a probe_result for each of
+        targets, in order.
+        """
+        
+        stale = [t for t in targets \
+            if self.cached(t[0], t[1], max_age) == None]
+        
+        if stale:
+            self.probe(stale)
+            
+        return [self.cache[tuple(t)] for t in targets]
+        
+    def probe(self, targets, timeout=None):
+        """
+        Try connecting to each of targets, a list of (addr, port) pairs,
+        all at once. Returns a probe_result for each of them, in order,
+        and caches them.
+        
+        Names that need looking up are looked up all at once too, on
+        the resolver threads, and each host's connect starts as soon as
+        its address is known. A lookup that takes longer than timeout
+        counts as a timeout, but its answer is still kept for next time.
+        """
+        
+        if timeout == None:
+            timeout = self.timeout
+            
+        targets = [tuple(t) for t in targets]
+        results = [None] * len(targets)
+        
+        # indices of targets ready to connect, with their addresses
+        waiting = deque()
+        
+        # start time of every lookup in progress, by index
+        resolving = {}
+        
+        # (sock, index, started) by file descriptor
+        connecting = {}
+        
+        # (deadline, n, fd or None, index) heap. An fd of None is a
+        # lookup's deadline.
+        deadlines = []
+        counter = itertools.count()
+        
+        selector = default_selector()
+        answers = None
+        
+        def finish(i, state, started):
+            addr, port = targets[i]
+            t = time.time()
+            results[i] = probe_result(addr, port,
+                state in ('open', 'refused'), state, t - started, t)
+                
+        def close(fd):
+            sock, i, started = connecting.pop(fd)
+            selector.unregister(fd)
+            sock.close()
+            return i, started
+            
+        for i, (addr, port) in enumerate(targets):
+            
+            started = time.time()
+            info = self.address(addr, port)
+            
+            if info != None:
+                waiting.append((i, info, started))
+                continue
+            
+            if answers == None:
+                answers = _answers()
+                selector.register(answers.r, EVENT_READ)
+            
+            resolving[i] = started
+            heapq.heappush(deadlines,
+                (started + timeout, next(counter), None, i))
+            
+            self.resolve(addr, port, i, answers)
+        
+        try:
+            while waiting or connecting or resolving:
+            
+                while waiting and len(connecting) < self.parallel:
+                
+                    i, info, started = waiting.popleft()
+                    
+                    if info == False:
+                        finish(i, 'unresolved', started)
+                        continue
+                        
+                    sock, err = self.connect(info)
+                    
+                    if not err in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                                    errno.EALREADY):
+                        sock.close()
+                        finish(i, _connect_state(err), started)
+                        continue
+                        
+                    fd = sock.fileno()
+                    
+                    connecting[fd] = (sock, i, started)
+                    selector.register(fd, EVENT_WRITE)
+                    heapq.heappush(deadlines,
+                        (started + timeout, next(counter), fd, i))
+                    
+                if not connecting and not resolving:
+                    continue
+                    
+                wait = max(deadlines[0][0] - time.time(), 0)
+                
+                for key, events in selector.select(wait):
+                
+                    if answers != None and key.fd == answers.r:
+                        continue
+                    
+                    sock = connecting[key.fd][0]
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    
+                    i, started = close(key.fd)
+                    finish(i, _connect_state(err), started)
+                    
+                if answers != None:
+                    for i, info in answers.take():
+                        if i in resolving:
+                            waiting.append((i, info or False,
+                                resolving.pop(i)))
+                
+                t = time.time()
+                
+                while deadlines and deadlines[0][0] <= t:
+                
+                    deadline, n, fd, i = heapq.heappop(deadlines)
+                    
+                    if fd == None:
+                        if i in resolving:
+                            finish(i, 'timeout', resolving.pop(i))
+                        continue
+                    
+                    # a descriptor since reused for a later connect has a
+                    # later deadline of its own
+                    if fd in connecting and \
+                        connecting[fd][2] + timeout <= t:
+                        
+                        i, started = close(fd)
+                        finish(i, 'timeout', started)
+                        
+        finally:
+            for fd in list(connecting):
+                close(fd)
+                
+            if answers != None:
+                answers.close()
+            
+            selector.close()
+            
+        with self.lock:
+            for r in results:
+                self.cache[(r.addr, r.port)] = r
+                
+        return results
+        
+    def address(self, addr, port):
+        """
+        The getaddrinfo() entry to connect to addr and port with if we
+        have one that's fresh, or can get one without asking DNS;
+        otherwise None
+        """
+        
+        entry = self.addresses.get((addr, port))
+        
+        if entry != None and time.time() - entry[1] <= self.resolve_ttl:
+            return entry[0]
+        
+        # numeric addresses never need a lookup
+        try:
+            return socket.getaddrinfo(addr, port, 0, socket.SOCK_STREAM,
+                0, socket.AI_NUMERICHOST)[0]
+        except socket.gaierror:
+            return None
+            
+    def resolve(self, addr, port, i, answers):
+        """
+        Look addr up on the resolver threads, keep what we find, and hand
+        it to answers as (i, getaddrinfo() entry), or (i, None) if
+        there's no such host
+        """
+        
+        with self.lock:
+            if self.pool == None:
+                self.pool = ThreadPool(self.resolvers)
+        
+        def lookup():
+            try:
+                info = socket.getaddrinfo(addr, port, 0,
+                    socket.SOCK_STREAM)[0]
+            except (socket.gaierror, socket.error, UnicodeError):
+                info = None
+            
+            if info != None:
+                with self.lock:
+                    self.addresses[(addr, port)] = (info, time.time())
+            
+            answers.put(i, info)
+        
+        self.pool.apply_async(lookup)
+    
+    def connect(self, info):
+        """
+        Start a nonblocking connect to info, a getaddrinfo() entry.
+        Returns the socket and the errno connect gave.
+        """
+        
+        family, socktype, proto, name, sockaddr = info
+        
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        
+        return sock, sock.connect_ex(sockaddr)
+        
+class _answers(object):
+    """
+    Where a host_prober's resolver threads leave the addresses they've
+    looked up for one probe(). Every answer writes a byte to a pipe, so
+    probe() can wait on it along with its connects.
+    """
+    
+    def __init__(self):
+        
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.closed = False
+        
+        self.r, self.w = os.pipe()
+        
+        for fd in (self.r, self.w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    
+    def put(self, i, info):
+        """
+        Called from a resolver thread. Answers that come after probe()
+        has given up on them are dropped.
+        """
+        
+        with self.lock:
+            
+            if self.closed:
+                return
+            
+            self.queue.append((i, info))
+            
+            try:
+                os.write(self.w, b'x')
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+    
+    def take(self):
+        """
+        Return every answer so far, as a list of (i, info)
+        """
+        
+        try:
+            while os.read(self.r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        
+        with self.lock:
+            out = list(self.queue)
+            self.queue.clear()
+        
+        return out
+    
+    def close(self):
+        
+        with self.lock:
+            self.closed = True
+            os.close(self.r)
+            os.close(self.w)
+
+def _connect_state(err):
+
+    if err == 0:
+        return 'open'
+        
+    if err == errno.ECONNREFUSED:
+        return 'refused'
+        
+    if err == errno.ETIMEDOUT:
+        return 'timeout'
+        
+    return errno.errorcode.get(err, str(err)).lower()
+    
+_prober = None
+
+def prober():
+    """
+    Return the host_prober shared by everything in this process,
+    creating it if need be
+    """
+    
+    global _prober
+    
+    with _shared_lock:
+    
+        if _prober == None:
+            _prober = host_prober()
+            
+        return _prober
         
 def datetime_to_list(dt):
     """
@@ -107,3 +1507,144 @@ def datetime_from_list(l):
         return None
         
     return datetime.datetime(*l)
+
+
+selector_key = namedtuple('selector_key', ['fileobj', 'fd', 'events', 'data'])
+
+class poll_selector(object):
+    """
+    Stand-in for selectors.PollSelector on pythons that don't have the
+    selectors module. Implements just enough of the selectors API for
+    our purposes: register(), unregister(), modify(), select() and
+    close(). Like the real thing, it isn't subject to FD_SETSIZE.
+    """
+    
+    def __init__(self):
+        
+        self.poll = select.poll()
+        
+        # selector_key by file descriptor
+        self.keys = {}
+        
+    def register(self, fileobj, events, data=None):
+        
+        fd = _fileno(fileobj)
+        
+        if fd in self.keys:
+            raise KeyError('%r is already registered' % (fileobj,))
+        
+        key = selector_key(fileobj, fd, events, data)
+        
+        self.poll.register(fd, self._pollmask(events))
+        self.keys[fd] = key
+        
+        return key
+        
+    def unregister(self, fileobj):
+        
+        key = self.keys.pop(self._lookup(fileobj))
+        
+        try:
+            self.poll.unregister(key.fd)
+        except (KeyError, ValueError, EnvironmentError):
+            pass
+            
+        return key
+        
+    def modify(self, fileobj, events, data=None):
+        
+        fd = self._lookup(fileobj)
+        
+        key = selector_key(fileobj, fd, events, data)
+        
+        self.poll.modify(fd, self._pollmask(events))
+        self.keys[fd] = key
+        
+        return key
+        
+    def select(self, timeout=None):
+        
+        if timeout != None:
+            timeout = max(int(1000 * timeout), 0)
+        
+        try:
+            ready = self.poll.poll(timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+            
+        out = []
+        
+        for fd, mask in ready:
+        
+            key = self.keys.get(fd)
+            
+            if key == None:
+                continue
+                
+            events = 0
+            
+            if mask & ~select.POLLOUT:
+                events |= EVENT_READ
+            if mask & (select.POLLOUT|select.POLLERR|select.POLLHUP):
+                events |= EVENT_WRITE
+                
+            out.append( (key, events & key.events) )
+            
+        return out
+        
+    def close(self):
+        
+        self.keys.clear()
+        
+    def _pollmask(self, events):
+    
+        mask = 0
+        
+        if events & EVENT_READ:
+            mask |= select.POLLIN
+        if events & EVENT_WRITE:
+            mask |= select.POLLOUT
+            
+        return mask
+        
+    def _lookup(self, fileobj):
+        """
+        Find the file descriptor fileobj was registered under, even if
+        it has since been closed
+        """
+        
+        try:
+            fd = _fileno(fileobj)
+            
+            if fd in self.keys:
+                return fd
+                
+        except (ValueError, EnvironmentError):
+            pass
+            
+        for fd, key in self.keys.items():
+            if key.fileobj is fileobj:
+                return fd
+                
+        raise KeyError('%r is not registered' % (fileobj,))
+        
+        
+def _fileno(fileobj):
+    
+    if isinstance(fileobj, int):
+        return fileobj
+        
+    return fileobj.fileno()
+    
+def default_selector():
+    """
+    Return the most efficient selector available on this platform,
+    e.g. selectors.EpollSelector on Linux.
+    """
+    
+    if selectors != None:
+        return selectors.DefaultSelector()
+        
+    return poll_selector()